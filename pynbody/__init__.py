@@ -27,6 +27,7 @@ from . import (
     filt,
     gravity,
     halo,
+    instrumentation,
     snapshot,
     sph,
     transformation,
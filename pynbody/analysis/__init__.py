@@ -16,6 +16,7 @@ from . import (
     ionfrac,
     luminosity,
     pkdgrav_cosmo,
+    power_spectrum,
     profile,
     ramses_util,
     theoretical_profiles,
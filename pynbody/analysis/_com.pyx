@@ -9,6 +9,8 @@ import math
 import numpy as np
 from cython.parallel import prange
 
+from libc.math cimport INFINITY, NAN, fabs, floor, sqrt
+
 logger = logging.getLogger('pynbody.analysis._com')
 
 
@@ -85,3 +87,378 @@ def shrink_sphere_center(np.ndarray[np.float64_t, ndim=2] pos,
             raise RuntimeError, "shrink_sphere_center failed to converge after %d iterations"%itermax
 
     return com_x, current_rmax, second_radius
+
+
+cdef inline double _wrap_offset(double dx, double boxsize) noexcept nogil:
+    if boxsize > 0:
+        return dx - boxsize * floor(dx / boxsize + 0.5)
+    else:
+        return dx
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int _shrink_sphere_one_halo(double[:, :] pos, double[:] mass, double[:, :] vel,
+                                 np.uint8_t[:] use_for_velocity, np.int64_t[:] indices,
+                                 Py_ssize_t start, Py_ssize_t stop, int min_particles,
+                                 int particles_for_velocity, double shrink_factor, double boxsize,
+                                 int itermax, double[:, :] centers, double[:, :] velocities,
+                                 double[:] radii, double[:] velocity_radii, Py_ssize_t s) noexcept nogil:
+    cdef Py_ssize_t j, p
+    cdef Py_ssize_t n = stop - start
+    cdef double refx, refy, refz, cx = 0, cy = 0, cz = 0, dx, dy, dz, r2, mi
+    cdef double ox, oy, oz, tot_mass, xmin, xmax
+    cdef double current_rmax = INFINITY, starting_rmax, velocity_radius = -1.0
+    cdef double vx, vy, vz
+    cdef long npart
+    cdef int iternum = 0
+
+    if n == 0:
+        centers[s, 0] = NAN; centers[s, 1] = NAN; centers[s, 2] = NAN
+        velocities[s, 0] = NAN; velocities[s, 1] = NAN; velocities[s, 2] = NAN
+        radii[s] = NAN
+        velocity_radii[s] = NAN
+        return 0
+
+    # work in offsets from the first particle, so that halos straddling a periodic boundary are handled
+    p = indices[start]
+    refx = pos[p, 0]; refy = pos[p, 1]; refz = pos[p, 2]
+
+    xmin = INFINITY; xmax = -INFINITY
+    for j in range(start, stop):
+        p = indices[j]
+        dx = _wrap_offset(pos[p, 0] - refx, boxsize)
+        cx += dx
+        cy += _wrap_offset(pos[p, 1] - refy, boxsize)
+        cz += _wrap_offset(pos[p, 2] - refz, boxsize)
+        if dx < xmin:
+            xmin = dx
+        if dx > xmax:
+            xmax = dx
+    cx /= n; cy /= n; cz /= n
+    starting_rmax = (xmax - xmin) / 2
+
+    while True:
+        ox = 0; oy = 0; oz = 0; tot_mass = 0; npart = 0
+        for j in range(start, stop):
+            p = indices[j]
+            dx = _wrap_offset(pos[p, 0] - refx, boxsize) - cx
+            dy = _wrap_offset(pos[p, 1] - refy, boxsize) - cy
+            dz = _wrap_offset(pos[p, 2] - refz, boxsize) - cz
+            r2 = dx * dx + dy * dy + dz * dz
+            if r2 < current_rmax * current_rmax:
+                mi = mass[p]
+                ox = ox + dx * mi
+                oy = oy + dy * mi
+                oz = oz + dz * mi
+                tot_mass = tot_mass + mi
+                npart = npart + 1
+
+        if npart < particles_for_velocity and velocity_radius < 0:
+            velocity_radius = current_rmax
+
+        if npart < min_particles or tot_mass == 0:
+            break
+
+        cx = cx + ox / tot_mass; cy = cy + oy / tot_mass; cz = cz + oz / tot_mass
+
+        iternum = iternum + 1
+        if iternum > 1:
+            current_rmax = current_rmax * shrink_factor
+        else:
+            current_rmax = starting_rmax
+
+        if iternum > itermax:
+            return -1
+
+    radii[s] = current_rmax
+    velocity_radii[s] = velocity_radius
+
+    vx = 0; vy = 0; vz = 0; tot_mass = 0
+    if velocity_radius > 0:
+        for j in range(start, stop):
+            p = indices[j]
+            if not use_for_velocity[p]:
+                continue
+            dx = _wrap_offset(pos[p, 0] - refx, boxsize) - cx
+            dy = _wrap_offset(pos[p, 1] - refy, boxsize) - cy
+            dz = _wrap_offset(pos[p, 2] - refz, boxsize) - cz
+            if dx * dx + dy * dy + dz * dz < velocity_radius * velocity_radius:
+                mi = mass[p]
+                vx = vx + vel[p, 0] * mi
+                vy = vy + vel[p, 1] * mi
+                vz = vz + vel[p, 2] * mi
+                tot_mass = tot_mass + mi
+    if tot_mass > 0:
+        velocities[s, 0] = vx / tot_mass; velocities[s, 1] = vy / tot_mass; velocities[s, 2] = vz / tot_mass
+    else:
+        velocities[s, 0] = NAN; velocities[s, 1] = NAN; velocities[s, 2] = NAN
+
+    cx = cx + refx; cy = cy + refy; cz = cz + refz
+    if boxsize > 0:
+        cx = cx - boxsize * floor(cx / boxsize)
+        cy = cy - boxsize * floor(cy / boxsize)
+        cz = cz - boxsize * floor(cz / boxsize)
+    centers[s, 0] = cx; centers[s, 1] = cy; centers[s, 2] = cz
+    return 0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def shrink_sphere_centers(double[:, :] pos, double[:] mass, double[:, :] vel, np.uint8_t[:] use_for_velocity,
+                          np.int64_t[:] indices, np.int64_t[:, :] boundaries,
+                          int min_particles, int particles_for_velocity, double shrink_factor,
+                          double boxsize, int num_threads, int itermax=1000):
+    """Find the shrinking-sphere centre of many halos in parallel, one halo per thread.
+
+    Halo s consists of particles indices[boundaries[s,0]:boundaries[s,1]]. If boxsize>0, periodic wrapping is applied.
+
+    Returns the centres, the mass-weighted mean velocity of particles flagged in use_for_velocity within the velocity
+    radius, the final radius of the shrinking sphere, and the velocity radius (i.e. the radius at which fewer than
+    particles_for_velocity particles remained). Empty halos give NaN."""
+    cdef Py_ssize_t nhalo = boundaries.shape[0]
+    cdef Py_ssize_t s
+    cdef int failures = 0
+
+    cdef double[:, :] centers = np.empty((nhalo, 3))
+    cdef double[:, :] velocities = np.empty((nhalo, 3))
+    cdef double[:] radii = np.empty(nhalo)
+    cdef double[:] velocity_radii = np.empty(nhalo)
+
+    for s in prange(nhalo, nogil=True, schedule='dynamic', chunksize=1, num_threads=num_threads):
+        if _shrink_sphere_one_halo(pos, mass, vel, use_for_velocity, indices, boundaries[s, 0], boundaries[s, 1],
+                                   min_particles, particles_for_velocity, shrink_factor, boxsize, itermax,
+                                   centers, velocities, radii, velocity_radii, s) != 0:
+            failures += 1
+
+    if failures > 0:
+        raise RuntimeError("shrink_sphere_centers failed to converge after %d iterations for %d halos"
+                           % (itermax, failures))
+
+    return np.asarray(centers), np.asarray(velocities), np.asarray(radii), np.asarray(velocity_radii)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _symmetric_eigen_3x3(double *A, double *values, double *vectors) noexcept nogil:
+    """Diagonalise the symmetric 3x3 matrix A (row-major, destroyed) by cyclic Jacobi rotations.
+
+    On exit, values holds the eigenvalues and the columns of vectors (row-major) the corresponding eigenvectors."""
+    cdef int sweep, p, q, k
+    cdef double theta, t, cs, sn, akp, akq, vkp, vkq, apq, app, aqq
+
+    for k in range(9):
+        vectors[k] = 0.0
+    vectors[0] = vectors[4] = vectors[8] = 1.0
+
+    for sweep in range(50):
+        if fabs(A[1]) + fabs(A[2]) + fabs(A[5]) < 1e-15 * (fabs(A[0]) + fabs(A[4]) + fabs(A[8])):
+            break
+        for p in range(2):
+            for q in range(p + 1, 3):
+                apq = A[3 * p + q]
+                if apq == 0.0:
+                    continue
+                app = A[3 * p + p]
+                aqq = A[3 * q + q]
+                theta = (aqq - app) / (2.0 * apq)
+                t = 1.0 / (fabs(theta) + sqrt(theta * theta + 1.0))
+                if theta < 0:
+                    t = -t
+                cs = 1.0 / sqrt(t * t + 1.0)
+                sn = t * cs
+                for k in range(3):
+                    akp = A[3 * k + p]
+                    akq = A[3 * k + q]
+                    A[3 * k + p] = cs * akp - sn * akq
+                    A[3 * k + q] = sn * akp + cs * akq
+                for k in range(3):
+                    akp = A[3 * p + k]
+                    akq = A[3 * q + k]
+                    A[3 * p + k] = cs * akp - sn * akq
+                    A[3 * q + k] = sn * akp + cs * akq
+                for k in range(3):
+                    vkp = vectors[3 * k + p]
+                    vkq = vectors[3 * k + q]
+                    vectors[3 * k + p] = cs * vkp - sn * vkq
+                    vectors[3 * k + q] = sn * vkp + cs * vkq
+
+    for k in range(3):
+        values[k] = A[4 * k]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int _fit_one_shell(double[:, :] pos, double[:] mass, double[:] r, Py_ssize_t start, Py_ssize_t end,
+                        double inner, double rbin, double outer, double tol, int itermax,
+                        double *axes, double *E) noexcept nogil:
+    """Iteratively fit a homeoidal shell to the particles pos[start:end], which must be sorted by radius r.
+
+    The shell initially spans inner < r < outer, with its semi-major axis a fixed at rbin. On exit, axes holds
+    (a, b, c) and E (row-major) the rotation matrix whose columns are the principal directions. Returns the number of
+    particles in the final shell."""
+    cdef double L1 = rbin - inner, L2 = outer - rbin
+    cdef double a = rbin, b = rbin, c = rbin
+    cdef double anew, bnew, cnew, div, rlo, rhi, ai, bi, ci, ao, bo, co
+    cdef double x0, x1, x2, p0, p1, p2, m, msum, ein, eout, tmp
+    cdef double M[9]
+    cdef double values[3]
+    cdef double vectors[9]
+    cdef double Enew[9]
+    cdef int order[3]
+    cdef int count = 0, i, j, k, n
+    cdef Py_ssize_t lo, hi, mid_, pidx
+
+    for k in range(9):
+        E[k] = 0.0
+    E[0] = E[4] = E[8] = 1.0
+
+    while True:
+        count += 1
+        rlo = c - L1 * c / a
+        rhi = a + L2
+        ai = a - L1
+        bi = b - L1 * b / a
+        ci = c - L1 * c / a
+        ao = a + L2
+        bo = b + L2 * b / a
+        co = c + L2 * c / a
+
+        # binary search for the first particle with r > rlo
+        lo = start
+        hi = end
+        while lo < hi:
+            mid_ = (lo + hi) // 2
+            if r[mid_] > rlo:
+                hi = mid_
+            else:
+                lo = mid_ + 1
+
+        for k in range(9):
+            M[k] = 0.0
+        msum = 0.0
+        n = 0
+        pidx = lo
+        while pidx < end and r[pidx] < rhi:
+            x0 = pos[pidx, 0]
+            x1 = pos[pidx, 1]
+            x2 = pos[pidx, 2]
+            # coordinates along the current principal axes
+            p0 = E[0] * x0 + E[3] * x1 + E[6] * x2
+            p1 = E[1] * x0 + E[4] * x1 + E[7] * x2
+            p2 = E[2] * x0 + E[5] * x1 + E[8] * x2
+            ein = (p0 / ai) * (p0 / ai) + (p1 / bi) * (p1 / bi) + (p2 / ci) * (p2 / ci)
+            eout = (p0 / ao) * (p0 / ao) + (p1 / bo) * (p1 / bo) + (p2 / co) * (p2 / co)
+            if ein > 1.0 and eout < 1.0:
+                m = mass[pidx]
+                M[0] += m * x0 * x0
+                M[1] += m * x0 * x1
+                M[2] += m * x0 * x2
+                M[4] += m * x1 * x1
+                M[5] += m * x1 * x2
+                M[8] += m * x2 * x2
+                msum += m
+                n += 1
+            pidx += 1
+
+        if n == 0:
+            break
+
+        M[3] = M[1]
+        M[6] = M[2]
+        M[7] = M[5]
+        for k in range(9):
+            M[k] /= msum
+
+        _symmetric_eigen_3x3(M, values, vectors)
+
+        # order the principal axes by decreasing length
+        order[0] = 0
+        order[1] = 1
+        order[2] = 2
+        for i in range(3):
+            for j in range(2 - i):
+                if fabs(values[order[j]]) < fabs(values[order[j + 1]]):
+                    k = order[j]
+                    order[j] = order[j + 1]
+                    order[j + 1] = k
+        for i in range(3):
+            for j in range(3):
+                Enew[3 * i + j] = vectors[3 * i + order[j]]
+
+        anew = sqrt(fabs(values[order[0]]) * 3.0)
+        bnew = sqrt(fabs(values[order[1]]) * 3.0)
+        cnew = sqrt(fabs(values[order[2]]) * 3.0)
+
+        # keep a as the semi-major axis, and distort b and c by b/a and c/a
+        div = rbin / anew
+        anew *= div
+        bnew *= div
+        cnew *= div
+
+        for k in range(9):
+            E[k] = Enew[k]
+
+        if (fabs(b / a - bnew / anew) < tol and fabs(c / a - cnew / anew) < tol) or count >= itermax:
+            a = anew
+            b = bnew
+            c = cnew
+            if E[0] < 0:
+                for k in range(9):
+                    E[k] = -E[k]
+            break
+        elif count % 10 == 0:
+            # relax the tolerance if convergence has stagnated
+            tol *= 5.0
+
+        a = anew
+        b = bnew
+        c = cnew
+
+    axes[0] = a
+    axes[1] = b
+    axes[2] = c
+    return n
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def fit_shell_shapes(double[:, :] pos, double[:] mass, double[:] r, np.int64_t[:] boundaries,
+                     double[:, :] shell_inner, double[:, :] shell_mid, double[:, :] shell_outer,
+                     double tol=1e-3, int itermax=1000, int num_threads=1):
+    """Fit homeoidal shells to many halos at once, as in :func:`pynbody.analysis.halo.halo_shape`.
+
+    The particles of halo h are pos[boundaries[h]:boundaries[h+1]], with positions relative to the halo centre and
+    sorted by radius r. Shell s of halo h initially spans shell_inner[h,s] < r < shell_outer[h,s], and its semi-major
+    axis is fixed at shell_mid[h,s]. All shells of all halos are fitted in parallel.
+
+    Returns (axes, rotations, num_particles), where axes has shape (nhalo, nshell, 3) and gives (a, b, c);
+    rotations has shape (nhalo, nshell, 3, 3) and its columns are the principal directions; and num_particles gives
+    the number of particles in each fitted shell."""
+    cdef Py_ssize_t nhalo = shell_mid.shape[0], nshell = shell_mid.shape[1]
+    cdef Py_ssize_t task, h, s, k
+
+    axes_np = np.zeros((nhalo, nshell, 3), dtype=np.float64)
+    rotations_np = np.zeros((nhalo, nshell, 3, 3), dtype=np.float64)
+    num_particles_np = np.zeros((nhalo, nshell), dtype=np.int64)
+
+    cdef double[:, :, ::1] axes = axes_np
+    cdef double[:, :, :, ::1] rotations = rotations_np
+    cdef np.int64_t[:, ::1] num_particles = num_particles_np
+
+    for task in prange(nhalo * nshell, nogil=True, schedule='dynamic', num_threads=num_threads):
+        h = task // nshell
+        s = task % nshell
+        if not (shell_mid[h, s] > 0):
+            axes[h, s, 0] = NAN
+            axes[h, s, 1] = NAN
+            axes[h, s, 2] = NAN
+            continue
+        num_particles[h, s] = _fit_one_shell(pos, mass, r, boundaries[h], boundaries[h + 1],
+                                             shell_inner[h, s], shell_mid[h, s], shell_outer[h, s], tol, itermax,
+                                             &axes[h, s, 0], &rotations[h, s, 0, 0])
+
+    return axes_np, rotations_np, num_particles_np
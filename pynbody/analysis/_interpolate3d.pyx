@@ -139,3 +139,55 @@ cdef int bisect(np.float64_t x, int nval, np.float64_t [:] arr) nogil:
         else :
             top = mid
     return bot
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _interpolate_tables_one(np.int64_t[:, ::1] index, np.float64_t[:, ::1] frac,
+                                  np.float64_t[:, :, :, ::1] tables, np.float64_t[:, ::1] result,
+                                  Py_ssize_t i) noexcept nogil:
+    cdef Py_ssize_t x0 = index[0, i], y0 = index[1, i], z0 = index[2, i]
+    cdef Py_ssize_t x1 = x0 + 1, y1 = y0 + 1, z1 = z0 + 1
+    cdef double fx = frac[0, i], fy = frac[1, i], fz = frac[2, i]
+    cdef double w000, w001, w010, w011, w100, w101, w110, w111
+    cdef Py_ssize_t t
+
+    # axes with a single grid point have index 0 and fraction 0
+    if x1 >= tables.shape[1]:
+        x1 = x0
+    if y1 >= tables.shape[2]:
+        y1 = y0
+    if z1 >= tables.shape[3]:
+        z1 = z0
+
+    w000 = (1.0 - fx) * (1.0 - fy) * (1.0 - fz)
+    w001 = (1.0 - fx) * (1.0 - fy) * fz
+    w010 = (1.0 - fx) * fy * (1.0 - fz)
+    w011 = (1.0 - fx) * fy * fz
+    w100 = fx * (1.0 - fy) * (1.0 - fz)
+    w101 = fx * (1.0 - fy) * fz
+    w110 = fx * fy * (1.0 - fz)
+    w111 = fx * fy * fz
+
+    for t in range(tables.shape[0]):
+        result[t, i] = (w000 * tables[t, x0, y0, z0] + w001 * tables[t, x0, y0, z1] +
+                        w010 * tables[t, x0, y1, z0] + w011 * tables[t, x0, y1, z1] +
+                        w100 * tables[t, x1, y0, z0] + w101 * tables[t, x1, y0, z1] +
+                        w110 * tables[t, x1, y1, z0] + w111 * tables[t, x1, y1, z1])
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def interpolate_tables(np.int64_t[:, ::1] index, np.float64_t[:, ::1] frac,
+                       np.float64_t[:, :, :, ::1] tables, np.float64_t[:, ::1] result, int num_threads=1):
+    """Trilinearly interpolate several tables sharing the same grid, given precomputed cell indices and fractions.
+
+    *index* and *frac* have shape (3, N), giving for each point the lower corner of its cell along each axis and the
+    fractional position within that cell. *tables* has shape (ntables, nx, ny, nz) and the result is written into
+    *result*, which has shape (ntables, N)."""
+    cdef Py_ssize_t i, n = index.shape[1]
+
+    from cython.parallel cimport prange
+
+    for i in prange(n, nogil=True, schedule='static', num_threads=num_threads):
+        _interpolate_tables_one(index, frac, tables, result, i)
@@ -0,0 +1,151 @@
+cimport cython
+cimport numpy as np
+
+np.import_array()
+
+import numpy as np
+from cython.parallel import prange
+
+from libc.math cimport floor
+
+ctypedef fused fused_float:
+    np.float32_t
+    np.float64_t
+
+ctypedef fused fused_float_2:
+    np.float32_t
+    np.float64_t
+
+# Particles are deposited onto a grid with cell (i,j,k) covering [x0 + i*dx, x0 + (i+1)*dx) etc. Schemes are
+# identified by the number of cells they touch along each axis: 1 = nearest grid point, 2 = cloud in cell,
+# 3 = triangular shaped cloud.
+
+cdef inline Py_ssize_t _kernel(double u, int scheme, double *w) noexcept nogil:
+    """Fill w with the weights for a particle at position u (in cell units), and return the first cell touched"""
+    cdef Py_ssize_t i
+    cdef double d
+    if scheme == 1:
+        w[0] = 1.0
+        return <Py_ssize_t> floor(u)
+    elif scheme == 2:
+        i = <Py_ssize_t> floor(u - 0.5)
+        d = u - 0.5 - i
+        w[0] = 1.0 - d
+        w[1] = d
+        return i
+    else:
+        i = <Py_ssize_t> floor(u)
+        d = u - i - 0.5
+        w[0] = 0.5 * (0.5 - d) * (0.5 - d)
+        w[1] = 0.75 - d * d
+        w[2] = 0.5 * (0.5 + d) * (0.5 + d)
+        return i - 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _deposit_one(fused_float[:, :] pos, fused_float_2[:] mass, np.float64_t[:, :, ::1] grid, Py_ssize_t p,
+                       double x0, double dx, double shift, int scheme, bint periodic) noexcept nogil:
+    cdef double wx[3]
+    cdef double wy[3]
+    cdef double wz[3]
+    cdef Py_ssize_t nx = grid.shape[0], ny = grid.shape[1], nz = grid.shape[2]
+    cdef Py_ssize_t ix0, iy0, iz0, a, b, c, ix, iy, iz
+    cdef double m = mass[p], mx, mxy
+
+    ix0 = _kernel((pos[p, 0] - x0) / dx + shift, scheme, wx)
+    iy0 = _kernel((pos[p, 1] - x0) / dx + shift, scheme, wy)
+    iz0 = _kernel((pos[p, 2] - x0) / dx + shift, scheme, wz)
+
+    for a in range(scheme):
+        ix = ix0 + a
+        if periodic:
+            ix = ix % nx
+            if ix < 0:
+                ix = ix + nx
+        elif ix < 0 or ix >= nx:
+            continue
+        mx = m * wx[a]
+        for b in range(scheme):
+            iy = iy0 + b
+            if periodic:
+                iy = iy % ny
+                if iy < 0:
+                    iy = iy + ny
+            elif iy < 0 or iy >= ny:
+                continue
+            mxy = mx * wy[b]
+            for c in range(scheme):
+                iz = iz0 + c
+                if periodic:
+                    iz = iz % nz
+                    if iz < 0:
+                        iz = iz + nz
+                elif iz < 0 or iz >= nz:
+                    continue
+                grid[ix, iy, iz] += mxy * wz[c]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def deposit(fused_float[:, :] pos, fused_float_2[:] mass, np.float64_t[:, :, ::1] grid, double x0, double dx,
+            int scheme, double shift=0.0, bint periodic=True, int num_threads=1):
+    """Add the masses of the given particles onto the grid, using the given mass assignment scheme.
+
+    Cell (i,j,k) covers [x0 + i*dx, x0 + (i+1)*dx) along each axis. If *shift* is non-zero, the particles are
+    displaced by that fraction of a cell along each axis before deposition (for interlacing). If *periodic* is True,
+    the grid wraps around; otherwise contributions outside the grid are discarded.
+
+    To deposit in parallel without races, particles are sorted into slabs along the x axis at least three cells wide;
+    alternate slabs are then processed in two passes, so that no two threads ever write to the same cell."""
+    cdef Py_ssize_t N = pos.shape[0]
+    cdef Py_ssize_t nx = grid.shape[0]
+    cdef Py_ssize_t nblocks, width, p, ix, b, j
+    cdef int phase
+
+    if scheme not in (1, 2, 3):
+        raise ValueError("Unknown mass assignment scheme")
+
+    nblocks = 2 * min(num_threads, nx // 6)
+    if nblocks < 2:
+        for p in range(N):
+            _deposit_one(pos, mass, grid, p, x0, dx, shift, scheme, periodic)
+        return
+
+    width = nx // nblocks
+
+    # counting sort of particles into slabs
+    cdef np.int64_t[::1] block = np.empty(N, dtype=np.int64)
+    cdef np.int64_t[::1] block_start = np.zeros(nblocks + 1, dtype=np.int64)
+    cdef np.int64_t[::1] fill = np.zeros(nblocks, dtype=np.int64)
+    cdef np.int64_t[::1] order = np.empty(N, dtype=np.int64)
+
+    with nogil:
+        for p in range(N):
+            ix = <Py_ssize_t> floor((pos[p, 0] - x0) / dx + shift)
+            if periodic:
+                ix = ix % nx
+                if ix < 0:
+                    ix = ix + nx
+            elif ix < 0:
+                ix = 0
+            b = ix // width
+            if b >= nblocks:
+                b = nblocks - 1
+            block[p] = b
+            block_start[b + 1] += 1
+
+        for b in range(nblocks):
+            block_start[b + 1] += block_start[b]
+
+        for p in range(N):
+            b = block[p]
+            order[block_start[b] + fill[b]] = p
+            fill[b] += 1
+
+        for phase in range(2):
+            for b in prange(phase, nblocks, 2, schedule='dynamic', num_threads=num_threads):
+                for j in range(block_start[b], block_start[b + 1]):
+                    _deposit_one(pos, mass, grid, order[j], x0, dx, shift, scheme, periodic)
@@ -4,6 +4,7 @@ Galactic bulge/disk/halo decomposition
 """
 
 import logging
+import multiprocessing
 
 import numpy as np
 
@@ -12,9 +13,11 @@ from . import angmom, profile
 
 logger = logging.getLogger('pynbody.analysis.decomp')
 
+_batch_halos = None
+
 
 def decomp(h, aligned=False, j_disk_min=0.8, j_disk_max=1.1, E_cut=None, j_circ_from_r=False,
-           log_interp=False, angmom_size="3 kpc"):
+           log_interp=False, angmom_size="3 kpc", gravity_solver='direct'):
     """Creates an array 'decomp' for star particles in the simulation, with an integer specifying components.
 
     The possible values of the components are:
@@ -59,7 +62,21 @@ def decomp(h, aligned=False, j_disk_min=0.8, j_disk_max=1.1, E_cut=None, j_circ_
     angmom_size : str
         The size of the disk to use for calculating the angular momentum vector. Default is "3 kpc".
 
+    gravity_solver : str
+        The gravity solver used for the midplane rotation curve and potential, and for the particle potentials if
+        these are not available from the snapshot: 'direct' (default) or 'tree'. The tree solver is much faster
+        for large numbers of particles. See :mod:`pynbody.gravity.calc`.
+
+    The rotation curve is cached, so that repeated decompositions of the same halo (e.g. with different
+    thresholds) do not need to recalculate it. To decompose many halos at once, see :func:`decomp_halos`.
+
     """
+    return _decomp(h, aligned, j_disk_min, j_disk_max, E_cut, j_circ_from_r, log_interp, angmom_size,
+                   gravity_solver)[0]
+
+
+def _decomp(h, aligned, j_disk_min, j_disk_max, E_cut, j_circ_from_r, log_interp, angmom_size, gravity_solver):
+    """Perform the decomposition, returning the disk profile, the value of j_crit and the value of E_cut"""
 
     import scipy.interpolate as interp
     global config
@@ -75,6 +92,9 @@ def decomp(h, aligned=False, j_disk_min=0.8, j_disk_max=1.1, E_cut=None, j_circ_
 
         # Find KE, PE and TE
         ke = h['ke']
+        if 'phi' not in h.keys() and 'phi' not in h.loadable_keys():
+            logger.info("Calculating potential using %s gravity solver" % gravity_solver)
+            _potential(h, gravity_solver)
         pe = h['phi']
 
         h['phi'].convert_units(ke.units)  # put PE and TE into same unit system
@@ -121,12 +141,12 @@ def decomp(h, aligned=False, j_disk_min=0.8, j_disk_max=1.1, E_cut=None, j_circ_
 
             pro_d._profiles['v_circ'] = v_c
             pro_d.v_circ_loaded = True
+            _set_midplane_gravity(pro_d, h, gravity_solver, include_v_circ=False)
 
         except Exception:
             pro_d = profile.Profile(d, nbins=100, type='log')  # .D()
-            # Nasty hack follows to force the full halo to be used in calculating the
-            # gravity (otherwise get incorrect rotation curves)
-            pro_d._profiles['v_circ'] = profile.v_circ(pro_d, h)
+            # The full halo is used in calculating the gravity (otherwise get incorrect rotation curves)
+            _set_midplane_gravity(pro_d, h, gravity_solver)
 
         pro_phi = pro_d['phi']
         #import pdb; pdb.set_trace()
@@ -166,23 +186,16 @@ def decomp(h, aligned=False, j_disk_min=0.8, j_disk_max=1.1, E_cut=None, j_circ_
 
         if 'decomp' not in h_star:
             h_star._create_array('decomp', dtype=int)
-        disk = np.where(
-            (h_star['jz_by_jzcirc'] > j_disk_min) * (h_star['jz_by_jzcirc'] < j_disk_max))
 
-        h_star['decomp', disk[0]] = 1
-        # h_star = h_star[np.where(h_star['decomp']!=1)]
+        JzJcirc = h_star['jz_by_jzcirc'].view(np.ndarray)
+        te = h_star['te'].view(np.ndarray)
 
         # Find disk/spheroid angular momentum cut-off to make spheroid
         # rotational velocity exactly zero.
 
-        V = h_star['vcxy']
-        JzJcirc = h_star['jz_by_jzcirc']
-        te = h_star['te']
-
         logger.info("Finding spheroid/disk angular momentum boundary...")
 
-        j_crit = util.bisect(0., 5.0,
-                             lambda c: np.mean(V[np.where(JzJcirc < c)]))
+        j_crit = _find_j_crit(JzJcirc, h_star['vcxy'].view(np.ndarray))
 
         logger.info("j_crit = %.2e" % j_crit)
 
@@ -192,24 +205,173 @@ def decomp(h, aligned=False, j_disk_min=0.8, j_disk_max=1.1, E_cut=None, j_circ_
             logger.warning("!! j_crit will be reset to j_disk_min=%.2e" % j_disk_min)
             j_crit = j_disk_min
 
-        sphere = np.where(h_star['jz_by_jzcirc'] < j_crit)
-
         if E_cut is None:
-            E_cut = np.median(h_star['te'])
+            E_cut = np.median(te)
 
         logger.info("E_cut = %.2e" % E_cut)
 
-        halo = np.where((te > E_cut) * (JzJcirc < j_crit))
-        bulge = np.where((te <= E_cut) * (JzJcirc < j_crit))
-        pbulge = np.where((te <= E_cut) * (JzJcirc > j_crit)
-                          * ((JzJcirc < j_disk_min) + (JzJcirc > j_disk_max)))
-        thick = np.where((te > E_cut) * (JzJcirc > j_crit)
-                         * ((JzJcirc < j_disk_min) + (JzJcirc > j_disk_max)))
-
-        h_star['decomp', halo] = 2
-        h_star['decomp', bulge] = 3
-        h_star['decomp', thick] = 4
-        h_star['decomp', pbulge] = 5
+        h_star['decomp'] = _classify(JzJcirc, te, j_disk_min, j_disk_max, j_crit, E_cut,
+                                     h_star['decomp'].view(np.ndarray))
 
     # Return profile object for informational purposes
-    return pro_d
+    return pro_d, float(j_crit), float(E_cut)
+
+
+def _potential(h, gravity_solver):
+    """Calculate the potential of all particles in h, storing it in h['phi']"""
+    from ..gravity import calc
+    if gravity_solver == 'tree':
+        calc.all_tree(h)
+    elif gravity_solver == 'direct':
+        calc.all_direct(h)
+    else:
+        raise ValueError("Unknown gravity solver %r; must be 'direct' or 'tree'" % gravity_solver)
+
+
+def _set_midplane_gravity(pro_d, h, gravity_solver, include_v_circ=True):
+    """Store the midplane rotation curve and potential for the full halo h in the disk profile pro_d.
+
+    The results are cached alongside the halo, and reused while the halo's particles and their arrangement (as
+    characterised by the mass-weighted second moments of the positions) are unchanged."""
+    from ..gravity import calc
+
+    # The potential is calculated from the halo if the disk is part of one, as for the Profile 'pot' property
+    pot_sim = pro_d.sim
+    while hasattr(pot_sim, 'base') and "halo_number" in pot_sim.base.properties:
+        pot_sim = pot_sim.base
+
+    rbins = pro_d['rbins']
+    key = (gravity_solver, include_v_circ, pot_sim is h, len(h), rbins.view(np.ndarray).tobytes(),
+           tuple(np.einsum('i,ij->j', h['mass'].view(np.ndarray), h['pos'].view(np.ndarray) ** 2)))
+
+    cached = h.ancestor._get_persist(h._inclusion_hash, 'decomp_midplane_gravity')
+    if cached is not None and cached[0] == key:
+        logger.info(" - using cached rotation curve")
+        v_circ, pot = cached[1]
+    else:
+        v_circ = None
+        if include_v_circ:
+            v_circ = calc.midplane_rot_curve(h, rbins, solver=gravity_solver).in_units(pro_d.sim['vel'].units)
+        pot = calc.midplane_potential(pot_sim, rbins, solver=gravity_solver).in_units(pro_d.sim['vel'].units ** 2)
+        h.ancestor._set_persist(h._inclusion_hash, 'decomp_midplane_gravity', (key, (v_circ, pot)))
+
+    if include_v_circ:
+        pro_d._profiles['v_circ'] = v_circ.copy()
+    pro_d._profiles['pot'] = pot.copy()
+
+
+def _find_j_crit(JzJcirc, V):
+    """Find the value of jz/jz_circ below which the mean rotational velocity of stars is zero.
+
+    This performs the same bisection search as applying :func:`pynbody.util.bisect` to the mean of V over the
+    particles with JzJcirc below the trial value, but after a single sort each trial costs only O(log N)."""
+    order = np.argsort(JzJcirc, kind='stable')
+    J_sorted = JzJcirc[order]
+    cumulative_mean = np.cumsum(V[order], dtype=np.float64) / np.arange(1, len(V) + 1)
+
+    def mean_V_below(c):
+        count = np.searchsorted(J_sorted, c, side='left')
+        return cumulative_mean[count - 1] if count > 0 else np.nan
+
+    return util.bisect(0., 5.0, mean_V_below)
+
+
+def _classify(JzJcirc, te, j_disk_min, j_disk_max, j_crit, E_cut, previous):
+    """Return the component of each star, given its jz/jz_circ and binding energy. Stars falling in no component
+    (e.g. with undefined JzJcirc) retain their previous value."""
+    outside_disk_range = (JzJcirc < j_disk_min) | (JzJcirc > j_disk_max)
+    low_j = JzJcirc < j_crit
+    high_j = JzJcirc > j_crit
+    bound = te <= E_cut
+    loose = te > E_cut
+
+    return np.select([loose & low_j,
+                      bound & low_j,
+                      loose & high_j & outside_disk_range,
+                      bound & high_j & outside_disk_range,
+                      (JzJcirc > j_disk_min) & (JzJcirc < j_disk_max)],
+                     [2, 3, 4, 5, 1], default=previous)
+
+
+def _decomp_in_worker(args):
+    index, kwargs = args
+    h = _batch_halos[index]
+    _, j_crit, E_cut = _decomp(h, **kwargs)
+    return index, h.star['decomp'].view(np.ndarray), h.star['jz_by_jzcirc'].view(np.ndarray), j_crit, E_cut
+
+
+def decomp_halos(halos, processes=None, aligned=False, j_disk_min=0.8, j_disk_max=1.1, E_cut=None,
+                 j_circ_from_r=False, log_interp=False, angmom_size="3 kpc", gravity_solver='tree'):
+    """Perform a kinematic decomposition (see :func:`decomp`) of many halos, in parallel worker processes.
+
+    On return, each halo's stars have arrays 'decomp' and 'jz_by_jzcirc', as for :func:`decomp`. By default, the
+    tree gravity solver is used; see :mod:`pynbody.gravity.calc`.
+
+    Worker processes are forked from the current process, so that they share the loaded snapshot without
+    copying. Where forking is not available, or *processes* is 1, the halos are decomposed one after another.
+
+    Parameters
+    ----------
+
+    halos : iterable of SimSnap
+        The halos to decompose, e.g. a list of halos from a :class:`~pynbody.halo.HaloCatalogue`
+
+    processes : int, optional
+        The number of worker processes. Defaults to the ``number_of_threads`` configuration option. The remaining
+        threads (if any) are divided between the processes for the gravity calculations.
+
+    Other parameters are as for :func:`decomp`.
+
+    Returns
+    -------
+
+    list of dict
+        For each halo, a dictionary with entries 'j_crit' and 'E_cut', giving the values used for the
+        classification.
+    """
+    global _batch_halos
+
+    halos = list(halos)
+    kwargs = dict(aligned=aligned, j_disk_min=j_disk_min, j_disk_max=j_disk_max, E_cut=E_cut,
+                  j_circ_from_r=j_circ_from_r, log_interp=log_interp, angmom_size=angmom_size,
+                  gravity_solver=gravity_solver)
+
+    if processes is None:
+        processes = config['number_of_threads']
+    processes = max(1, min(processes, len(halos)))
+
+    results = [None] * len(halos)
+
+    if processes == 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        for i, h in enumerate(halos):
+            _, j_crit, E_cut = _decomp(h, **kwargs)
+            results[i] = {'j_crit': j_crit, 'E_cut': E_cut}
+        return results
+
+    # Make sure the arrays needed by every halo are loaded before forking, so that each is loaded only once
+    for h in halos:
+        for name in ('pos', 'vel', 'mass', 'eps'):
+            h[name]
+
+    threads_per_process = max(1, config['number_of_threads'] // processes)
+    old_threads = config['number_of_threads']
+    _batch_halos = halos
+    try:
+        config['number_of_threads'] = threads_per_process
+        with multiprocessing.get_context('fork').Pool(processes) as pool:
+            for i, decomp_values, jz_by_jzcirc, j_crit, E_cut in pool.imap_unordered(
+                    _decomp_in_worker, [(i, kwargs) for i in range(len(halos))]):
+                h_star = halos[i].star
+                if 'decomp' not in h_star:
+                    h_star._create_array('decomp', dtype=int)
+                h_star['decomp'] = decomp_values
+                h_star['jz_by_jzcirc'] = jz_by_jzcirc
+                results[i] = {'j_crit': j_crit, 'E_cut': E_cut}
+            # let the workers exit cleanly; terminating them relies on SIGTERM, which may be intercepted
+            pool.close()
+            pool.join()
+    finally:
+        config['number_of_threads'] = old_threads
+        _batch_halos = None
+
+    return results
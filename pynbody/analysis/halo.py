@@ -184,6 +184,129 @@ def virial_radius(sim, cen=None, overden=178, r_max=None, rho_def='matter'):
     return result
 
 
+def catalogue_centers_and_radii(halos, overdensities=(178,), rho_def='matter', shrink_factor=0.7,
+                                min_particles=100, particles_for_velocity=0, families_for_velocity=['dm', 'star'],
+                                num_threads=None):
+    """Find the shrinking-sphere centre and spherical-overdensity radii of every halo in a catalogue at once.
+
+    This is equivalent to calling :func:`shrink_sphere_center` and :func:`virial_radius` on each halo in turn, but
+    is much faster for large catalogues: the halos are centred in parallel, one thread per halo, and the radii are then
+    found for all halos by sorting particle radii once and cumulatively summing masses.
+
+    Unlike :func:`virial_radius`, only the particles belonging to each halo contribute to its enclosed mass. Periodic
+    boundaries are taken into account if the snapshot has a boxsize.
+
+    Parameters
+    ----------
+
+    halos : HaloCatalogue
+        The halo catalogue
+
+    overdensities : sequence of float, optional
+        The overdensities for which to calculate radii and masses. Default is (178,).
+
+    rho_def : str, optional
+        The reference density, 'matter' (default) or 'critical'; see :func:`virial_radius`.
+
+    shrink_factor, min_particles, particles_for_velocity, families_for_velocity, num_threads :
+        As for :func:`shrink_sphere_center`
+
+    Returns
+    -------
+
+    dict
+        A dictionary with entries 'center' (an Nhalo x 3 array), 'vel' (an Nhalo x 3 array, present only if
+        particles_for_velocity > min_particles), and 'r_<overdensity>' and 'm_<overdensity>' (e.g. 'r_200' and
+        'm_200') for each requested overdensity. Arrays are ordered by halo index, i.e. in the same order as
+        :meth:`~pynbody.halo.HaloCatalogue.get_properties_all_halos`. Empty halos, or halos that never reach the
+        required overdensity, give NaN.
+
+    """
+    if num_threads is None:
+        num_threads = config['number_of_threads']
+
+    sim = halos.base
+    index_lists = halos._get_all_particle_indices_cached()
+    indices = np.asarray(index_lists.particle_index_list, dtype=np.int64)
+    boundaries = np.ascontiguousarray(index_lists.particle_index_list_boundaries, dtype=np.int64)
+
+    pos_units = sim['pos'].units
+    pos = np.asarray(sim['pos'], dtype=np.float64)
+    mass = np.asarray(sim['mass'], dtype=np.float64)
+
+    boxsize = sim.properties.get('boxsize', None)
+    if boxsize is None:
+        boxsize = 0.0
+    elif units.is_unit_like(boxsize):
+        boxsize = float(boxsize.in_units(pos_units, **sim.conversion_context()))
+
+    want_velocity = particles_for_velocity > min_particles
+    if want_velocity:
+        vel = np.asarray(sim['vel'], dtype=np.float64)
+        use_for_velocity = np.zeros(len(sim), dtype=np.uint8)
+        for f in families_for_velocity:
+            use_for_velocity[sim._get_family_slice(f)] = 1
+    else:
+        vel = np.zeros((1, 3))
+        use_for_velocity = np.zeros(1, dtype=np.uint8)
+
+    centers, velocities, _, _ = _com.shrink_sphere_centers(pos, mass, vel, use_for_velocity, indices, boundaries,
+                                                           min_particles, particles_for_velocity, shrink_factor,
+                                                           boxsize, num_threads)
+
+    result = {'center': array.SimArray(centers, pos_units)}
+    if want_velocity:
+        result['vel'] = array.SimArray(velocities, sim['vel'].units)
+
+    # Gather every halo's particles into one contiguous list, with the radius from the halo centre
+    lengths = boundaries[:, 1] - boundaries[:, 0]
+    segment_starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    halo_of_member = np.repeat(np.arange(len(lengths)), lengths)
+    members = indices[np.repeat(boundaries[:, 0] - segment_starts, lengths) + np.arange(lengths.sum())]
+
+    offsets = pos[members] - centers[halo_of_member]
+    if boxsize > 0:
+        offsets -= boxsize * np.round(offsets / boxsize)
+    r = np.sqrt((offsets ** 2).sum(axis=1))
+    del offsets
+
+    ordering = np.lexsort((r, halo_of_member))
+    r = r[ordering]
+    cumulative_mass = np.cumsum(mass[members][ordering])
+    mass_before_segment = np.concatenate(([0.0], cumulative_mass))[segment_starts]
+    cumulative_mass -= np.repeat(mass_before_segment, lengths)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_density = cumulative_mass / (4. * math.pi * r ** 3 / 3)
+
+    if rho_def == 'matter':
+        ref_density = sim.properties["omegaM0"] * cosmology.rho_crit(sim, z=0) * (1.0 + sim.properties["z"]) ** 3
+    elif rho_def == 'critical':
+        ref_density = cosmology.rho_crit(sim, z=sim.properties["z"])
+    else:
+        raise ValueError(rho_def + "is not a valid definition for the reference density")
+
+    nonempty = lengths > 0
+    position = np.arange(len(r))
+    for overden in overdensities:
+        target_rho = overden * ref_density
+        # the outermost particle inside which the mean density still exceeds the target
+        outermost = np.maximum.reduceat(np.where(mean_density >= target_rho, position, -1),
+                                        segment_starts[nonempty]) if nonempty.any() else np.zeros(0, dtype=int)
+        m_delta = np.full(len(lengths), np.nan)
+        found = outermost >= segment_starts[nonempty]
+        m_delta[np.flatnonzero(nonempty)[found]] = cumulative_mass[outermost[found]]
+        # the enclosed mass is constant out to the next particle, so the radius follows exactly from the mass
+        r_delta = (3 * m_delta / (4. * math.pi * target_rho)) ** (1. / 3)
+        result['r_%g' % overden] = array.SimArray(r_delta, pos_units)
+        result['m_%g' % overden] = array.SimArray(m_delta, sim['mass'].units)
+
+    for v in result.values():
+        v.sim = sim
+
+    return result
+
+
 def _potential_minimum(sim):
     i = sim["phi"].argmin()
     return sim["pos"][i].copy()
@@ -540,11 +663,13 @@ def halo_shape(sim, N=100, rin=None, rout=None, bins='equal'):
             count += 1
 
             # Collect all particle positions and masses within shell:
-            r = pos[np.where((posr < a+L2) & (posr > c-L1*c/a))]
+            in_range = np.where((posr < a+L2) & (posr > c-L1*c/a))
+            r = pos[in_range]
+            m = mass[in_range]
             inner = Ellipsoid(r, a-L1,b-L1*b/a,c-L1*c/a, E)
             outer = Ellipsoid(r, a+L2,b+L2*b/a,c+L2*c/a, E)
             r = r[np.where((inner > 1.) & (outer < 1.))]
-            m = mass[np.where((inner > 1.) & (outer < 1.))]
+            m = m[np.where((inner > 1.) & (outer < 1.))]
 
             # End iterations if there is no data in range:
             if (len(r) == 0):
@@ -591,3 +716,163 @@ def halo_shape(sim, N=100, rin=None, rout=None, bins='equal'):
             a,b,c = anew,bnew,cnew
 
     return [array.SimArray(rbin, sim.d['pos'].units), ba, ca, angle, Es]
+
+
+def _shape_shell_edges(r_sorted, N, rin, rout, bins):
+    """Return the initial (inner, mid, outer) radii of N shells, following the conventions of :func:`halo_shape`"""
+    if bins == 'equal':
+        r_sorted = r_sorted[(r_sorted >= rin) & (r_sorted <= rout)]
+        per_group = len(r_sorted) // (2 * N)
+        if per_group == 0:
+            return np.full(N, np.nan), np.full(N, np.nan), np.full(N, np.nan)
+        mid = np.append(r_sorted[np.arange(2 * N) * per_group], r_sorted[-1])
+        rbin = mid[1:N * 2 + 1:2]
+        mid = mid[0:N * 2 + 1:2]
+    elif bins == 'log':
+        edges = np.logspace(np.log10(rin), np.log10(rout), N + 2)
+        mid = 0.5 * (edges[:-1] + edges[1:])
+        rbin = np.sqrt(mid[0:N] * mid[1:N + 1])
+    elif bins == 'lin':
+        edges = np.linspace(rin, rout, N + 2)
+        mid = 0.5 * (edges[:-1] + edges[1:])
+        rbin = 0.5 * (mid[0:N] + mid[1:N + 1])
+    else:
+        raise ValueError("Unknown binning scheme %r" % bins)
+    return mid[0:N], rbin, mid[1:N + 1]
+
+
+def halo_shapes(halos, N=100, rin=None, rout=None, bins='equal', centers=None, family='dm', num_threads=None):
+    """Compute the shapes of many halos as a function of radius by fitting homeoidal shells.
+
+    This performs the same iterative fit as :func:`halo_shape`, but all shells of all halos are fitted in parallel
+    in compiled code, which is much faster for large samples of halos or large numbers of shells.
+
+    Parameters
+    ----------
+
+    halos : HaloCatalogue or sequence of SimSnap
+        The halos to fit. If a catalogue is given, all halos in it are fitted.
+
+    N : int
+        The number of homeoidal shells per halo
+
+    rin, rout : float or array-like, optional
+        The minimum and maximum radial bins in units of ``pos``, either for all halos or one value per halo.
+        By default, rout is the radius of the outermost particle in each halo and rin is rout/1000.
+
+    bins : str
+        The spacing scheme for the shells: 'equal', 'log' or 'lin'. See :func:`halo_shape`.
+
+    centers : array-like, optional
+        The centre of each halo. If not specified, the centres of a halo catalogue are found using
+        :func:`catalogue_centers_and_radii`, while a sequence of snapshots is assumed to be pre-centred (as for
+        :func:`halo_shape`). Periodic boundaries are taken into account if the snapshot has a boxsize.
+
+    family : str, optional
+        The family of particles to use. Default is 'dm'; if None, all particles are used.
+
+    num_threads : int, optional
+        The number of threads to use. Default is the ``number_of_threads`` configuration option.
+
+    Returns
+    -------
+
+    numpy.ndarray
+        A structured array of shape (number of halos, N), with fields 'r' (the radius of the shell, equal to its
+        semi-major axis), 'a', 'b' and 'c' (the axis lengths), 'angle' (the angle of the a-direction with respect to
+        the x-axis), 'rotation' (the 3x3 rotation matrix whose columns are the principal directions) and
+        'n_particles' (the number of particles in the fitted shell). Shells that cannot be defined, e.g. because a
+        halo has too few particles, are NaN.
+
+    """
+    from .. import family as family_module
+    from ..halo import HaloCatalogue
+
+    if num_threads is None:
+        num_threads = config['number_of_threads']
+    if family is not None:
+        family = family_module.get_family(family)
+
+    if isinstance(halos, HaloCatalogue):
+        sim = halos.base
+        index_lists = halos._get_all_particle_indices_cached()
+        indices = np.asarray(index_lists.particle_index_list, dtype=np.int64)
+        boundaries = np.asarray(index_lists.particle_index_list_boundaries, dtype=np.int64)
+        if family is not None:
+            family_slice = sim._get_family_slice(family)
+            in_family = (indices >= family_slice.start) & (indices < family_slice.stop)
+            cumulative = np.concatenate(([0], np.cumsum(in_family)))
+            boundaries = cumulative[boundaries]
+            indices = indices[in_family]
+        lengths = boundaries[:, 1] - boundaries[:, 0]
+        segment_starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        members = indices[np.repeat(boundaries[:, 0] - segment_starts, lengths) + np.arange(lengths.sum())]
+        pos_units = sim['pos'].units
+        pos = np.asarray(sim['pos'], dtype=np.float64)[members]
+        mass = np.asarray(sim['mass'], dtype=np.float64)[members]
+        if centers is None:
+            centers = catalogue_centers_and_radii(halos, num_threads=num_threads)['center']
+    else:
+        halos = [h if family is None else h[family] for h in halos]
+        if len(halos) == 0:
+            raise ValueError("No halos were provided")
+        sim = halos[0].ancestor
+        pos_units = halos[0]['pos'].units
+        lengths = np.array([len(h) for h in halos], dtype=np.int64)
+        pos = np.concatenate([np.asarray(h['pos'].in_units(pos_units), dtype=np.float64) for h in halos])
+        mass = np.concatenate([np.asarray(h['mass'], dtype=np.float64) for h in halos])
+        if centers is None:
+            centers = np.zeros((len(halos), 3))
+
+    nhalo = len(lengths)
+    halo_of_member = np.repeat(np.arange(nhalo), lengths)
+    pos -= np.asarray(centers, dtype=np.float64).reshape((nhalo, 3))[halo_of_member]
+
+    boxsize = sim.properties.get('boxsize', None)
+    if units.is_unit_like(boxsize):
+        boxsize = float(boxsize.in_units(pos_units, **sim.conversion_context()))
+    if boxsize:
+        pos -= boxsize * np.round(pos / boxsize)
+
+    r = np.sqrt((pos ** 2).sum(axis=1))
+    ordering = np.lexsort((r, halo_of_member))
+    r = r[ordering]
+    pos = pos[ordering]
+    mass = mass[ordering]
+    boundaries = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+
+    if rout is None:
+        rout = np.array([r[boundaries[h + 1] - 1] if lengths[h] > 0 else np.nan for h in range(nhalo)])
+    rout = np.broadcast_to(np.asarray(rout, dtype=np.float64), (nhalo,))
+    if rin is None:
+        rin = rout / 1e3
+    rin = np.broadcast_to(np.asarray(rin, dtype=np.float64), (nhalo,))
+
+    # as for halo_shape, only particles strictly inside rout are used
+    keep = r < np.repeat(rout, lengths)
+    r, pos, mass = r[keep], pos[keep], mass[keep]
+    boundaries = np.concatenate(([0], np.cumsum(keep))).astype(np.int64)[boundaries]
+
+    shell_inner = np.full((nhalo, N), np.nan)
+    shell_mid = np.full((nhalo, N), np.nan)
+    shell_outer = np.full((nhalo, N), np.nan)
+    for h in range(nhalo):
+        if boundaries[h + 1] > boundaries[h]:
+            shell_inner[h], shell_mid[h], shell_outer[h] = _shape_shell_edges(r[boundaries[h]:boundaries[h + 1]],
+                                                                              N, rin[h], rout[h], bins)
+
+    axes, rotations, num_particles = _com.fit_shell_shapes(pos, mass, r, boundaries, shell_inner, shell_mid,
+                                                           shell_outer, num_threads=num_threads)
+
+    result = np.zeros((nhalo, N), dtype=[('r', np.float64), ('a', np.float64), ('b', np.float64),
+                                         ('c', np.float64), ('angle', np.float64), ('rotation', np.float64, (3, 3)),
+                                         ('n_particles', np.int64)])
+    result['r'] = shell_mid
+    result['a'] = axes[..., 0]
+    result['b'] = axes[..., 1]
+    result['c'] = axes[..., 2]
+    result['rotation'] = rotations
+    result['angle'] = np.arccos(np.clip(rotations[..., 0, 0], -1.0, 1.0))
+    result['angle'][np.isnan(shell_mid)] = np.nan
+    result['n_particles'] = num_particles
+    return result
@@ -19,7 +19,9 @@ import warnings
 
 import numpy as np
 import scipy
+import scipy.integrate
 import scipy.interpolate
+import scipy.special
 
 import pynbody
 
@@ -36,6 +38,9 @@ logger = logging.getLogger('pynbody.analysis.hmf')
 class FieldFilter:
     """Represents a filter acting on a field"""
 
+    #: ln(kR) beyond which the filter is negligible, and variance integrals are truncated
+    ln_kR_max = 3.0
+
     def M_to_R(self, M):
         """Return the mass scale (Msol h^-1) for a given length (Mpc h^-1 comoving)"""
         return (M / (self.gammaF * self.rho_bar)) ** 0.3333
@@ -76,6 +81,8 @@ class GaussianFilter(FieldFilter):
 class HarmonicStepFilter(FieldFilter):
     """A step filter in harmonic space"""
 
+    ln_kR_max = 0.0
+
     def __init__(self, context):
         self.gammaF = 6 * math.pi ** 2
         self.rho_bar = cosmology.rho_M(context, unit="Msol Mpc^-3 h^2 a^-3")
@@ -323,6 +330,25 @@ class BiasedPowerSpectrum(PowerSpectrum):
 # Variance calculation
 #######################################################################
 
+def _log_power_table(powspec):
+    """Return ln k and ln P(k) at the tabulated wavenumbers of a power spectrum, cached on the instance.
+
+    Since power spectra are (by default) interpolated linearly in log space between these points, linear interpolation
+    in this table reproduces the power spectrum exactly. The cache is invalidated if the normalisation changes."""
+    key = (powspec._norm, getattr(powspec, '_lingrowth', 1))
+    cache = getattr(powspec, '_log_power_table_cache', None)
+    if cache is None or cache[0] != key:
+        k = np.asarray(powspec.k)
+        k = k[(k >= powspec.min_k) & (k <= powspec.max_k)]
+        k = np.concatenate(([powspec.min_k], k, [powspec.max_k]))
+        cache = (key, np.log(k), np.log(np.asarray(powspec(k))))
+        powspec._log_power_table_cache = cache
+    return cache[1], cache[2]
+
+
+_variance_ln_kR_step = 1. / 512
+
+
 def variance(M_or_R, f_filter=TophatFilter, powspec=PowerSpectrum, arg_is_R=False):
     """Calculate the variance of the density field smoothed on a mass scale M, or optionally a length scale R.
 
@@ -347,24 +373,39 @@ def variance(M_or_R, f_filter=TophatFilter, powspec=PowerSpectrum, arg_is_R=Fals
         The variance of the density field smoothed on the given scale(s).
 
     """
-    if hasattr(M_or_R, '__len__'):
-        ax = pynbody.array.SimArray(
-            [variance(Mi, f_filter, powspec, arg_is_R) for Mi in M_or_R])
+    is_array = hasattr(M_or_R, '__len__')
+
+    if arg_is_R:
+        R = np.atleast_1d(np.asarray(M_or_R, dtype=np.float64))
+    else:
+        R = np.atleast_1d(f_filter.M_to_R(np.asarray(M_or_R, dtype=np.float64)))
+
+    # Integrate over u = ln(kR), on a grid which is the same for all R, so that the filter need be evaluated only once.
+    # The grid ends exactly on the upper limit; the filter is evaluated just inside it so that a sharp cut-off there
+    # (as in the harmonic step filter) is handled correctly.
+    ln_k_table, ln_Pk_table = _log_power_table(powspec)
+    ln_min_k = math.log(powspec.min_k)
+    u_max = f_filter.ln_kR_max
+    num_steps = int(math.ceil((u_max - ln_min_k - np.log(R).min()) / _variance_ln_kR_step))
+    u = u_max - _variance_ln_kR_step * np.arange(num_steps, -1, -1)
+    filter_weight = np.exp(3 * u) * f_filter.Wk(np.exp(u) * (1 - 1e-10)) ** 2
+
+    v = np.empty(len(R))
+    for start in range(0, len(R), 256):
+        ln_R = np.log(R[start:start + 256, np.newaxis])
+        ln_k = u[np.newaxis, :] - ln_R
+        integrand = filter_weight * np.exp(np.interp(ln_k, ln_k_table, ln_Pk_table))
+        integrand[ln_k < ln_min_k] = 0
+        v[start:start + 256] = scipy.integrate.simpson(integrand, dx=_variance_ln_kR_step, axis=1)
+    v /= 2 * math.pi ** 2 * R ** 3
+
+    if is_array:
+        ax = v.view(pynbody.array.SimArray)
         # hopefully dimensionless
         ax.units = powspec.Pk_z0_unnormalised.units * powspec.k.units ** 3
         return ax
-
-    if arg_is_R:
-        R = M_or_R
     else:
-        R = f_filter.M_to_R(M_or_R)
-
-    integrand = lambda k: k ** 2 * powspec(k) * f_filter.Wk(k * R) ** 2
-    integrand_ln_k = lambda k: np.exp(k) * integrand(np.exp(k))
-    v =  scipy.integrate.quad(integrand_ln_k, math.log(powspec.min_k), math.log(
-        1. / R) + 3, epsrel=1.e-6)[0] / (2 * math.pi ** 2)
-
-    return v
+        return v[0]
 
 
 def get_neffm(mass, sigma):
@@ -375,107 +416,69 @@ def get_neffm(mass, sigma):
     return neff
 
 
-@units.takes_arg_in_units((0, "Mpc h^-1"))
-def correlation(r, powspec=PowerSpectrum):
-    """Calculate the correlation function of the density field at a specified radius."""
+def _fftlog(ln_x, f, kernel_mellin, q):
+    """Evaluate g(y) = int f(x) K(xy) dx/x for all y = 1/x on a logarithmic grid, using the FFTLog algorithm.
 
-    if hasattr(r, '__len__'):
-        ax = pynbody.array.SimArray([correlation(ri,  powspec) for ri in r])
-        ax.units = powspec.Pk_z0_unnormalised.units * powspec.k.units ** 3
-        return ax
+    *kernel_mellin* must return the Mellin transform int_0^infinity t^(z-1) K(t) dt for complex z, and *q* is a
+    bias exponent for which both the Mellin transform and int f(x) x^(-q) dx/x converge. Returns ln y and g(y),
+    with y in ascending order."""
+    num = len(ln_x)
+    delta = (ln_x[-1] - ln_x[0]) / (num - 1)
+    ln_y = -ln_x[::-1]
 
-    # Because sin kr becomes so highly oscilliatory, normal
-    # quadrature is slow/inaccurate for this problem. The following
-    # is the best way I could come up with to overcome that.
-    #
-    # For small kr, sin kr/kr is represented as a Taylor expansion and
-    # each segment of the power spectrum is integrated over, summing
-    # over the Taylor series to convergence.
-    #
-    # When the convergence of this starts to fail, each segment of the
-    # power spectrum is still represented by a power law, but the
-    # exact integral boils down to a normal incomplete gamma function
-    # extended into the complex plane.
-    #
-    # Originally, we had:
-    #
-    # integrand = lambda k: k**2 * powspec(k) * (np.sin(k*r)/(k*r))
-    # integrand_ln_k = lambda k: np.exp(k)*integrand(np.exp(k))
-    #
-
-    tot = 0
-    defer = False
-
-    k = powspec.k
-
-    gamma_method = False
-
-    for k_bot, k_top in zip(k[:-1], k[1:]):
-
-        if k_bot >= k_top:
-            continue
-
-        # express segment as P(k) = P0*k^n
-        Pk_top = powspec(k_top)
-        Pk_bot = powspec(k_bot)
-
-        n = np.log(Pk_top / Pk_bot) / np.log(k_top / k_bot)
-        P0 = Pk_top / k_top ** n
-
-        if n != n or abs(n) > 2:
-            # looks nasty in log space, so interpolate linearly instead
-            grad = (Pk_top - Pk_bot) / (k_top - k_bot)
-            segment = ((-2 * grad + k_bot * Pk_bot * r ** 2) * np.cos(k_bot * r) +
-                       (2 * grad - k_top * (-(grad * k_bot) + grad * k_top + Pk_bot) * r ** 2) * np.cos(k_top * r) -
-                       (grad * k_bot + Pk_bot) * r * np.sin(k_bot * r) +
-                       (-(grad * k_bot) + 2 * grad * k_top + Pk_bot) * r * np.sin(k_top * r)) / r ** 4
-
-        elif k_top * r < 6.0 and not gamma_method:
-            # approximate sin y/y as polynomial = \sum_m coeff_m y^m
-
-            segment = 0
-            term = 0
-
-            m = 0
-            coeff = 1
-            while m == 0 or (abs(term / segment) > 1.e-7 and m < 50):
-                if m > 0:
-                    coeff *= (-1.0) / (m * (m + 1))
-
-                # integral is P0 * r^m * int_(k_bot)^(k_top) k^(2+n+m) dk = P0
-                # r^m [k^(3+n+m)/(3+n+m)]
-                top_val = k_top ** (3 + n + m) / (3 + n + m)
-                bot_val = k_bot ** (3 + n + m) / (3 + n + m)
-                term = P0 * (r ** m) * (top_val - bot_val) * coeff
-                segment += term
-                m += 2
-
-            if m >= 50:
-                raise RuntimeError("Convergence failure in sin y/y series integral")
-
-            if m > 18:
-                gamma_method = True
-                # experience suggests when you have to sum beyond m=18, it's faster
-                # to switch to the method below
+    # Fourier coefficients of f(x) x^-q as a function of ln x, then convolution with the kernel in log space
+    coefficients = np.fft.fft(f * np.exp(-q * ln_x)) / num
+    omega = 2 * math.pi * np.fft.fftfreq(num, d=delta)
+    coefficients *= kernel_mellin(q + 1j * omega) * np.exp(-1j * omega * (ln_x[0] + ln_y[0]))
+    g = np.fft.fft(coefficients).real
+    return ln_y, g * np.exp(-q * ln_y)
 
-        else:
 
-            # now integral of this segment is exactly
-            # P0 * int_(k_bot)^(k_top) k^(2+n) sin(kr)/(kr) = (P0/r^(n+3)) Im[ (i)^(-n-2) Gamma(n+2,i k_bot r, i k_top r)]
-            # First we need to evaluate the Gamma integral sufficiently
-            # accurately
+def _j0_mellin(z):
+    """The Mellin transform of x^3 j_0(x) / (2 pi^2), for use with _fftlog"""
+    s = z + 3
+    return 2 ** (s - 2) * math.sqrt(math.pi) * np.exp(scipy.special.loggamma(s / 2)
+                                                     - scipy.special.loggamma((3 - s) / 2)) / (2 * math.pi ** 2)
 
-            top_val = util.gamma_inc(n + 2, (1.0j) * r * k_top)
-            bot_val = util.gamma_inc(n + 2, (1.0j) * r * k_bot)
-            segment = - \
-                ((1.0j) ** (-n - 2) * P0 *
-                 (top_val - bot_val) / r ** (n + 3)).imag
 
-        tot += segment
+_correlation_num_points = 4096
 
-    tot /= (2 * math.pi ** 2)
 
-    return tot
+def _correlation_table(powspec):
+    """Return ln r and xi(r) on a logarithmic grid, calculated using FFTLog and cached on the power spectrum"""
+    key = (powspec._norm, getattr(powspec, '_lingrowth', 1))
+    cache = getattr(powspec, '_correlation_table_cache', None)
+    if cache is None or cache[0] != key:
+        ln_k_table, ln_Pk_table = _log_power_table(powspec)
+        ln_k = np.linspace(ln_k_table[0], ln_k_table[-1], _correlation_num_points)
+        Pk = np.exp(np.interp(ln_k, ln_k_table, ln_Pk_table))
+        ln_r, r3_xi = _fftlog(ln_k, Pk, _j0_mellin, -1.5)
+        cache = (key, ln_r, r3_xi * np.exp(-3 * ln_r))
+        powspec._correlation_table_cache = cache
+    return cache[1], cache[2]
+
+
+@units.takes_arg_in_units((0, "Mpc h^-1"))
+def correlation(r, powspec=PowerSpectrum):
+    """Calculate the correlation function of the density field at the specified radius or radii.
+
+    The correlation function is calculated for a logarithmic grid of radii in a single FFTLog transform of the power
+    spectrum, which is cached with the power spectrum object; values at the requested radii are then interpolated.
+    """
+    ln_r_table, xi_table = _correlation_table(powspec)
+    # avoid the edges of the table, which are affected by ringing
+    use = slice(_correlation_num_points // 8, -_correlation_num_points // 8)
+    ln_r = np.log(np.asarray(r, dtype=np.float64))
+    if (ln_r < ln_r_table[use][0]).any() or (ln_r > ln_r_table[use][-1]).any():
+        raise ValueError("Radius out of range for correlation function calculation")
+    xi = scipy.interpolate.CubicSpline(ln_r_table[use], xi_table[use])(ln_r)
+
+    if hasattr(r, '__len__'):
+        ax = xi.view(pynbody.array.SimArray)
+        ax.units = powspec.Pk_z0_unnormalised.units * powspec.k.units ** 3
+        return ax
+    else:
+        return float(xi)
 
 
 def correlation_func(context, log_r_min=-3, log_r_max=2, delta_log_r=0.2,
@@ -524,8 +527,7 @@ def correlation_func(context, log_r_min=-3, log_r_max=2, delta_log_r=0.2,
     r.sim = context
     r.units = "Mpc h^-1 a"
 
-    Xi_r = np.array([correlation(ri, pspec)
-                     for ri in r]).view(pynbody.array.SimArray)
+    Xi_r = np.asarray(correlation(r, pspec)).view(pynbody.array.SimArray)
     Xi_r.sim = context
     Xi_r.units = ""
 
@@ -866,7 +868,7 @@ def simulation_halo_mass_function(snapshot_or_cat,
 
     mass_property : str, optional
         The property name giving the mass of each halo. If None, sums the mass in particles in each halo
-        according to the particle data in the catalogue. Summing masses can be slow for large catalogues.
+        according to the particle data in the catalogue, using :meth:`~pynbody.halo.HaloCatalogue.reduce`.
 
     calculate_err : bool, optional
         If True, estimates error bars according to Poisson statistics.
@@ -915,8 +917,8 @@ def simulation_halo_mass_function(snapshot_or_cat,
 
     if masses is None:
         if mass_property is None:
-            warnings.warn("Halo finder masses not provided. Calculating them (might take a while...)")
-            masses = np.array([h['mass'].sum().in_units('1 h**-1 Msol') for h in halo_catalogue])
+            warnings.warn("Halo finder masses not provided. Calculating them from the particle data")
+            masses = halo_catalogue.reduce('mass').in_units('1 h**-1 Msol')
         else:
             masses = halo_catalogue.get_properties_all_halos(with_units=True)[mass_property]
             if units.has_unit(masses):
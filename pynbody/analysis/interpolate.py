@@ -4,12 +4,144 @@ interpolate
 
 2D and 3D Interpolation routines written in cython
 
+For evaluating many tables (e.g. several ions or bandpasses) that share a grid, use :class:`GridInterpolator`,
+which locates each point in the grid once and then interpolates all the requested tables in a single threaded
+pass. Table files can be loaded through :func:`load_table`, which keeps them in a process-wide cache.
+
 """
 
+import os
+import threading
+
 import numpy as np
 
+from .. import config
 from . import _interpolate3d
 
+_table_cache = {}
+_table_cache_lock = threading.Lock()
+
+
+def load_table(path):
+    """Load the arrays stored in a ``.npz`` file, caching them for the lifetime of the process.
+
+    The cache is keyed on the path and modification time of the file, so a table that is changed on disk is reloaded.
+    The returned dictionary and arrays are shared between all callers and must not be modified."""
+    path = os.path.abspath(path)
+    key = (path, os.path.getmtime(path))
+    with _table_cache_lock:
+        if key not in _table_cache:
+            with np.load(path) as data:
+                _table_cache[key] = {k: data[k] for k in data.files}
+        return _table_cache[key]
+
+
+class GridWeights:
+    """The cells and fractional positions within those cells of a set of points on a :class:`GridInterpolator` grid"""
+
+    def __init__(self, index, frac, shape):
+        self.index = index  #: Lower corner of the cell along each axis, shape (3, N)
+        self.frac = frac  #: Fractional position within the cell along each axis, shape (3, N)
+        self.shape = shape  #: The shape of the input points, and hence of interpolated results
+
+    def __len__(self):
+        return self.index.shape[1]
+
+
+class GridInterpolator:
+    """Linear interpolation of any number of named tables that share a 2D or 3D grid.
+
+    Points outside the grid are clamped to its edge. The grid need not be uniform, but the values along each axis
+    must be increasing.
+
+    >>> interp = GridInterpolator((redshifts, temperatures, densities), {'ovi': ovi_table, 'civ': civ_table})
+    >>> result = interp(z, log_temp, log_rho)  # returns {'ovi': ..., 'civ': ...}
+    """
+
+    def __init__(self, axes, tables):
+        """Create an interpolator.
+
+        Parameters
+        ----------
+
+        axes : sequence of array-like
+            The grid values along each of the two or three axes
+
+        tables : dict[str, array-like]
+            The tables to interpolate, each with shape ``(len(axes[0]), len(axes[1]), ...)``
+        """
+        if len(axes) not in (2, 3):
+            raise ValueError("GridInterpolator supports only 2D and 3D grids")
+        self._axes = [np.ascontiguousarray(a, dtype=np.float64) for a in axes]
+        shape = tuple(len(a) for a in self._axes)
+        self._tables = {}
+        for name, table in tables.items():
+            table = np.asarray(table, dtype=np.float64)
+            if table.shape != shape:
+                raise ValueError(f"Table {name!r} has shape {table.shape}, but the grid has shape {shape}")
+            self._tables[name] = table.reshape((1,) * (4 - len(shape)) + shape)
+
+    @property
+    def names(self):
+        """The names of the tables available for interpolation"""
+        return list(self._tables.keys())
+
+    def weights(self, *coords):
+        """Locate the given points in the grid, returning a :class:`GridWeights` that can be passed to :meth:`__call__`
+
+        There must be one coordinate array per grid axis; arrays are broadcast against each other."""
+        if len(coords) != len(self._axes):
+            raise ValueError(f"Expected {len(self._axes)} coordinates, got {len(coords)}")
+        coords = np.broadcast_arrays(*(np.asarray(c, dtype=np.float64) for c in coords))
+        shape = coords[0].shape
+        n = coords[0].size
+
+        index = np.zeros((3, n), dtype=np.int64)
+        frac = np.zeros((3, n), dtype=np.float64)
+        offset = 3 - len(self._axes)
+        for i, (axis, x) in enumerate(zip(self._axes, coords)):
+            if len(axis) < 2:
+                continue
+            x = np.clip(x.ravel(), axis[0], axis[-1])
+            cell = np.searchsorted(axis, x, side='left') - 1
+            np.clip(cell, 0, len(axis) - 2, out=cell)
+            index[i + offset] = cell
+            frac[i + offset] = (x - axis[cell]) / (axis[cell + 1] - axis[cell])
+
+        return GridWeights(index, frac, shape)
+
+    def __call__(self, *coords, names=None, weights=None, num_threads=None):
+        """Interpolate tables at the given points, returning a dictionary mapping table names to result arrays.
+
+        Parameters
+        ----------
+
+        *coords : array-like
+            The points at which to interpolate, one array per grid axis. May be omitted if *weights* is given.
+
+        names : sequence of str, optional
+            The tables to interpolate. By default, all tables are interpolated.
+
+        weights : GridWeights, optional
+            The result of a previous call to :meth:`weights`, to avoid locating the same points again
+
+        num_threads : int, optional
+            The number of threads to use. Defaults to the ``number_of_threads`` configuration option.
+        """
+        if weights is None:
+            weights = self.weights(*coords)
+        if names is None:
+            names = self.names
+        if num_threads is None:
+            num_threads = config['number_of_threads']
+        if len(names) == 0:
+            return {}
+
+        tables = np.ascontiguousarray(np.concatenate([self._tables[name] for name in names]))
+        result = np.empty((len(names), len(weights)), dtype=np.float64)
+        _interpolate3d.interpolate_tables(weights.index, weights.frac, tables, result, num_threads)
+        return {name: r.reshape(weights.shape) for name, r in zip(names, result)}
+
 # this just calls the cython interpolation function, setting the
 # interpolation arrays to correct type
 
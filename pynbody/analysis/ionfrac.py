@@ -3,7 +3,10 @@
 ionfrac
 =======
 
-calculates ionization fractions - NEEDS DOCUMENTATION
+Calculates ionization fractions by interpolating tables generated with CLOUDY for the optically thin case.
+
+The tables are loaded once per process, and any number of ions can be calculated in a single pass over the gas
+particles by passing a list of ion names to :func:`calculate`.
 
 """
 
@@ -12,58 +15,67 @@ import os
 
 import numpy as np
 
-from pynbody import config
+from .interpolate import GridInterpolator, load_table
 
 logger = logging.getLogger('pynbody.analysis.ionfrac')
 
-from .interpolate import interpolate3d
+_ionfrac_file = os.path.join(os.path.dirname(__file__), "ionfracs.npz")
+_interpolator = None
+
+
+def _get_interpolator():
+    global _interpolator
+    if _interpolator is None:
+        # ionization fractions calculated for optically thin case with
+        # CLOUDY v 10.0.  J. Xavier Prochaska + Joe Hennawi have many
+        # helper idl routines for running CLOUDY
+        if not os.path.exists(_ionfrac_file):
+            raise OSError("ionfracs.npz (Ion Fraction table) not found")
+        logger.info("Loading %s" % _ionfrac_file)
+        ifs = load_table(_ionfrac_file)
+        _interpolator = GridInterpolator((ifs['redshiftvals'], ifs['tempvals'], ifs['denvals']),
+                                         {k[:-2]: v for k, v in ifs.items() if k.endswith('if')})
+    return _interpolator
+
+
+def available_ions():
+    """Return the names of the ions for which ionization fractions are tabulated"""
+    return _get_interpolator().names
 
 
 def calculate(sim, ion='ovi', mode='old'):
-    """
+    """Calculate the ionization fraction of the given ion(s) for the gas particles in a simulation
 
-    calculate -- documentation placeholder
+    Parameters
+    ----------
 
+    sim : pynbody.SimSnap
+        The simulation; only gas particles are used. The redshift is taken from the simulation properties.
+
+    ion : str or sequence of str
+        The ion name (e.g. 'ovi'), or a list of ion names. See :func:`available_ions`.
+
+    mode : str
+        Ignored; retained for backwards compatibility.
+
+    Returns
+    -------
+
+    numpy.ndarray or dict[str, numpy.ndarray]
+        If a single ion name was passed, the ionization fractions for that ion. If a list was passed, a dictionary
+        mapping ion names to ionization fractions. Values outside the tabulated range of redshift, temperature and
+        density are clamped to the edge of the table.
     """
+    interpolator = _get_interpolator()
+    ions = [ion] if isinstance(ion, str) else list(ion)
+
+    temp = np.log10(sim.gas['temp']).view(np.ndarray)
+    rho = np.log10(sim.gas['rho'].in_units('m_p cm^-3')).view(np.ndarray)
+
+    logger.info("Interpolating %s values" % ", ".join(ions))
+    weights = interpolator.weights(sim.properties['z'], temp, rho)
+    result = {k: 10 ** v for k, v in interpolator(names=ions, weights=weights).items()}
 
-    global config
-    # ionization fractions calculated for optically thin case with
-    # CLOUDY v 10.0.  J. Xavier Prochaska + Joe Hennawi have many
-    # helper idl routines for running CLOUDY
-    iffile = os.path.join(os.path.dirname(__file__), "ionfracs.npz")
-    if os.path.exists(iffile):
-        # import data
-        logger.info("Loading %s" % iffile)
-        ifs = np.load(iffile)
-    else:
-        raise OSError("ionfracs.npz (Ion Fraction table) not found")
-
-    # allocate temporary metals that we can play with
-    # before inlining, the views on the arrays must be standard np.ndarray
-    # otherwise the normal numpy macros are not generated
-    x_vals = ifs['redshiftvals'].view(np.ndarray)
-    y_vals = ifs['tempvals'].view(np.ndarray)
-    z_vals = ifs['denvals'].view(np.ndarray)
-    vals = ifs[ion + 'if'].view(np.ndarray)
-    x = np.zeros(len(sim.gas))
-    x[:] = sim.properties['z']
-    y = np.log10(sim.gas['temp']).view(np.ndarray)
-    z = np.log10(sim.gas['rho'].in_units('m_p cm^-3')).view(np.ndarray)
-    n = len(sim.gas)
-    n_x_vals = len(x_vals)
-    n_y_vals = len(y_vals)
-    n_z_vals = len(z_vals)
-
-    # get values off grid to minmax
-    x[np.where(x < np.min(x_vals))] = np.min(x_vals)
-    x[np.where(x > np.max(x_vals))] = np.max(x_vals)
-    y[np.where(y < np.min(y_vals))] = np.min(y_vals)
-    y[np.where(y > np.max(y_vals))] = np.max(y_vals)
-    z[np.where(z < np.min(z_vals))] = np.min(z_vals)
-    z[np.where(z > np.max(z_vals))] = np.max(z_vals)
-
-    # interpolate
-    logger.info("Interpolation %s values" % ion)
-    result_array = interpolate3d(x, y, z, x_vals, y_vals, z_vals, vals)
-
-    return 10 ** result_array
+    if isinstance(ion, str):
+        return result[ion]
+    return result
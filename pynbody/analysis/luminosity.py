@@ -75,7 +75,7 @@ import numpy as np
 import pynbody
 
 from .. import filt, snapshot, units
-from .interpolate import interpolate2d
+from .interpolate import GridInterpolator
 
 _ssp_table = None
 _default_ssp_file = [os.path.join(os.path.dirname(__file__), "default_ssp.txt"),
@@ -129,6 +129,15 @@ class SSPTable:
         """List of bandpasses available in this table"""
         return list(self._magnitudes.keys())
 
+    @property
+    def _interpolator(self):
+        if getattr(self, '_interpolator_cache', None) is None:
+            self._interpolator_cache = GridInterpolator((self._metallicities, self._ages), self._magnitudes)
+        return self._interpolator_cache
+
+    def _normalize_band(self, band):
+        return band.lower() if self._case_insensitive else band
+
     def interpolate(self, ages, metallicities, band):
         """Interpolate the magnitude for a given age, metallicity and bandpass
 
@@ -141,25 +150,24 @@ class SSPTable:
         metallicities : float or array-like
             Metallicity in log10 mass fraction
 
-        band : str
-            Bandpass name
+        band : str or sequence of str
+            Bandpass name, or a list of bandpass names
 
         Returns
         -------
 
-        float or array-like
-            Magnitude(s) per solar mass interpolated from the SSP table
+        float or array-like, or dict
+            Magnitude(s) per solar mass interpolated from the SSP table. Ages and metallicities outside
+            the table are clamped to its edge. If a list of bandpasses was passed, a dictionary mapping
+            bandpass names to magnitudes is returned; the position of each star in the table is then
+            only calculated once.
 
         """
-        if self._case_insensitive:
-            band = band.lower()
-        metallicities = np.copy(metallicities)
-        ages = np.copy(ages)
-        # clamp to the edge of the table
-        metallicities = self._clamp_value(metallicities, self._metallicities)
-        ages = self._clamp_value(ages, self._ages)
-
-        return interpolate2d(metallicities, ages, self._metallicities, self._ages, self._magnitudes[band])
+        bands = [band] if isinstance(band, str) else list(band)
+        results = self._interpolator(np.atleast_1d(metallicities), np.atleast_1d(ages),
+                                     names=[self._normalize_band(b) for b in bands])
+        results = {b: results[self._normalize_band(b)] for b in bands}
+        return results[band] if isinstance(band, str) else results
 
     def __call__(self, snapshot, band):
         """Interpolate the magnitude for a given snapshot and bandpass
@@ -170,14 +178,15 @@ class SSPTable:
         snapshot : pynbody.SimSnap
             Snapshot containing the stars
 
-        band : str
-            Bandpass name
+        band : str or sequence of str
+            Bandpass name, or a list of bandpass names
 
         Returns
         -------
 
-        array-like
-            Magnitudes of star particles interpolated from the SSP table
+        array-like or dict
+            Magnitudes of star particles interpolated from the SSP table. If a list of bandpasses was passed,
+            a dictionary mapping bandpass names to magnitudes is returned.
 
         """
 
@@ -192,11 +201,17 @@ class SSPTable:
         with np.errstate(invalid='ignore'):
             output_mags = self.interpolate(np.log10(age_star), metals, band)
 
+        log_masses = 2.5 * np.log10(masses)
+
+        def _to_simarray(mags):
+            vals = mags - log_masses
+            vals = vals.view(pynbody.array.SimArray)
+            vals.units = None
+            return vals
 
-        vals = output_mags - 2.5 * np.log10(masses)
-        vals = vals.view(pynbody.array.SimArray)
-        vals.units = None
-        return vals
+        if isinstance(band, str):
+            return _to_simarray(output_mags)
+        return {k: _to_simarray(v) for k, v in output_mags.items()}
 
     def get_central_wavelength(self, band):
         """Get the estimated central wavelength of a bandpass
@@ -253,13 +268,6 @@ class SSPTable:
         return self.get_flux_normalization(band) * (4 * np.pi * (10 * units.pc)**2)
 
 
-    @classmethod
-    def _clamp_value(cls, value, values):
-        value = np.atleast_1d(value)
-        value[value < np.min(values)] = np.min(values)
-        value[value > np.max(values)] = np.max(values)
-        return value
-
 class MultiSSPTable(SSPTable):
     """Combines multiple SSP tables, each of which must offer different bandpasses"""
     def __init__(self, *tables):
@@ -274,11 +282,28 @@ class MultiSSPTable(SSPTable):
     def bands(self):
         return list(self._bandpass_to_table.keys())
 
+    def _group_bands(self, bands):
+        """Group the given bandpasses by the table that provides them"""
+        groups = {}
+        for band in bands:
+            groups.setdefault(id(self._bandpass_to_table[band]), (self._bandpass_to_table[band], []))[1].append(band)
+        return groups.values()
+
     def interpolate(self, ages, metallicities, band):
-        return self._bandpass_to_table[band].interpolate(ages, metallicities, band)
+        if isinstance(band, str):
+            return self._bandpass_to_table[band].interpolate(ages, metallicities, band)
+        results = {}
+        for table, bands in self._group_bands(band):
+            results.update(table.interpolate(ages, metallicities, bands))
+        return {b: results[b] for b in band}
 
     def __call__(self, snapshot, band):
-        return self._bandpass_to_table[band](snapshot, band)
+        if isinstance(band, str):
+            return self._bandpass_to_table[band](snapshot, band)
+        results = {}
+        for table, bands in self._group_bands(band):
+            results.update(table(snapshot, bands))
+        return {b: results[b] for b in band}
 
     def get_central_wavelength(self, band):
         return self._bandpass_to_table[band].get_central_wavelength(band)
@@ -471,9 +496,11 @@ def calc_mags(simstars, band='v', cmd_path=None):
         Snapshot containing the stars (only). If you have a snapshot with non-star particles, pass
         ``sim.s`` to this function.
 
-    band : str
+    band : str or sequence of str
         Bandpass name. Can be any that is defined in the SSP table (which by default includes
         'U', 'B', 'V', 'R', 'I', 'J', 'H', 'K'). See the module documentation (:mod:`pynbody.analysis.luminosity`).
+        If a list of bandpasses is passed, a dictionary mapping bandpass names to magnitudes is returned; this is
+        faster than calculating each bandpass separately.
 
     cmd_path : str, optional
         Path to the SSP table file. If not provided, the default table will be used. This is either the
@@ -489,6 +516,41 @@ def calc_mags(simstars, band='v', cmd_path=None):
     return table(simstars, band)
 
 
+def calc_lum_den(simstars, bands):
+    """Calculate the luminosity density of stars in several bandpasses at once
+
+    The luminosity density is as defined by the ``<band>_lum_den`` derived arrays (see the module documentation).
+    Where those arrays, or the corresponding ``<band>_mag`` arrays, have already been calculated for the snapshot,
+    they are reused; the remaining magnitudes are calculated in a single pass by :func:`calc_mags`.
+
+    Parameters
+    ----------
+
+    simstars : pynbody.SimSnap
+        Snapshot containing the stars (only)
+
+    bands : sequence of str
+        Bandpass names
+
+    Returns
+    -------
+
+    dict[str, pynbody.array.SimArray]
+        Dictionary mapping bandpass names to luminosity densities
+    """
+    keys = simstars.keys()
+    to_calculate = [b for b in bands if b + '_lum_den' not in keys and b + '_mag' not in keys]
+    mags = calc_mags(simstars, to_calculate) if to_calculate else {}
+
+    result = {}
+    for band in bands:
+        if band + '_lum_den' in keys:
+            result[band] = simstars[band + '_lum_den']
+        else:
+            result[band] = _mag_to_lum_den(mags[band] if band in mags else simstars[band + '_mag'], simstars)
+    return result
+
+
 def halo_mag(sim, band='V'):
     """Calculate the absolute magnitude of the provided halo (or other collection of particles)
 
@@ -595,14 +657,17 @@ def half_light_r(sim, band='V', cylindrical=False):
     return test_r
 
 
+def _mag_to_lum_den(mag, s):
+    val = (10 ** (-0.4 * mag)) * s['rho'] / s['mass']
+    val.units = s['rho'].units/s['mass'].units
+    return val
+
 def _setup_derived_arrays():
 
     bands_available = 'UBVRIJHKugrizy'
 
     def _lum_den_template(band, s):
-        val = (10 ** (-0.4 * s[band + "_mag"])) * s['rho'] / s['mass']
-        val.units = s['rho'].units/s['mass'].units
-        return val
+        return _mag_to_lum_den(s[band + "_mag"], s)
 
     for band in bands_available:
         X = lambda s, b=str(band): calc_mags(s, band=b)
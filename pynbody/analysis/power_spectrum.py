@@ -0,0 +1,376 @@
+"""
+Measurement of the matter power spectrum and correlation function from particle data.
+
+The particles' masses are deposited onto a periodic grid using a nearest-grid-point, cloud-in-cell or
+triangular-shaped-cloud scheme (optionally interlaced, to suppress aliasing), then Fourier transformed. The mass
+assignment window is deconvolved and the shot noise subtracted before binning.
+
+For most purposes, call :func:`power_spectrum` or :func:`correlation_function` on a snapshot:
+
+>>> k, Pk, num_modes = pynbody.analysis.power_spectrum.power_spectrum(f, ngrid=512)
+>>> k_dm_gas, Pk_dm_gas, _ = pynbody.analysis.power_spectrum.power_spectrum(f.dm, f.gas, ngrid=512)
+
+Snapshots too large to hold in memory can be deposited piece by piece onto a :class:`DensityGrid`, e.g. from a
+sequence of partial loads, and the power spectrum then calculated with :func:`power_spectrum_from_grids`.
+
+For model (rather than measured) power spectra, see :mod:`pynbody.analysis.hmf`.
+
+"""
+
+import logging
+import math
+
+import numpy as np
+import scipy.fft
+
+from .. import array, config, units
+from . import _mass_assignment
+
+logger = logging.getLogger('pynbody.analysis.power_spectrum')
+
+_schemes = {'ngp': 1, 'cic': 2, 'tsc': 3}
+
+
+class DensityGrid:
+    """A periodic grid onto which particle masses are deposited, ready for Fourier analysis"""
+
+    def __init__(self, ngrid, boxsize, scheme='cic', interlace=True, num_threads=None):
+        """Create an empty density grid.
+
+        Parameters
+        ----------
+
+        ngrid : int
+            The number of cells along each side of the grid
+
+        boxsize : float
+            The side length of the periodic box, in the same units as the positions that will be deposited
+
+        scheme : str
+            The mass assignment scheme: 'ngp' (nearest grid point), 'cic' (cloud in cell, the default) or 'tsc'
+            (triangular shaped cloud)
+
+        interlace : bool
+            If True (default), deposit onto a second grid offset by half a cell, and combine the two in Fourier space
+            to suppress aliasing. This doubles the memory and time required.
+
+        num_threads : int, optional
+            The number of threads to use. If None, the number of threads is taken from the configuration.
+        """
+        if scheme not in _schemes:
+            raise ValueError("Unknown mass assignment scheme %r; must be one of %s" % (scheme, list(_schemes)))
+        self.ngrid = int(ngrid)
+        self.boxsize = float(boxsize)
+        self.scheme = scheme
+        self.interlace = interlace
+        self.num_threads = num_threads or config['number_of_threads']
+        self.total_mass = 0.0
+        self.sum_mass_squared = 0.0
+        self._grids = [np.zeros((self.ngrid,) * 3)]
+        if interlace:
+            self._grids.append(np.zeros((self.ngrid,) * 3))
+
+    @property
+    def cell_size(self):
+        return self.boxsize / self.ngrid
+
+    def add(self, pos, mass):
+        """Deposit the given particles, with positions as an Nx3 array and masses as a length-N array"""
+        pos = np.asarray(pos)
+        mass = np.asarray(mass)
+        if pos.dtype not in (np.float32, np.float64):
+            pos = pos.astype(np.float64)
+        if mass.dtype not in (np.float32, np.float64):
+            mass = mass.astype(np.float64)
+
+        for grid, shift in zip(self._grids, (0.0, 0.5)):
+            _mass_assignment.deposit(pos, mass, grid, 0.0, self.cell_size, _schemes[self.scheme], shift,
+                                     True, self.num_threads)
+        self.total_mass += float(mass.sum(dtype=np.float64))
+        self.sum_mass_squared += float((mass.astype(np.float64) ** 2).sum())
+
+    def add_snapshot(self, sim, chunk_size=2**22):
+        """Deposit all particles in a snapshot, a chunk at a time to limit the memory used by temporary copies"""
+        pos = sim['pos']
+        mass = sim['mass']
+        for start in range(0, len(sim), chunk_size):
+            self.add(pos[start:start + chunk_size], mass[start:start + chunk_size])
+
+    @property
+    def shot_noise(self):
+        """The shot noise power, in units of the cube of the position units"""
+        if self.total_mass == 0:
+            return 0.0
+        return self.boxsize ** 3 * self.sum_mass_squared / self.total_mass ** 2
+
+    def wavenumbers(self):
+        """Return the wavenumbers along the three axes of the (real-to-complex) Fourier transformed grid"""
+        kx = 2 * math.pi * np.fft.fftfreq(self.ngrid, d=self.cell_size)
+        kz = 2 * math.pi * np.fft.rfftfreq(self.ngrid, d=self.cell_size)
+        return kx, kx, kz
+
+    def delta_k(self):
+        """Return the Fourier transform of the overdensity, with the mass assignment window deconvolved"""
+        if self.total_mass == 0:
+            raise ValueError("No particles have been deposited onto the grid")
+
+        mean_mass = self.total_mass / self.ngrid ** 3
+        kx, ky, kz = self.wavenumbers()
+        result = None
+        for grid, shift in zip(self._grids, (0.0, 0.5)):
+            delta = grid / mean_mass - 1.0
+            delta_k = scipy.fft.rfftn(delta, workers=self.num_threads, overwrite_x=True)
+            del delta
+            if shift != 0:
+                # the particles were displaced by +shift cells, so undo the corresponding phase shift
+                phase = shift * self.cell_size
+                delta_k *= np.exp(1j * phase * kx)[:, np.newaxis, np.newaxis]
+                delta_k *= np.exp(1j * phase * ky)[np.newaxis, :, np.newaxis]
+                delta_k *= np.exp(1j * phase * kz)[np.newaxis, np.newaxis, :]
+            if result is None:
+                result = delta_k
+            else:
+                result += delta_k
+        result /= len(self._grids)
+
+        p = _schemes[self.scheme]
+        window = [np.sinc(k * self.cell_size / (2 * math.pi)) ** p for k in (kx, ky, kz)]
+        result /= window[0][:, np.newaxis, np.newaxis]
+        result /= window[1][np.newaxis, :, np.newaxis]
+        result /= window[2][np.newaxis, np.newaxis, :]
+        return result
+
+
+def _mode_weights(ngrid):
+    """Return the number of modes represented by each column of the last axis of a real-to-complex transform"""
+    weights = np.full(ngrid // 2 + 1, 2.0)
+    weights[0] = 1.0
+    if ngrid % 2 == 0:
+        weights[-1] = 1.0
+    return weights
+
+
+def _default_k_bins(grid):
+    k_fundamental = 2 * math.pi / grid.boxsize
+    return k_fundamental * np.arange(0.5, grid.ngrid // 2 + 1.0)
+
+
+def power_spectrum_from_grids(grid, other_grid=None, bins=None, subtract_shot_noise=True):
+    """Calculate the binned (cross) power spectrum from one or two :class:`DensityGrid` objects.
+
+    Parameters
+    ----------
+
+    grid : DensityGrid
+        The grid onto which particles have been deposited
+
+    other_grid : DensityGrid, optional
+        If specified, calculate the cross power spectrum between *grid* and *other_grid*, which must have the same
+        size and box size. Shot noise is not subtracted from cross spectra.
+
+    bins : array-like, optional
+        The edges of the bins in wavenumber. By default, bins of width equal to the fundamental wavenumber are used,
+        up to the Nyquist wavenumber.
+
+    subtract_shot_noise : bool
+        If True (default), subtract the shot noise from an auto power spectrum.
+
+    Returns
+    -------
+
+    k : numpy.ndarray
+        The mean wavenumber of the modes in each bin, in inverse position units (including the factor 2 pi)
+
+    Pk : numpy.ndarray
+        The power spectrum, in cubed position units
+
+    num_modes : numpy.ndarray
+        The number of Fourier modes contributing to each bin
+    """
+    if other_grid is not None and (other_grid.ngrid != grid.ngrid or other_grid.boxsize != grid.boxsize):
+        raise ValueError("Grids must have the same size to calculate a cross power spectrum")
+
+    if bins is None:
+        bins = _default_k_bins(grid)
+    bins = np.asarray(bins)
+
+    delta_k = grid.delta_k()
+    other_delta_k = delta_k if other_grid is None else other_grid.delta_k()
+
+    kx, ky, kz = grid.wavenumbers()
+    mode_weights = _mode_weights(grid.ngrid)[np.newaxis, :]
+    kyz_squared = ky[:, np.newaxis] ** 2 + kz[np.newaxis, :] ** 2
+    nbins = len(bins) - 1
+    sum_power = np.zeros(nbins)
+    sum_k = np.zeros(nbins)
+    sum_weights = np.zeros(nbins)
+
+    # accumulate one plane at a time to avoid allocating further full-size temporaries
+    for i in range(grid.ngrid):
+        k = np.sqrt(kx[i] ** 2 + kyz_squared)
+        power = (delta_k[i] * other_delta_k[i].conj()).real
+        weights = np.broadcast_to(mode_weights, k.shape)
+        bin_index = np.digitize(k, bins) - 1
+        use = (bin_index >= 0) & (bin_index < nbins)
+        bin_index = bin_index[use]
+        weights = weights[use]
+        sum_power += np.bincount(bin_index, weights * power[use], minlength=nbins)
+        sum_k += np.bincount(bin_index, weights * k[use], minlength=nbins)
+        sum_weights += np.bincount(bin_index, weights, minlength=nbins)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        Pk = sum_power / sum_weights * grid.boxsize ** 3 / grid.ngrid ** 6
+        k_mean = sum_k / sum_weights
+
+    if subtract_shot_noise and other_grid is None:
+        Pk -= grid.shot_noise
+
+    return k_mean, Pk, sum_weights.astype(np.int64)
+
+
+def correlation_function_from_grids(grid, other_grid=None, bins=None, subtract_shot_noise=True):
+    """Calculate the binned (cross) correlation function from one or two :class:`DensityGrid` objects.
+
+    The correlation function is the inverse Fourier transform of the window-deconvolved power spectrum, so is
+    only reliable on scales larger than a few grid cells. Parameters are as for :func:`power_spectrum_from_grids`,
+    except that *bins* gives the bin edges in separation (default: bins one cell wide, up to half the box size).
+
+    Returns
+    -------
+
+    r : numpy.ndarray
+        The mean separation in each bin, in position units
+
+    xi : numpy.ndarray
+        The correlation function
+    """
+    if bins is None:
+        bins = grid.cell_size * np.arange(0.5, grid.ngrid // 2 + 1.0)
+    bins = np.asarray(bins)
+
+    delta_k = grid.delta_k()
+    if other_grid is None:
+        power = (delta_k * delta_k.conj()).real
+        if subtract_shot_noise:
+            power -= grid.shot_noise * grid.ngrid ** 6 / grid.boxsize ** 3
+    else:
+        power = (delta_k * other_grid.delta_k().conj()).real
+    del delta_k
+
+    xi = scipy.fft.irfftn(power, (grid.ngrid,) * 3, workers=grid.num_threads) / grid.ngrid ** 3
+    del power
+
+    separation_1d = grid.cell_size * np.minimum(np.arange(grid.ngrid), grid.ngrid - np.arange(grid.ngrid))
+    ryz_squared = separation_1d[:, np.newaxis] ** 2 + separation_1d[np.newaxis, :] ** 2
+    nbins = len(bins) - 1
+    sum_xi = np.zeros(nbins)
+    sum_r = np.zeros(nbins)
+    counts = np.zeros(nbins)
+    for i in range(grid.ngrid):
+        r = np.sqrt(separation_1d[i] ** 2 + ryz_squared)
+        bin_index = np.digitize(r, bins) - 1
+        use = (bin_index >= 0) & (bin_index < nbins)
+        bin_index = bin_index[use]
+        sum_xi += np.bincount(bin_index, xi[i][use], minlength=nbins)
+        sum_r += np.bincount(bin_index, r[use], minlength=nbins)
+        counts += np.bincount(bin_index, minlength=nbins)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sum_r / counts, sum_xi / counts
+
+
+def _grids_for_snapshots(sim, other, ngrid, scheme, interlace, num_threads):
+    pos_units = sim['pos'].units
+    boxsize = sim.properties['boxsize']
+    if units.is_unit_like(boxsize):
+        boxsize = float(boxsize.in_units(pos_units, **sim.conversion_context()))
+
+    grids = []
+    for s in (sim, other):
+        if s is None:
+            grids.append(None)
+            continue
+        grid = DensityGrid(ngrid, boxsize, scheme, interlace, num_threads)
+        logger.info("Depositing %d particles onto a %d^3 grid", len(s), ngrid)
+        grid.add_snapshot(s)
+        grids.append(grid)
+    return grids[0], grids[1], pos_units
+
+
+def power_spectrum(sim, other=None, ngrid=256, scheme='cic', interlace=True, bins=None, subtract_shot_noise=True,
+                   num_threads=None):
+    """Measure the mass power spectrum of a periodic snapshot, or the cross spectrum between two snapshots.
+
+    Parameters
+    ----------
+
+    sim : SimSnap
+        The snapshot (or family subsnap, e.g. ``f.dm``) to analyse. Its ``boxsize`` property gives the periodic box.
+
+    other : SimSnap, optional
+        If specified, the cross power spectrum between *sim* and *other* is returned, e.g. ``f.dm`` and ``f.gas``.
+
+    ngrid : int
+        The number of grid cells along each side of the box. Default 256.
+
+    scheme : str
+        The mass assignment scheme, 'ngp', 'cic' (default) or 'tsc'
+
+    interlace : bool
+        If True (default), use interlacing to suppress aliasing
+
+    bins : array-like, optional
+        The bin edges in wavenumber, in the inverse position units of the snapshot (including the factor 2 pi)
+
+    subtract_shot_noise : bool
+        If True (default), subtract the shot noise from an auto spectrum
+
+    num_threads : int, optional
+        Number of threads to use. If None, the number of threads is taken from the configuration.
+
+    Returns
+    -------
+
+    k : SimArray
+        The mean wavenumber in each bin
+
+    Pk : SimArray
+        The power spectrum in each bin
+
+    num_modes : numpy.ndarray
+        The number of Fourier modes in each bin
+    """
+    grid, other_grid, pos_units = _grids_for_snapshots(sim, other, ngrid, scheme, interlace, num_threads)
+    k, Pk, num_modes = power_spectrum_from_grids(grid, other_grid, bins, subtract_shot_noise)
+
+    k = k.view(array.SimArray)
+    k.units = pos_units ** -1
+    k.sim = sim
+    Pk = Pk.view(array.SimArray)
+    Pk.units = pos_units ** 3
+    Pk.sim = sim
+    return k, Pk, num_modes
+
+
+def correlation_function(sim, other=None, ngrid=256, scheme='cic', interlace=True, bins=None,
+                         subtract_shot_noise=True, num_threads=None):
+    """Measure the two-point mass correlation function of a periodic snapshot, via its power spectrum.
+
+    Parameters are as for :func:`power_spectrum`, except that *bins* gives the bin edges in separation, in the
+    position units of the snapshot. The result is only reliable on scales larger than a few grid cells.
+
+    Returns
+    -------
+
+    r : SimArray
+        The mean separation in each bin
+
+    xi : numpy.ndarray
+        The correlation function in each bin
+    """
+    grid, other_grid, pos_units = _grids_for_snapshots(sim, other, ngrid, scheme, interlace, num_threads)
+    r, xi = correlation_function_from_grids(grid, other_grid, bins, subtract_shot_noise)
+    r = r.view(array.SimArray)
+    r.units = pos_units
+    r.sim = sim
+    return r, xi
@@ -43,11 +43,18 @@ The steps for loading particle data are as follows
    to throw away in a simple-to-use fashion. See the help for :func:`LoadControl.iterate` for details
    on how to implement this final step.
 
+For writing, the :class:`WriteControl` class provides the equivalent logic: it breaks arrays into
+chunks of bounded size so that conversions (of units or dtype) never require a full-size temporary
+copy, and it reports the throughput achieved once writing is complete.
+
 """
 
 from __future__ import annotations
 
 import copy
+import logging
+import threading
+import time
 from typing import TYPE_CHECKING, Callable, Iterable, Iterator
 
 import numpy as np
@@ -57,6 +64,8 @@ from .. import util
 if TYPE_CHECKING:
     from .. import family
 
+logger = logging.getLogger('pynbody.chunk')
+
 class LoadControl:
     """LoadControl provides the logic required for partial loading.
 
@@ -322,7 +331,9 @@ class LoadControl:
             List of families for which we want to read the array into memory
         multiskip : bool
             If True, skip commands (i.e. entries with buffer_index=None)
-            can have readlen greater than the block length
+            can have readlen greater than the block length, and consecutive skips
+            are merged (including across families) so that a reader can seek
+            over them in one operation
 
         Yields
         ------
@@ -340,10 +351,6 @@ class LoadControl:
         skip_accumulation = 0
 
         for current_family in self._ordered_families:
-            if skip_accumulation > 0:
-                yield skip_accumulation, None, None
-                skip_accumulation = 0
-
             if current_family not in families_on_disk:
                 assert current_family not in families_in_memory
             else:
@@ -366,4 +373,81 @@ class LoadControl:
                     mem_offset += mem_fs.stop - mem_fs.start
                 else:
                     for nread_disk, disk_mask, mem_slice in self._family_chunks[current_family]:
-                        yield nread_disk, None, None
+                        if multiskip:
+                            skip_accumulation += nread_disk
+                        else:
+                            yield nread_disk, None, None
+
+        if skip_accumulation > 0:
+            yield skip_accumulation, None, None
+
+
+class WriteControl:
+    """WriteControl streams arrays out to disk in chunks of bounded size, and records the throughput achieved.
+
+    A typical write loop should be as follows:
+
+    .. code-block:: python
+
+        with WriteControl(chunk_size, "my file") as ctl:
+            for sl in ctl.iterate(len(array)):
+                data = convert(array[sl])
+                write_entries(data)
+                ctl.record(data.nbytes)
+
+    On leaving the ``with`` block, the total amount of data written and the rate at which it was
+    written are reported through the ``pynbody.chunk`` logger. WriteControl is thread-safe, so that
+    a single instance may be used to record writes that are being made in parallel.
+    """
+
+    def __init__(self, max_chunk: int = 1024 ** 2, description: str = "data"):
+        """Initialize a WriteControl object.
+
+        Parameters
+        ----------
+        max_chunk : int
+            The maximum number of entries (i.e. rows, for multi-dimensional arrays) to process in a single chunk
+        description : str
+            A description of what is being written, used only for reporting
+        """
+        self.max_chunk = max_chunk
+        self.description = description
+        self.nbytes = 0
+        self.start_time = None
+        self.end_time = None
+        self._lock = threading.Lock()
+
+    def iterate(self, length: int) -> Iterator[slice]:
+        """Yield slices which together cover an array of the given length, each of at most max_chunk entries"""
+        for i0 in range(0, length, self.max_chunk):
+            yield slice(i0, min(i0 + self.max_chunk, length))
+
+    def record(self, nbytes: int):
+        """Record that the specified number of bytes has been written"""
+        with self._lock:
+            self.nbytes += nbytes
+
+    @property
+    def elapsed(self) -> float:
+        """The time in seconds spent writing so far"""
+        if self.start_time is None:
+            return 0.0
+        return (self.end_time or time.perf_counter()) - self.start_time
+
+    @property
+    def throughput(self) -> float:
+        """The rate at which data has been written, in bytes per second"""
+        elapsed = self.elapsed
+        if elapsed == 0.0:
+            return 0.0
+        return self.nbytes / elapsed
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        self.end_time = None
+        return self
+
+    def __exit__(self, *exc_info):
+        self.end_time = time.perf_counter()
+        logger.info("Wrote %.1f MB of %s in %.2fs (%.1f MB/s)", self.nbytes / 1e6, self.description,
+                    self.elapsed, self.throughput / 1e6)
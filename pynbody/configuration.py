@@ -73,12 +73,20 @@ def _get_basic_config_from_parser(config_parser):
     if config['number_of_threads']<0:
         config['number_of_threads']=multiprocessing.cpu_count()
 
+    config['memory-budget'] = config_parser.get('general', 'memory-budget')
+    if config['memory-budget'].strip() in ('0', ''):
+        config['memory-budget'] = None
+
     config['gravity_calculation_mode'] = config_parser.get(
         'general', 'gravity_calculation_mode')
     config['disk-fit-function'] = config_parser.get('general', 'disk-fit-function')
 
     config['image-default-resolution'] = int(config_parser.get('general', 'image-default-resolution'))
 
+    config['cache'] = {'enabled': config_parser.getboolean('cache', 'enabled'),
+                       'auto-cache-arrays': list(map(str.strip,
+                                                     config_parser.get('cache', 'auto-cache-arrays').split(",")))}
+
     return config
 
 def _setup_logger(config):
@@ -18,6 +18,8 @@ ctypedef fused DTYPE_t:
     np.float64_t
 
 cdef extern from "math.h" nogil:
+      double fabs(double)
+      double INFINITY
       double sqrt(double)
       float sqrt(float)
 
@@ -75,3 +77,337 @@ def direct(f, np.ndarray[DTYPE_t, ndim=2] ipos, eps=None, int num_threads = 0):
     accel = array.SimArray(-m_by_r2,units=f['mass'].units/f['pos'].units**2 * units.G)
 
     return pot, accel
+
+
+from libc.stdlib cimport free, malloc, realloc
+
+
+cdef struct _OctreeNode:
+    double center[3]
+    double half
+    double com[3]
+    double mass
+    double eps2
+    double quad[6]  # traceless quadrupole about the centre of mass: xx, xy, xz, yy, yz, zz
+    np.int64_t start
+    np.int64_t end
+    np.int64_t first_child
+    int num_children
+    int depth
+
+
+cdef struct _Octree:
+    _OctreeNode *nodes
+    np.int64_t num_nodes
+    np.int64_t *order
+    double *pos
+    double *mass
+    double *eps2
+    int max_depth
+
+
+cdef inline void _add_quadrupole(double *quad, double m, double x, double y, double z) noexcept nogil:
+    cdef double r2 = x * x + y * y + z * z
+    quad[0] += m * (3 * x * x - r2)
+    quad[1] += m * 3 * x * y
+    quad[2] += m * 3 * x * z
+    quad[3] += m * (3 * y * y - r2)
+    quad[4] += m * 3 * y * z
+    quad[5] += m * (3 * z * z - r2)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int _octree_build(_Octree *tree, np.int64_t n, int leaf_size) noexcept nogil:
+    """Build an octree over the n particles already stored in tree. Nodes are created in breadth-first order, so
+    that the children of a node always have higher indices than the node itself. Returns -1 on allocation failure."""
+    cdef np.int64_t capacity = 1024, i, j, p, cur
+    cdef np.int64_t counts[8]
+    cdef np.int64_t offsets[8]
+    cdef np.int64_t *scratch
+    cdef double lo[3]
+    cdef double hi[3]
+    cdef double half
+    cdef int k, octant
+    cdef _OctreeNode *node
+    cdef _OctreeNode *child
+    cdef _OctreeNode *grown
+
+    tree.nodes = <_OctreeNode *> malloc(capacity * sizeof(_OctreeNode))
+    scratch = <np.int64_t *> malloc(max(n, 1) * sizeof(np.int64_t))
+    if tree.nodes == NULL or scratch == NULL:
+        free(scratch)
+        return -1
+
+    for k in range(3):
+        lo[k] = INFINITY
+        hi[k] = -INFINITY
+    for p in range(n):
+        tree.order[p] = p
+        for k in range(3):
+            if tree.pos[3 * p + k] < lo[k]:
+                lo[k] = tree.pos[3 * p + k]
+            if tree.pos[3 * p + k] > hi[k]:
+                hi[k] = tree.pos[3 * p + k]
+
+    half = 0.0
+    for k in range(3):
+        if n == 0:
+            lo[k] = hi[k] = 0.0
+        if (hi[k] - lo[k]) / 2 > half:
+            half = (hi[k] - lo[k]) / 2
+    node = &tree.nodes[0]
+    for k in range(3):
+        node.center[k] = (lo[k] + hi[k]) / 2
+    node.half = half * 1.0001 + 1e-300
+    node.start = 0
+    node.end = n
+    node.num_children = 0
+    node.depth = 0
+    tree.num_nodes = 1
+    tree.max_depth = 0
+
+    i = 0
+    while i < tree.num_nodes:
+        node = &tree.nodes[i]
+        # nodes are split unless they are small enough, or so deep that the particles must be coincident
+        if node.end - node.start > leaf_size and node.depth < 60:
+            for k in range(8):
+                counts[k] = 0
+            for j in range(node.start, node.end):
+                p = tree.order[j]
+                octant = ((tree.pos[3 * p] > node.center[0]) | ((tree.pos[3 * p + 1] > node.center[1]) << 1) |
+                          ((tree.pos[3 * p + 2] > node.center[2]) << 2))
+                counts[octant] += 1
+            offsets[0] = node.start
+            for k in range(1, 8):
+                offsets[k] = offsets[k - 1] + counts[k - 1]
+            for j in range(node.start, node.end):
+                p = tree.order[j]
+                octant = ((tree.pos[3 * p] > node.center[0]) | ((tree.pos[3 * p + 1] > node.center[1]) << 1) |
+                          ((tree.pos[3 * p + 2] > node.center[2]) << 2))
+                scratch[offsets[octant]] = p
+                offsets[octant] += 1
+            for j in range(node.start, node.end):
+                tree.order[j] = scratch[j]
+
+            if tree.num_nodes + 8 > capacity:
+                capacity *= 2
+                grown = <_OctreeNode *> realloc(tree.nodes, capacity * sizeof(_OctreeNode))
+                if grown == NULL:
+                    free(scratch)
+                    return -1
+                tree.nodes = grown
+                node = &tree.nodes[i]
+
+            node.first_child = tree.num_nodes
+            cur = node.start
+            for k in range(8):
+                if counts[k] == 0:
+                    continue
+                child = &tree.nodes[tree.num_nodes]
+                child.half = node.half / 2
+                child.center[0] = node.center[0] + (child.half if k & 1 else -child.half)
+                child.center[1] = node.center[1] + (child.half if k & 2 else -child.half)
+                child.center[2] = node.center[2] + (child.half if k & 4 else -child.half)
+                child.start = cur
+                child.end = cur + counts[k]
+                child.num_children = 0
+                child.depth = node.depth + 1
+                if child.depth > tree.max_depth:
+                    tree.max_depth = child.depth
+                cur += counts[k]
+                tree.num_nodes += 1
+                node.num_children += 1
+        i += 1
+
+    free(scratch)
+
+    # accumulate mass moments from the leaves upwards
+    for i in range(tree.num_nodes - 1, -1, -1):
+        node = &tree.nodes[i]
+        node.mass = 0.0
+        node.eps2 = 0.0
+        for k in range(3):
+            node.com[k] = 0.0
+        if node.num_children == 0:
+            for j in range(node.start, node.end):
+                p = tree.order[j]
+                node.mass += tree.mass[p]
+                node.eps2 += tree.mass[p] * tree.eps2[p]
+                for k in range(3):
+                    node.com[k] += tree.mass[p] * tree.pos[3 * p + k]
+        else:
+            for j in range(node.first_child, node.first_child + node.num_children):
+                child = &tree.nodes[j]
+                node.mass += child.mass
+                node.eps2 += child.mass * child.eps2
+                for k in range(3):
+                    node.com[k] += child.mass * child.com[k]
+        if node.mass != 0:
+            node.eps2 /= node.mass
+            for k in range(3):
+                node.com[k] /= node.mass
+        else:
+            for k in range(3):
+                node.com[k] = node.center[k]
+
+        # quadrupole moments, using the parallel axis theorem for the children of internal nodes
+        for k in range(6):
+            node.quad[k] = 0.0
+        if node.num_children == 0:
+            for j in range(node.start, node.end):
+                p = tree.order[j]
+                _add_quadrupole(node.quad, tree.mass[p], tree.pos[3 * p] - node.com[0],
+                                tree.pos[3 * p + 1] - node.com[1], tree.pos[3 * p + 2] - node.com[2])
+        else:
+            for j in range(node.first_child, node.first_child + node.num_children):
+                child = &tree.nodes[j]
+                for k in range(6):
+                    node.quad[k] += child.quad[k]
+                _add_quadrupole(node.quad, child.mass, child.com[0] - node.com[0],
+                                child.com[1] - node.com[1], child.com[2] - node.com[2])
+    return 0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _octree_walk(_Octree *tree, double *target, double theta2, np.int64_t *stack,
+                       double *m_by_r, double *m_by_r2) noexcept nogil:
+    """Sum m/r and m dx/r^3 over the tree for a single target position, using the monopole approximation for nodes
+    that subtend less than the opening angle"""
+    cdef np.int64_t sp = 1, n, j, p
+    cdef _OctreeNode *node
+    cdef double dx, dy, dz, r2, drsoft, drsoft3, m, r5inv, qx, qy, qz, dqd
+    cdef bint inside
+
+    stack[0] = 0
+    while sp > 0:
+        sp -= 1
+        node = &tree.nodes[stack[sp]]
+        if node.num_children == 0:
+            for j in range(node.start, node.end):
+                p = tree.order[j]
+                dx = target[0] - tree.pos[3 * p]
+                dy = target[1] - tree.pos[3 * p + 1]
+                dz = target[2] - tree.pos[3 * p + 2]
+                m = tree.mass[p]
+                drsoft = 1.0 / sqrt(dx * dx + dy * dy + dz * dz + tree.eps2[p])
+                drsoft3 = drsoft * drsoft * drsoft
+                m_by_r[0] += m * drsoft
+                m_by_r2[0] += m * dx * drsoft3
+                m_by_r2[1] += m * dy * drsoft3
+                m_by_r2[2] += m * dz * drsoft3
+            continue
+
+        dx = target[0] - node.com[0]
+        dy = target[1] - node.com[1]
+        dz = target[2] - node.com[2]
+        r2 = dx * dx + dy * dy + dz * dz
+        inside = (fabs(target[0] - node.center[0]) <= node.half and fabs(target[1] - node.center[1]) <= node.half
+                  and fabs(target[2] - node.center[2]) <= node.half)
+        if not inside and 4.0 * node.half * node.half < theta2 * r2:
+            drsoft = 1.0 / sqrt(r2 + node.eps2)
+            drsoft3 = drsoft * drsoft * drsoft
+            m_by_r[0] += node.mass * drsoft
+            m_by_r2[0] += node.mass * dx * drsoft3
+            m_by_r2[1] += node.mass * dy * drsoft3
+            m_by_r2[2] += node.mass * dz * drsoft3
+
+            # quadrupole correction (unsoftened, since the node is well separated from the target)
+            r5inv = 1.0 / (r2 * r2 * sqrt(r2))
+            qx = node.quad[0] * dx + node.quad[1] * dy + node.quad[2] * dz
+            qy = node.quad[1] * dx + node.quad[3] * dy + node.quad[4] * dz
+            qz = node.quad[2] * dx + node.quad[4] * dy + node.quad[5] * dz
+            dqd = dx * qx + dy * qy + dz * qz
+            m_by_r[0] += 0.5 * dqd * r5inv
+            m_by_r2[0] += (2.5 * dqd * dx / r2 - qx) * r5inv
+            m_by_r2[1] += (2.5 * dqd * dy / r2 - qy) * r5inv
+            m_by_r2[2] += (2.5 * dqd * dz / r2 - qz) * r5inv
+        else:
+            for n in range(node.first_child, node.first_child + node.num_children):
+                stack[sp] = n
+                sp += 1
+
+
+def _spatial_order(pos):
+    """Return an ordering of the given positions along a Morton (Z-order) curve, so that consecutive positions are
+    close together in space"""
+    if len(pos) == 0:
+        return np.zeros(0, dtype=np.int64)
+    lo = pos.min(axis=0)
+    extent = np.maximum(pos.max(axis=0) - lo, 1e-300)
+    cell = ((pos - lo) / extent * 1023).astype(np.int64)
+    key = np.zeros(len(pos), dtype=np.int64)
+    for bit in range(10):
+        for k in range(3):
+            key |= ((cell[:, k] >> bit) & 1) << (3 * bit + k)
+    return np.argsort(key).astype(np.int64)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def tree(f, np.ndarray[DTYPE_t, ndim=2] ipos, eps=None, double opening_angle=0.7, int leaf_size=8,
+         int num_threads=0):
+    """Calculate the potential and acceleration at the given positions due to all particles in f, using a
+    Barnes-Hut octree with monopole and quadrupole moments.
+
+    The return values and units are as for :func:`direct`. The cost scales as O(N log N) rather than O(N^2);
+    for the default opening angle of 0.7, the typical error in the force is a few tenths of a per cent."""
+
+    from cython.parallel cimport prange
+
+    if num_threads == 0:
+        num_threads = int(config["number_of_threads"])
+    if num_threads < 0:
+        num_threads = openmp.get_cpus()
+    if num_threads > openmp.get_cpus():
+        num_threads = openmp.get_cpus()
+
+    if eps is None:
+        eps = get_eps(f)
+
+    cdef np.ndarray[np.float64_t, ndim=2] pos = np.ascontiguousarray(f['pos'].view(np.ndarray), dtype=np.float64)
+    cdef np.ndarray[np.float64_t, ndim=1] mass = np.ascontiguousarray(f['mass'].view(np.ndarray), dtype=np.float64)
+    cdef np.ndarray[np.float64_t, ndim=1] epssq = np.ascontiguousarray(
+        np.broadcast_to(np.asarray(eps, dtype=np.float64) ** 2, (len(mass),)))
+    cdef np.ndarray[np.int64_t, ndim=1] order = np.empty(len(mass), dtype=np.int64)
+    cdef np.ndarray[np.float64_t, ndim=2] targets = np.ascontiguousarray(ipos, dtype=np.float64)
+    cdef np.int64_t nips = len(targets), pi, ti, npart = len(mass)
+    # walking the tree for nearby targets in succession makes much better use of the cache
+    cdef np.ndarray[np.int64_t, ndim=1] target_order = _spatial_order(targets)
+    cdef np.ndarray[np.float64_t, ndim=2] m_by_r2 = np.zeros((nips, 3), dtype=np.float64)
+    cdef np.ndarray[np.float64_t, ndim=1] m_by_r = np.zeros(nips, dtype=np.float64)
+    cdef double theta2 = opening_angle * opening_angle
+    cdef _Octree octree
+    cdef np.int64_t *stack
+    cdef int status
+
+    octree.pos = &pos[0, 0] if len(mass) > 0 else NULL
+    octree.mass = &mass[0] if len(mass) > 0 else NULL
+    octree.eps2 = &epssq[0] if len(mass) > 0 else NULL
+    octree.order = &order[0] if len(mass) > 0 else NULL
+    octree.nodes = NULL
+
+    with nogil:
+        status = _octree_build(&octree, npart, leaf_size)
+    if status != 0:
+        free(octree.nodes)
+        raise MemoryError("Unable to allocate octree")
+
+    try:
+        with nogil:
+            for pi in prange(nips, schedule='dynamic', chunksize=64, num_threads=num_threads):
+                ti = target_order[pi]
+                stack = <np.int64_t *> malloc(8 * (octree.max_depth + 2) * sizeof(np.int64_t))
+                _octree_walk(&octree, &targets[ti, 0], theta2, stack, &m_by_r[ti], &m_by_r2[ti, 0])
+                free(stack)
+    finally:
+        free(octree.nodes)
+
+    pot = array.SimArray(-m_by_r.astype(ipos.dtype), units=f['mass'].units / f['pos'].units * units.G)
+    accel = array.SimArray(-m_by_r2.astype(ipos.dtype), units=f['mass'].units / f['pos'].units ** 2 * units.G)
+
+    return pot, accel
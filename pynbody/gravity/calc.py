@@ -12,7 +12,7 @@ from .. import array, config, units
 from ..array import SimArray
 from ..snapshot.simsnap import SimSnap
 from ..util import eps_as_simarray, get_eps
-from ._gravity import direct
+from ._gravity import direct, tree
 
 
 def all_direct(f: SimSnap, eps: float | SimArray | None = None):
@@ -38,6 +38,41 @@ def all_direct(f: SimSnap, eps: float | SimArray | None = None):
     f['acc'] = acc
 
 
+def all_tree(f: SimSnap, eps: float | SimArray | None = None, opening_angle: float = 0.7):
+    """Calculate the potential and acceleration for all particles in the snapshot using a Barnes-Hut tree algorithm.
+
+    The results are stored inside the snapshot itself, as f['phi'] and f['acc'].
+
+    The cost scales as O(N log N), so this is suitable for much larger numbers of particles than :func:`all_direct`.
+    Forces are accurate to a few tenths of a per cent for the default opening angle.
+
+    Parameters
+    ----------
+
+    f :
+        The snapshot to calculate the potential and acceleration for
+    eps :
+        The gravitational softening length. If not provided, the value of ``f['eps']`` will be used.
+    opening_angle :
+        The opening angle criterion for the tree walk. Smaller values are more accurate but slower.
+
+    """
+    if isinstance(eps, (str, units.UnitBase)):
+        eps = eps_as_simarray(f, eps)
+    phi, acc = tree(f, f['pos'].view(np.ndarray), eps, opening_angle=opening_angle)
+    f['phi'] = phi
+    f['acc'] = acc
+
+
+def _solver(name):
+    if name == 'direct':
+        return direct
+    elif name == 'tree':
+        return tree
+    else:
+        raise ValueError("Unknown gravity solver %r; must be 'direct' or 'tree'" % name)
+
+
 def all_pm(f: SimSnap, ngrid: int = 10):
     """Calculate the potential and acceleration for all particles in the snapshot using a Particle-Mesh algorithm.
 
@@ -138,7 +173,8 @@ def pm(f: SimSnap, ipos: np.ndarray, ngrid:int = 10, x0=None, x1=None):
 
     return phi, -grad_phi
 
-def midplane_rot_curve(f: SimSnap, rxy_points: np.ndarray, eps: float | SimArray | None = None):
+def midplane_rot_curve(f: SimSnap, rxy_points: np.ndarray, eps: float | SimArray | None = None,
+                       solver: str = 'direct'):
     """Calculate the rotation curve of a disk galaxy in the x-y midplane (with z=0)
 
     Parameters
@@ -147,6 +183,8 @@ def midplane_rot_curve(f: SimSnap, rxy_points: np.ndarray, eps: float | SimArray
         The snapshot to calculate the rotation curve for
     rxy_points :
         A list or array of radii at which to calculate the rotation curve, in the xy-plane
+    solver :
+        The gravity solver to use: 'direct' (default) or 'tree'
 
     Returns
     -------
@@ -166,7 +204,7 @@ def midplane_rot_curve(f: SimSnap, rxy_points: np.ndarray, eps: float | SimArray
     rs = [pos for r in rxy_points for pos in [
         (r, 0, 0), (0, r, 0), (-r, 0, 0), (0, -r, 0)]]
 
-    pot, accel = direct(f, np.array(rs, dtype=f['pos'].dtype), eps=eps)
+    pot, accel = _solver(solver)(f, np.array(rs, dtype=f['pos'].dtype), eps=eps)
 
     u_out = (accel.units * f['pos'].units) ** (1, 2)
 
@@ -194,7 +232,7 @@ def midplane_rot_curve(f: SimSnap, rxy_points: np.ndarray, eps: float | SimArray
     return x
 
 
-def midplane_potential(f, rxy_points, eps=None):
+def midplane_potential(f, rxy_points, eps=None, solver='direct'):
     """Calculate the potential of a disk galaxy in the x-y midplane (with z=0)
 
     Parameters
@@ -203,6 +241,8 @@ def midplane_potential(f, rxy_points, eps=None):
         The snapshot to calculate the potential for
     rxy_points :
         A list or array of radii at which to calculate the potential, in the xy-plane
+    solver :
+        The gravity solver to use: 'direct' (default) or 'tree'
 
     Returns
     -------
@@ -223,7 +263,7 @@ def midplane_potential(f, rxy_points, eps=None):
     rs = [pos for r in rxy_points for pos in [
         (r, 0, 0), (0, r, 0), (-r, 0, 0), (0, -r, 0)]]
 
-    m_by_r, m_by_r2 = direct(f, np.array(rs, dtype=f['pos'].dtype), eps=eps)
+    m_by_r, m_by_r2 = _solver(solver)(f, np.array(rs, dtype=f['pos'].dtype), eps=eps)
 
     potential = units.G * m_by_r * f['mass'].units / f['pos'].units
 
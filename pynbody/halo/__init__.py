@@ -388,6 +388,107 @@ class HaloCatalogue(snapshot.util.ContainerWithPhysicalUnitsOption,
         else:
             return number_per_particle
 
+    def reduce(self, array_name=None, op='sum', family=None, weight='mass') -> array.SimArray:
+        """Calculate a per-halo quantity for every halo in the catalogue, in a single pass over the particles.
+
+        This is much faster than iterating over the halos, since no :class:`Halo` objects need to be constructed.
+        For example, ``h.reduce('mass')`` returns the total mass of every halo; ``h.reduce('pos', 'mean')`` returns
+        every halo's centre of mass; and ``h.reduce('vel', 'std')`` returns the mass-weighted velocity dispersion
+        along each axis.
+
+        Parameters
+        ----------
+
+        array_name : str
+            The name of the particle array to reduce. May be omitted if *op* is 'count'.
+
+        op : str
+            The reduction to perform: 'sum', 'mean' (weighted by *weight*), 'std' (the standard deviation about the
+            weighted mean, weighted by *weight*), or 'count' (the number of particles).
+
+        family : str | pynbody.family.Family, optional
+            If specified, only particles of the specified family contribute.
+
+        weight : str | None
+            The name of the array to weight by for 'mean' and 'std', or None for unweighted. Default is 'mass'.
+
+        Returns
+        -------
+
+        SimArray
+            An array with one entry per halo, ordered by halo *index* (i.e. in the same order as the arrays from
+            :meth:`get_properties_all_halos`; use the :attr:`number_mapper` to map to halo numbers). For 'mean' and
+            'std' of multi-dimensional arrays, there is one column per dimension. Halos with no contributing
+            particles have a mean and standard deviation of NaN.
+
+        """
+        from .. import family as family_module
+
+        if op not in ('sum', 'mean', 'std', 'count'):
+            raise ValueError("Unknown reduction %r; must be one of 'sum', 'mean', 'std' or 'count'" % op)
+        if array_name is None and op != 'count':
+            raise ValueError("An array name must be specified for reduction %r" % op)
+
+        index_lists = self._get_all_particle_indices_cached()
+        indices = np.asarray(index_lists.particle_index_list)
+        boundaries = np.asarray(index_lists.particle_index_list_boundaries)
+
+        sim = self.base
+        if family is not None:
+            family = family_module.get_family(family)
+            family_slice = sim._get_family_slice(family)
+            in_family = (indices >= family_slice.start) & (indices < family_slice.stop)
+            cumulative = np.concatenate(([0], np.cumsum(in_family)))
+            boundaries = cumulative[boundaries]
+            indices = indices[in_family] - family_slice.start
+            sim = sim[family]
+
+        if indices.dtype not in (np.int32, np.int64):
+            indices = indices.astype(np.int64)
+        if boundaries.dtype not in (np.int32, np.int64):
+            boundaries = boundaries.astype(np.int64)
+
+        if op == 'count':
+            values = np.zeros((len(sim), 0))
+        else:
+            values = sim[array_name]
+            result_units = getattr(values, 'units', units.no_unit)
+            if values.dtype not in (np.float32, np.float64):
+                values = values.astype(np.float64)
+            values = values.reshape((len(values), -1))
+
+        weighted = op in ('mean', 'std') and weight is not None
+        if weighted:
+            weights = sim[weight]
+            if weights.dtype not in (np.float32, np.float64):
+                weights = weights.astype(np.float64)
+        else:
+            weights = np.zeros(1)
+
+        sum_w, sum_wv, var = util.segmented_moments(values, weights, indices, boundaries,
+                                                    weighted=weighted, second_moment=(op == 'std'))
+
+        if op == 'count':
+            result = sum_w.astype(np.int64).view(array.SimArray)
+            result.sim = self.base
+            return result
+        elif op == 'sum':
+            result = sum_wv
+        elif op == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result = sum_wv / sum_w[:, np.newaxis]
+        else:
+            result = np.sqrt(var)
+            result[sum_w == 0] = np.nan
+
+        if result.shape[1] == 1:
+            result = result[:, 0]
+
+        result = result.view(array.SimArray)
+        result.units = result_units
+        result.sim = self.base
+        return result
+
     def load_copy(self, halo_number):
         """Load a fresh SimSnap with only the particles in specified halo
 
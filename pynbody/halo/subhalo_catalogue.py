@@ -35,5 +35,10 @@ class SubhaloCatalogue(HaloCatalogue):
     def _get_halo(self, i):
         return self._full_halo_catalogue._get_halo(self._subhalo_numbers[i])
 
+    def reduce(self, array_name=None, op='sum', family=None, weight='mass'):
+        full_catalogue = self._full_halo_catalogue
+        result = full_catalogue.reduce(array_name, op, family, weight)
+        return result[full_catalogue.number_mapper.number_to_index(self._subhalo_numbers)]
+
     def load_copy(self, i):
         return self._full_halo_catalogue.load_copy(self._subhalo_numbers[i])
@@ -0,0 +1,203 @@
+"""Opt-in instrumentation, recording where the time goes in a pynbody analysis pipeline.
+
+Lazy loading, array derivation, unit conversion, KDTree operations and image rendering are all instrumented. Nothing
+is recorded unless a :class:`Profile` is active, in which case every instrumented operation is recorded as an
+:class:`Event`:
+
+>>> with pynbody.instrumentation.Profile() as prof:
+...     f = pynbody.load("my_snapshot")
+...     f.gas['rho']
+...     pynbody.plot.sph.image(f.gas)
+>>> print(prof.report())
+>>> prof.write_chrome_trace("trace.json")
+
+The trace can be viewed with ``chrome://tracing`` or at https://ui.perfetto.dev.
+
+When no profile is active, the instrumentation hooks cost no more than a check of an empty list.
+"""
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+_active_profiles = []
+_active_profiles_lock = threading.Lock()
+_thread_state = threading.local()
+_null_region = contextlib.nullcontext()
+
+
+class Event:
+    """A record of a single instrumented operation"""
+
+    __slots__ = ('kind', 'name', 'start', 'duration', 'self_duration', 'thread_id', 'thread_count',
+                 'bytes_allocated', 'dependency_chain', '_child_duration', '_start_memory')
+
+    def __init__(self, kind, name, thread_count, dependency_chain):
+        self.kind = kind  #: The type of operation, e.g. 'load', 'derive', 'render'
+        self.name = name  #: The name of the array or object being operated on
+        self.thread_count = thread_count  #: The number of threads in use for the operation
+        self.dependency_chain = dependency_chain  #: The derived arrays being calculated when the event occurred
+        self.thread_id = threading.get_ident()
+        self.start = None  #: The start time (from time.perf_counter)
+        self.duration = None  #: The wall time spent in the operation, in seconds
+        self.self_duration = None  #: The wall time spent, excluding time spent in nested instrumented operations
+        self.bytes_allocated = None  #: The net memory allocated, if the profile is tracing memory; otherwise None
+        self._child_duration = 0.0
+        self._start_memory = None
+
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__ if not k.startswith('_')}
+
+    def __repr__(self):
+        return "<Event %s %r: %.3g s>" % (self.kind, self.name, self.duration or 0.0)
+
+
+class Profile:
+    """Records instrumented events for as long as it is active (i.e. inside a ``with`` block)."""
+
+    def __init__(self, trace_memory=True):
+        """Create a profile.
+
+        Parameters
+        ----------
+        trace_memory : bool
+            If True (default), use the :mod:`tracemalloc` module to record the net memory allocated in each event.
+            This slows down pure-python code, so may be switched off if only timings are required.
+        """
+        self.trace_memory = trace_memory
+        self.events = []
+        self._started_tracemalloc = False
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    def __enter__(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        with _active_profiles_lock:
+            _active_profiles.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        with _active_profiles_lock:
+            _active_profiles.remove(self)
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def _record(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def summary(self):
+        """Return a list of dictionaries, one per (kind, name) pair, summarising the recorded events.
+
+        Each dictionary contains the kind, name, number of calls, total and self wall time and total bytes allocated.
+        The list is sorted by decreasing self time."""
+        summary = {}
+        for e in self.events:
+            entry = summary.setdefault((e.kind, e.name), {'kind': e.kind, 'name': e.name, 'calls': 0,
+                                                          'total_time': 0.0, 'self_time': 0.0,
+                                                          'bytes_allocated': 0})
+            entry['calls'] += 1
+            entry['total_time'] += e.duration
+            entry['self_time'] += e.self_duration
+            entry['bytes_allocated'] += e.bytes_allocated or 0
+        return sorted(summary.values(), key=lambda x: -x['self_time'])
+
+    def report(self):
+        """Return a human-readable table summarising the recorded events"""
+        lines = ["%-18s %-28s %6s %10s %10s %10s" % ("kind", "name", "calls", "total/s", "self/s", "alloc/MB")]
+        for entry in self.summary():
+            lines.append("%-18s %-28s %6d %10.4f %10.4f %10.2f" % (entry['kind'], entry['name'][:28], entry['calls'],
+                                                                   entry['total_time'], entry['self_time'],
+                                                                   entry['bytes_allocated'] / 1e6))
+        return "\n".join(lines)
+
+    def chrome_trace(self):
+        """Return the recorded events in the Chrome trace event format, as a dictionary ready for JSON export"""
+        pid = os.getpid()
+        trace_events = []
+        for e in self.events:
+            trace_events.append({'name': e.name, 'cat': e.kind, 'ph': 'X', 'pid': pid, 'tid': e.thread_id,
+                                 'ts': (e.start - self._origin) * 1e6, 'dur': e.duration * 1e6,
+                                 'args': {'thread_count': e.thread_count, 'bytes_allocated': e.bytes_allocated,
+                                          'dependency_chain': e.dependency_chain}})
+        return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, filename):
+        """Write the recorded events to a JSON file in the Chrome trace event format"""
+        with open(filename, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+
+class _Region:
+    def __init__(self, kind, name, sim, threads):
+        if sim is not None:
+            chain = list(sim.ancestor._dependency_tracker._current_calculation_stack)
+        else:
+            chain = []
+        if threads is None:
+            threads = threading.active_count()
+        self._event = Event(kind, str(name), threads, chain)
+
+    def __enter__(self):
+        stack = getattr(_thread_state, 'stack', None)
+        if stack is None:
+            stack = _thread_state.stack = []
+        stack.append(self._event)
+        if tracemalloc.is_tracing():
+            self._event._start_memory = tracemalloc.get_traced_memory()[0]
+        self._event.start = time.perf_counter()
+        return self._event
+
+    def __exit__(self, *exc_info):
+        event = self._event
+        event.duration = time.perf_counter() - event.start
+        event.self_duration = event.duration - event._child_duration
+        if event._start_memory is not None and tracemalloc.is_tracing():
+            event.bytes_allocated = tracemalloc.get_traced_memory()[0] - event._start_memory
+
+        stack = _thread_state.stack
+        stack.pop()
+        if stack:
+            stack[-1]._child_duration += event.duration
+
+        for profile in list(_active_profiles):
+            profile._record(event)
+
+
+def region(kind, name, sim=None, threads=None):
+    """Return a context manager that records the enclosed code as an event, if any profile is active.
+
+    Parameters
+    ----------
+    kind : str
+        The type of operation, e.g. 'load'
+    name : str
+        The name of the array or object being operated on
+    sim : SimSnap, optional
+        The snapshot being operated on, from which the chain of derived arrays being calculated is taken
+    threads : int, optional
+        The number of threads used by the operation. If not specified, the number of active python threads is
+        recorded.
+    """
+    if not _active_profiles:
+        return _null_region
+    return _Region(kind, name, sim, threads)
+
+
+def instrumented(kind):
+    """Decorator that records each call to a function or method as an event, named by its qualified name"""
+    def decorator(function):
+        name = function.__qualname__
+        @functools.wraps(function)
+        def wrapped(*args, **kwargs):
+            with region(kind, name):
+                return function(*args, **kwargs)
+        return wrapped
+    return decorator
@@ -8,7 +8,7 @@ import warnings
 
 import numpy as np
 
-from .. import array as ar, config, util
+from .. import array as ar, config, instrumentation, util
 from . import kdmain
 
 logger = logging.getLogger("pynbody.kdtree")
@@ -124,6 +124,8 @@ class KDTree:
 
         self.boxsize = boxsize
         self._pos = pos
+        self._pin_against_eviction(pos)
+        self._pin_against_eviction(mass)
         self.set_kernel(config['sph'].get('kernel', 'CubicSplineKernel'))
 
     def _set_num_threads(self, num_threads):
@@ -155,6 +157,8 @@ class KDTree:
         self.particle_offsets = particle_offsets
         self.boxsize = boxsize
         self._pos = pos
+        self._pin_against_eviction(pos)
+        self._pin_against_eviction(mass)
         self._kernel_id = kernel_id
 
         kdmain.import_prebuilt(self.kdtree, self.kdnodes, self.particle_offsets, 0)
@@ -266,6 +270,13 @@ class KDTree:
                 )
         kdmain.set_arrayref(self.kdtree, self.array_name_to_id(name), ar)
         assert self.get_array_ref(name) is ar
+        self._pin_against_eviction(ar)
+
+    def _pin_against_eviction(self, ar):
+        """Prevent the snapshot owning the given array from evicting it to meet a memory budget"""
+        sim = getattr(ar, 'sim', None)
+        if sim is not None and sim.ancestor._memory_budget is not None:
+            sim.ancestor._memory_budget.pin_for_kdtree(self, ar)
 
     def get_array_ref(self, name):
         """Get the current array reference for a given name ('smooth', 'rho', 'mass', 'qty', or 'qty_sm')."""
@@ -349,29 +360,30 @@ class KDTree:
         if nn is None:
             nn = 64
 
-        smx = kdmain.nn_start(self.kdtree, int(nn), self.boxsize)
-
-        try:
-            propid = self.smooth_operation_to_id(mode)
-
-            if propid == self.PROPID_HSM:
-                kdmain.domain_decomposition(self.kdtree, self.num_threads)
-
-
-            if self.num_threads == 1:
-                kdmain.populate(self.kdtree, smx, propid, 0, self._kernel_id)
-            else:
-                util.thread_map(
-                    kdmain.populate,
-                    [self.kdtree] * self.num_threads,
-                    [smx] * self.num_threads,
-                    [propid] * self.num_threads,
-                    list(range(0, self.num_threads)),
-                    [self._kernel_id] * self.num_threads
-                )
-        finally:
-            # Free C-structures memory
-            kdmain.nn_stop(self.kdtree, smx)
+        with instrumentation.region('kdtree_populate', mode, threads=self.num_threads):
+            smx = kdmain.nn_start(self.kdtree, int(nn), self.boxsize)
+
+            try:
+                propid = self.smooth_operation_to_id(mode)
+
+                if propid == self.PROPID_HSM:
+                    kdmain.domain_decomposition(self.kdtree, self.num_threads)
+
+
+                if self.num_threads == 1:
+                    kdmain.populate(self.kdtree, smx, propid, 0, self._kernel_id)
+                else:
+                    util.thread_map(
+                        kdmain.populate,
+                        [self.kdtree] * self.num_threads,
+                        [smx] * self.num_threads,
+                        [propid] * self.num_threads,
+                        list(range(0, self.num_threads)),
+                        [self._kernel_id] * self.num_threads
+                    )
+            finally:
+                # Free C-structures memory
+                kdmain.nn_stop(self.kdtree, smx)
 
     def sph_mean(self, array, nsmooth=64):
         r"""Calculate the SPH mean of a simulation array.
@@ -434,7 +434,7 @@ def image(sim, qty='rho', width="10 kpc", resolution=None, units=None, log=True,
           return_image=False, return_array=False,
           fill_nan=True, fill_val=0.0, linthresh=None,
           restrict_depth = False, threaded=True, approximate_fast=None, denoise=None,
-          kernel=None,
+          kernel=None, level_of_detail=None,
           **kwargs):
     """
     Make an image of the given simulation, using SPH or denoised-SPH interpolation.
@@ -538,6 +538,11 @@ def image(sim, qty='rho', width="10 kpc", resolution=None, units=None, log=True,
     threaded : bool, optional
         If True, use threads to parallelise the rendering. (Default is set in the config file).
 
+    level_of_detail : float, optional
+        If specified, merge groups of particles that are small compared with a pixel into KDTree node aggregates
+        before rendering, with the given tolerance (e.g. 1.0). This is much faster for wide-field images of large
+        simulations; see :meth:`~pynbody.sph.renderers.ImageRendererBase.set_level_of_detail`.
+
     qtytitle : str, optional
         Deprecated alias for colorbar_label.
 
@@ -587,7 +592,8 @@ def image(sim, qty='rho', width="10 kpc", resolution=None, units=None, log=True,
     renderer = renderers.make_render_pipeline(sim, quantity=qty, width=width, resolution=resolution,
                                               out_units=units, weight=weight, restrict_depth=restrict_depth,
                                               kernel=kernel, z_camera=z_camera, threaded=threaded,
-                                              approximate_fast=approximate_fast, denoise=denoise)
+                                              approximate_fast=approximate_fast, denoise=denoise,
+                                              level_of_detail=level_of_detail)
 
     # if width was provided e.g. as string, we'll need it as a float
     width = renderer.geometry.width
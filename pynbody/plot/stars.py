@@ -210,13 +210,16 @@ def render(sim,
 
 	'''
 
-	renderer = renderers.make_render_pipeline(sim.s, quantity=r_band + '_lum_den', width=width,
+	# calculate all three bands in one pass through the SSP table
+	lum_den = pynbody.analysis.luminosity.calc_lum_den(sim.s, [r_band, g_band, b_band])
+
+	renderer = renderers.make_render_pipeline(sim.s, quantity=lum_den[r_band], width=width,
 											  out_units="pc^-2", resolution=resolution)
 
 	r = renderer.render() * r_scale
-	renderer.set_quantity(g_band + '_lum_den')
+	renderer.set_quantity(lum_den[g_band])
 	g = renderer.render() * g_scale
-	renderer.set_quantity(b_band + '_lum_den')
+	renderer.set_quantity(lum_den[b_band])
 	b = renderer.render() * b_scale
 
 
@@ -44,7 +44,10 @@ def load(filename, *args, **kwargs) -> SimSnap:
     for c in SimSnap.iter_subclasses_with_priority(priority):
         if c._can_load(filename):
             logger.info("Loading using backend %s" % str(c))
-            return c(filename, *args, **kwargs)
+            sim = c(filename, *args, **kwargs)
+            if config['memory-budget'] is not None:
+                sim.set_memory_budget(config['memory-budget'])
+            return sim
 
     raise OSError(
         "File %r: format not understood or does not exist" % filename)
@@ -102,5 +105,5 @@ def new(n_particles = 0, order = None, class_ = SimSnap, **families) -> SimSnap:
     return x
 
 
-from . import ascii, gadget, gadgethdf, grafic, nchilada, ramses, subsnap, swift, tipsy
+from . import ascii, cached, gadget, gadgethdf, grafic, memory_budget, nchilada, ramses, subsnap, swift, tipsy
 from .subsnap import FamilySubSnap, IndexedSubSnap, SubSnap
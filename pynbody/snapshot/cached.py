@@ -0,0 +1,374 @@
+"""
+Implements a pynbody-native columnar cache format, for fast repeated access to the same snapshot.
+
+A cache is a directory (by default ``<snapshot>.pynbody-cache``, alongside the original snapshot) containing one
+``.npy`` file per array and a ``manifest.json`` recording the units, properties and family slices. Opening a cache
+requires no header parsing or unit inference, and arrays are memory-mapped rather than read, so that only the
+parts that are actually used are ever pulled from disk.
+
+To create or update a cache, write the snapshot in the cache format, optionally asking for extra arrays to be
+loaded or derived first:
+
+>>> f = pynbody.load("my_snapshot")
+>>> f.write(pynbody.snapshot.cached.CachedSnap, arrays=['smooth', 'rho', 'temp'])
+
+The cache can then be opened either by passing its directory name to :func:`pynbody.load`, or transparently
+(by passing the original snapshot filename) if ``enabled: True`` is set in the ``[cache]`` section of the
+configuration. In the latter case, arrays not present in the cache are loaded from the original snapshot, and arrays
+listed under ``auto-cache-arrays`` are written into the cache as soon as they have been derived.
+
+The cache records the modification times of the original snapshot files. If any of them change, the cache is
+considered out of date and is not used.
+"""
+
+import glob
+import json
+import logging
+import os
+import pathlib
+
+import numpy as np
+
+from .. import array, config, family, units
+from . import SimSnap
+
+logger = logging.getLogger('pynbody.snapshot.cached')
+
+_cache_suffix = ".pynbody-cache"
+_manifest_name = "manifest.json"
+_format_version = 1
+
+
+def cache_path(filename):
+    """Return the default path of the cache directory for the snapshot with the given filename"""
+    return pathlib.Path(str(filename).rstrip("/\\") + _cache_suffix)
+
+
+def _source_signature(filename):
+    """Return a dictionary mapping each file making up a snapshot to its modification time.
+
+    This includes both the named file or directory, and any files sharing its name as a prefix (e.g. the auxiliary
+    files of a tipsy snapshot, or the individual files of a multi-file gadget snapshot)."""
+    filename = str(filename).rstrip("/\\")
+    candidates = [filename] + glob.glob(glob.escape(filename) + ".*")
+    signature = {}
+    for path in sorted(candidates):
+        if path.endswith(_cache_suffix) or not os.path.exists(path):
+            continue
+        signature[os.path.abspath(path)] = os.stat(path).st_mtime_ns
+    return signature
+
+
+def _unit_to_str(unit):
+    """Return a string representation of a unit which, unlike str(unit), is not rounded"""
+    if isinstance(unit, units.NoUnit):
+        return None
+    if isinstance(unit, units.CompositeUnit):
+        terms = [repr(float(unit._scale))] if unit._scale != 1 else []
+        terms += [str(b) if p == 1 else "%s**%s" % (b, p) for b, p in zip(unit._bases, unit._powers)]
+        return " ".join(terms) or "1"
+    return str(unit)
+
+
+def _unit_from_str(unit_str):
+    if unit_str is None:
+        return units.NoUnit()
+    return units.Unit(unit_str)
+
+
+def _properties_to_json(properties):
+    result = {}
+    for k, v in properties.items():
+        if units.is_unit_like(v):
+            result[k] = {'unit': _unit_to_str(v)}
+        elif isinstance(v, (np.generic, np.ndarray)):
+            result[k] = {'value': v.tolist()}
+        elif isinstance(v, (str, int, float, bool)):
+            result[k] = {'value': v}
+        else:
+            logger.debug("Property %r of type %r cannot be stored in the cache", k, type(v))
+    return result
+
+
+def _properties_from_json(properties):
+    return {k: _unit_from_str(v['unit']) if 'unit' in v else v['value'] for k, v in properties.items()}
+
+
+def _read_manifest(path):
+    with open(path / _manifest_name) as f:
+        return json.load(f)
+
+
+def _write_manifest(path, manifest):
+    # write-then-rename, so that readers never see a partially written manifest
+    tmp_name = path / (_manifest_name + ".tmp%d" % os.getpid())
+    with open(tmp_name, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_name, path / _manifest_name)
+
+
+def _is_up_to_date(manifest):
+    source = manifest.get('source')
+    if not source or not os.path.exists(source):
+        # the cache is all that remains, or was made from a snapshot that never existed on disk
+        return True
+    return manifest['source_signature'] == _source_signature(source)
+
+
+def _save_array(path, manifest, name, fam, data, derived):
+    """Save an array into the cache directory, and record it in the manifest (which is not itself written)"""
+    if fam is None:
+        relative_filename = name + ".npy"
+    else:
+        (path / fam.name).mkdir(exist_ok=True)
+        relative_filename = fam.name + "/" + name + ".npy"
+
+    tmp_name = path / (relative_filename + ".tmp%d.npy" % os.getpid())
+    np.save(tmp_name, np.asarray(data))
+    os.replace(tmp_name, path / relative_filename)
+
+    manifest['arrays'] = [a for a in manifest['arrays']
+                          if not (a['name'] == name and a['family'] == (fam and fam.name))]
+    manifest['arrays'].append({'name': name, 'family': fam and fam.name, 'file': relative_filename,
+                               'units': _unit_to_str(getattr(data, 'units', units.NoUnit())),
+                               'derived': bool(derived)})
+
+
+class CachedSnap(SimSnap):
+    """Reads snapshots from the pynbody-native columnar cache format.
+
+    See the module documentation (:mod:`pynbody.snapshot.cached`) for information on creating and using caches."""
+
+    def __init__(self, filename):
+        """Open a cached snapshot.
+
+        Parameters
+        ----------
+        filename : str
+            Either the path to the cache directory, or the filename of the original snapshot, in which case the cache
+            is found at its default location (see :func:`cache_path`).
+        """
+        super().__init__()
+
+        filename = pathlib.Path(filename)
+        if (filename / _manifest_name).exists():
+            self._cache_path = filename
+        else:
+            self._cache_path = cache_path(filename)
+
+        self._manifest = _read_manifest(self._cache_path)
+        if not _is_up_to_date(self._manifest):
+            raise OSError("The cache at %s is out of date; the original snapshot %s has been modified since it was "
+                          "written" % (self._cache_path, self._manifest['source']))
+
+        self._source_filename = self._manifest['source']
+        self._source_snap = None
+        self._filename = self._source_filename or str(self._cache_path)
+        self._num_particles = self._manifest['num_particles']
+        for fam_name, (start, stop) in self._manifest['families'].items():
+            self._family_slice[family.get_family(fam_name)] = slice(start, stop)
+        self._file_units_system = [_unit_from_str(u) for u in self._manifest['file_units_system']]
+        self.properties.update(_properties_from_json(self._manifest['properties']))
+        self._update_cached_arrays()
+
+        self._decorate()
+
+    def _update_cached_arrays(self):
+        self._cached_arrays = {(a['name'], a['family'] and family.get_family(a['family'])): a
+                               for a in self._manifest['arrays']}
+
+    def loadable_keys(self, fam=None):
+        """Return the arrays available in the cache.
+
+        Arrays that are not in the cache may still be loaded from the original snapshot, but are not listed here, since
+        that would require the original snapshot to be opened."""
+        snapshot_level = {n for n, f in self._cached_arrays if f is None}
+        if fam is not None:
+            return list(snapshot_level.union(n for n, f in self._cached_arrays if f is fam))
+
+        family_level = [{n for n, f in self._cached_arrays if f is fam_x} for fam_x in self.families()]
+        if family_level:
+            snapshot_level.update(set.intersection(*family_level))
+        return list(snapshot_level)
+
+    def _load_array(self, array_name, fam=None):
+        if (array_name, None) in self._cached_arrays:
+            self._load_cached_array(array_name, None, fam)
+        elif fam is not None and (array_name, fam) in self._cached_arrays:
+            self._load_cached_array(array_name, fam, fam)
+        else:
+            self._load_array_from_source(array_name, fam)
+
+    def _load_cached_array(self, array_name, stored_fam, fam):
+        info = self._cached_arrays[(array_name, stored_fam)]
+        # copy-on-write memory map: nothing is read until it is used, and changes never reach the cache
+        data = np.load(self._cache_path / info['file'], mmap_mode='c')
+        if fam is not None and stored_fam is None:
+            data = data[self._get_family_slice(fam)]
+        data = data.view(array.SimArray)
+        data.units = _unit_from_str(info['units'])
+        ndim = data.shape[1] if data.ndim > 1 else 1
+
+        if fam is None:
+            self._create_array(array_name, ndim, data.dtype, source_array=data)
+        else:
+            self._create_family_array(array_name, fam, ndim, data.dtype, source_array=data)
+        self._get_array_or_family_array(array_name, fam).units = data.units
+
+    def _get_array_or_family_array(self, array_name, fam):
+        if fam is None:
+            return self._get_array(array_name)
+        else:
+            return self[fam]._get_array(array_name)
+
+    def _open_source(self):
+        if self._source_snap is None:
+            if self._source_filename is None or not os.path.exists(self._source_filename):
+                raise OSError("The original snapshot is not available")
+            for c in SimSnap.iter_subclasses_with_priority(config['snap-class-priority']):
+                if not issubclass(c, CachedSnap) and c._can_load(pathlib.Path(self._source_filename)):
+                    self._source_snap = c(self._source_filename)
+                    break
+            else:
+                raise OSError("The original snapshot format is not understood")
+        return self._source_snap
+
+    def _load_array_from_source(self, array_name, fam):
+        source = self._open_source()
+        if fam is not None:
+            source = source[fam]
+        try:
+            with source.lazy_derive_off:
+                data = source[array_name]
+        except KeyError:
+            raise OSError("No such array in the cache or the original snapshot")
+
+        ndim = data.shape[1] if data.ndim > 1 else 1
+        data = data.view(array.SimArray).copy()
+        if fam is None:
+            self._create_array(array_name, ndim, data.dtype, source_array=data)
+        else:
+            self._create_family_array(array_name, fam, ndim, data.dtype, source_array=data)
+        self._get_array_or_family_array(array_name, fam).units = data.units
+        self._auto_cache(array_name, fam, derived=False)
+
+    def _derive_array(self, name, fam=None):
+        super()._derive_array(name, fam)
+        self._auto_cache(name, fam, derived=True)
+
+    def _auto_cache(self, name, fam, derived):
+        if name not in config['cache']['auto-cache-arrays']:
+            return
+        if fam is None:
+            if name not in self.keys():
+                return
+            data = self._get_array(name)
+        else:
+            if name not in self[fam].keys():
+                return
+            data = self[fam]._get_array(name)
+            if data.family is None:
+                # actually a view of a snapshot-level array
+                return
+        try:
+            _save_array(self._cache_path, self._manifest, name, fam, data, derived)
+            _write_manifest(self._cache_path, self._manifest)
+        except OSError as e:
+            logger.warning("Unable to write array %r to the cache: %s", name, e)
+            return
+        self._update_cached_arrays()
+        logger.info("Added array %r to the cache at %s", name, self._cache_path)
+
+    @staticmethod
+    def _write(self, filename=None, arrays=None, include_derived=True):
+        """Write (or update) a cache for the snapshot.
+
+        Parameters
+        ----------
+        filename : str, optional
+            The cache directory to write. By default, the cache sits alongside the original snapshot (see
+            :func:`cache_path`).
+        arrays : list of str, optional
+            Arrays to load or derive before writing, e.g. ``['smooth', 'rho', 'temp']``. All arrays that are in
+            memory are written in any case.
+        include_derived : bool
+            If True (default), derived arrays in memory are written to the cache too. This is what makes the cache
+            useful for expensive SPH quantities, but note that they will not be re-derived if their dependencies are
+            later changed.
+        """
+        if self is not self.ancestor:
+            raise ValueError("Only a complete snapshot can be written to a cache")
+
+        if isinstance(self, CachedSnap):
+            source = self._source_filename
+            path = pathlib.Path(filename) if filename is not None else self._cache_path
+        else:
+            source = os.path.abspath(str(self.filename)) if os.path.exists(str(self.filename)) else None
+            if filename is None and source is None:
+                raise ValueError("A filename must be specified for the cache of a snapshot that is not on disk")
+            path = pathlib.Path(filename) if filename is not None else cache_path(source)
+
+        for name in arrays or []:
+            self[name]
+
+        path.mkdir(exist_ok=True)
+        manifest = None
+        if (path / _manifest_name).exists():
+            manifest = _read_manifest(path)
+            if manifest['source'] != source or not _is_up_to_date(manifest) \
+                    or manifest['num_particles'] != len(self):
+                # start afresh
+                manifest = None
+
+        if manifest is None:
+            manifest = {'format_version': _format_version, 'arrays': []}
+
+        manifest.update({'source': source,
+                         'source_signature': _source_signature(source) if source else {},
+                         'num_particles': len(self),
+                         'families': {f.name: [self._get_family_slice(f).start, self._get_family_slice(f).stop]
+                                      for f in self.families()},
+                         'file_units_system': [_unit_to_str(u) for u in self._file_units_system],
+                         'properties': _properties_to_json(self.properties)})
+
+        with self.lazy_off:
+            for name in self.keys():
+                if self._array_name_1D_to_ND(name) is not None:
+                    continue
+                if self.is_derived_array(name) and not include_derived:
+                    continue
+                _save_array(path, manifest, name, None, self._get_array(name), self.is_derived_array(name))
+
+            for name in self.family_keys():
+                if self._array_name_1D_to_ND(name) is not None:
+                    continue
+                for fam in self._family_arrays[name]:
+                    derived = self.is_derived_array(name, fam)
+                    if derived and not include_derived:
+                        continue
+                    _save_array(path, manifest, name, fam, self._family_arrays[name][fam], derived)
+
+        _write_manifest(path, manifest)
+
+        if isinstance(self, CachedSnap):
+            self._manifest = manifest
+            self._update_cached_arrays()
+
+    @classmethod
+    def _can_load(cls, f):
+        f = pathlib.Path(f)
+        if (f / _manifest_name).exists():
+            return True
+        if not config['cache']['enabled']:
+            return False
+        path = cache_path(f)
+        try:
+            manifest = _read_manifest(path)
+        except (OSError, ValueError):
+            return False
+        if manifest.get('format_version') != _format_version:
+            return False
+        if not _is_up_to_date(manifest):
+            logger.info("Ignoring out-of-date cache at %s", path)
+            return False
+        return True
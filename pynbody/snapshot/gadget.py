@@ -24,7 +24,7 @@ import warnings
 
 import numpy as np
 
-from .. import array, config_parser, family, units
+from .. import array, chunk, config_parser, family, units
 from . import SimSnap, namemapper
 
 # This is set here and not in a config file because too many things break
@@ -551,15 +551,19 @@ class _GadgetFile:
                 fd.seek(-len(data), 1)
                 fd.write(data)
 
-            if self.endian != '=':
-                big_data = big_data.byteswap(False)
-
             # Actually write the data
             # Make sure to ravel it, otherwise the wrong amount will be written,
             # because it will also write nulls every time the first array dimension
-            # changes.
-            d = np.ravel(big_data.astype(dt)).tobytes()
-            fd.write(d)
+            # changes. The conversion to the on-disk type is done chunk-by-chunk,
+            # so that no full-size copy of the data is made.
+            flat_data = np.ravel(big_data)
+            with chunk.WriteControl(description=fn) as write_control:
+                for sl in write_control.iterate(len(flat_data)):
+                    d = flat_data[sl].astype(dt)
+                    if self.endian != '=':
+                        d.byteswap(True)
+                    d.tofile(fd)
+                    write_control.record(d.nbytes)
             if p_type == MaxType or p_type < 0:
                 data = self.write_block_footer(name, cur_block.length)
                 fd.write(data)
@@ -1151,9 +1155,7 @@ class GadgetSnap(SimSnap):
                                 self._files[i].write_header(
                                     self.header, filename=ffile)
                         else:
-                            # Write data
-                            if np.issubdtype(data.dtype, np.floating):
-                                data = np.asanyarray(data, dtype=np.float32)
+                            # Write data (conversion to the on-disk type happens chunk-wise in write_block)
                             self._files[i].write_block(g_name, gfam, data[
                                                        s:(s + f_parts[i])], filename=ffile)
                         s += f_parts[i]
@@ -12,17 +12,23 @@ will be available from pynbody.
 
 Spanned files are supported. To load a range of files ``snap.0.hdf5``, ``snap.1.hdf5``, ... ``snap.n.hdf5``,
 pass the filename ``snap``. If you pass e.g. ``snap.2.hdf5``, only file 2 will be loaded.
+
+Any snapshot can be written out in GadgetHDF format using e.g. ``f.write(GadgetHDFSnap, "output", num_files=4,
+compression="gzip", shuffle=True)``. Datasets are chunked, optionally compressed, and the output files are
+written in parallel.
 """
 
+import concurrent.futures
 import configparser
 import functools
 import itertools
 import logging
 import warnings
+import zlib
 
 import numpy as np
 
-from .. import config_parser, family, units, util
+from .. import chunk, config, config_parser, family, units, util
 from . import SimSnap, namemapper
 
 logger = logging.getLogger('pynbody.snapshot.gadgethdf')
@@ -155,6 +161,236 @@ class _SubfindHdfMultiFileManager(_GadgetHdfMultiFileManager):
     _subgroup_name = "FOF"
 
 
+def _compress_hdf_chunk(source, factor, dtype, chunk_shape, shuffle, level):
+    """Convert a block of particle data for a single HDF5 chunk and compress it with the HDF5 deflate pipeline.
+
+    The returned bytes are suitable for passing to h5py's ``write_direct_chunk``. This runs outside the
+    h5py lock, so that many chunks can be compressed in parallel."""
+    data = np.asarray(source)
+    if factor != 1.0:
+        data = data * factor
+    data = np.ascontiguousarray(data, dtype=dtype)
+    if data.shape != chunk_shape:
+        # HDF5 always stores edge chunks at full size
+        padded = np.zeros(chunk_shape, dtype=dtype)
+        padded[:len(data)] = data
+        data = padded
+    if shuffle:
+        data = np.ascontiguousarray(data.view(np.uint8).reshape(-1, data.dtype.itemsize).T)
+    return zlib.compress(data, level)
+
+
+class _GadgetHdfWriter:
+    """Writes any snapshot out as one or more GadgetHDF files; see :meth:`GadgetHDFSnap._write`"""
+
+    _base_units = [units.cm, units.g, units.cm / units.s, units.K, units.a, units.h]
+    _unit_names = ['U_L', 'U_M', 'U_V', '[K]']
+
+    def __init__(self, sim, num_files, compression, compression_opts, shuffle, chunk_size):
+        if compression not in (None, 'gzip', 'lzf'):
+            raise ValueError("Unsupported compression %r; use 'gzip', 'lzf' or None" % compression)
+        self._sim = sim
+        self._num_files = num_files
+        self._compression = compression
+        self._compression_opts = compression_opts
+        self._shuffle = shuffle
+        self._chunk_size = chunk_size
+        self._translate_array_name = namemapper.AdaptiveNameMapper(GadgetHDFSnap._namemapper_config_section)
+        self._init_file_units()
+        self._init_family_groups()
+
+    def _init_file_units(self):
+        """Choose the file unit system to match the units of the snapshot, stripped of any a and h factors"""
+        # arrays without units are assumed to be in the default gadget unit system
+        self._default_array_units = {x: units.Unit(config_parser.get('gadget-units', x))
+                                     for x in ('pos', 'mass', 'vel')}
+        self._file_units = []
+        for array_name, base in zip(('pos', 'mass', 'vel'), self._base_units[:3]):
+            try:
+                array_units = self._sim[array_name].units
+                array_units.dimensional_project([base, units.a, units.h])
+            except (KeyError, units.UnitsException):
+                array_units = self._default_array_units[array_name]
+            _, aexp, hexp = array_units.dimensional_project([base, units.a, units.h])
+            self._file_units.append(float((array_units / (units.a ** aexp * units.h ** hexp)).in_units(base)))
+            if array_name == 'pos':
+                self._position_units = array_units
+        self._length_unit, self._mass_unit, self._velocity_unit = self._file_units
+
+    def _init_family_groups(self):
+        self._family_groups = {}
+        for fam in self._sim.families():
+            if fam not in _default_type_map:
+                raise ValueError("Family %s cannot be written to a GadgetHDF file because it is not present in "
+                                 "the [gadgethdf-type-mapping] configuration section" % fam.name)
+            self._family_groups[fam] = _default_type_map[fam][0]
+        self._num_types = max(int(g[-1]) for g in _all_hdf_particle_groups) + 1
+
+    def _unit_attributes(self, array_units, array_name):
+        """Return the conversion factor for the data, and the gadget-style HDF attributes describing its units"""
+        powers = [0] * len(self._base_units)
+        if isinstance(array_units, units.NoUnit):
+            array_units = self._default_array_units.get(array_name, array_units)
+        if not isinstance(array_units, units.NoUnit):
+            try:
+                powers = array_units.dimensional_project(self._base_units)
+            except units.UnitsException:
+                warnings.warn("Units of array %r cannot be expressed in the GadgetHDF unit system, so will not "
+                              "be recorded" % array_name, RuntimeWarning)
+
+        file_units = units.Unit("1")
+        cgs_factor = 1.0
+        description = []
+        for name, unit_value, base, power in zip(self._unit_names, self._file_units + [1.0],
+                                                 self._base_units, powers):
+            if power != 0:
+                file_units *= (unit_value * base) ** power
+                cgs_factor *= unit_value ** float(power)
+                description.append("%s^%.17g" % (name, float(power)))
+        file_units *= units.a ** powers[4] * units.h ** powers[5]
+
+        if any(p != 0 for p in powers):
+            factor = float(array_units.in_units(file_units))
+        else:
+            factor = 1.0
+
+        # the trailing text is required by the reader, which ignores the final character of the description
+        attrs = {'VarDescription': " ".join(description + ["[written by pynbody]"]),
+                 'CGSConversionFactor': cgs_factor,
+                 'aexp-scale-exponent': float(powers[4]),
+                 'h-scale-exponent': float(powers[5])}
+        return factor, attrs
+
+    def write(self, filename):
+        if self._num_files == 1:
+            filenames = [filename]
+        else:
+            filenames = ["%s.%d.hdf5" % (filename, i) for i in range(self._num_files)]
+
+        num_threads = config['number_of_threads']
+        with self._sim.lazy_derive_off, \
+                chunk.WriteControl(self._chunk_size * num_threads, filename) as self._write_control, \
+                concurrent.futures.ThreadPoolExecutor(num_threads) as self._compression_pool:
+            # all arrays are loaded up-front, so that no lazy-loading happens inside the writer threads
+            self._arrays = self._get_arrays_to_write()
+            util.thread_map(self._write_file, range(self._num_files), filenames)
+
+    def _get_arrays_to_write(self):
+        sim = self._sim
+        arrays = {}
+        for fam in self._family_groups:
+            names = set(sim.keys()).union(sim.family_keys(fam)).union(['pos', 'vel', 'mass'])
+            arrays[fam] = {}
+            for name in sorted(names):
+                if name in ('x', 'y', 'z', 'vx', 'vy', 'vz') or sim.is_derived_array(name, fam):
+                    continue
+                try:
+                    arrays[fam][name] = sim[fam][name]
+                except KeyError:
+                    pass
+
+            if 'iord' not in arrays[fam]:
+                # Gadget files require particle IDs
+                arrays[fam]['iord'] = np.arange(len(sim), dtype=np.int64)[sim._get_family_slice(fam)]
+        return arrays
+
+    def _file_range(self, fam, file_index):
+        n = len(self._sim[fam])
+        return n * file_index // self._num_files, n * (file_index + 1) // self._num_files
+
+    def _write_file(self, file_index, filename):
+        with h5py.File(filename, 'w') as f:
+            self._write_header(f, file_index)
+            for fam, group_name in self._family_groups.items():
+                i0, i1 = self._file_range(fam, file_index)
+                group = f.create_group(group_name)
+                for name, data in self._arrays[fam].items():
+                    self._write_dataset(group, name, data, i0, i1)
+
+    def _write_header(self, f, file_index):
+        sim = self._sim
+        context = sim.conversion_context()
+
+        npart_this_file = np.zeros(self._num_types, dtype=np.uint32)
+        npart_total = np.zeros(self._num_types, dtype=np.uint64)
+        for fam, group_name in self._family_groups.items():
+            i0, i1 = self._file_range(fam, file_index)
+            npart_this_file[int(group_name[-1])] += i1 - i0
+            npart_total[int(group_name[-1])] += len(sim[fam])
+
+        boxsize = sim.properties.get('boxsize', 0.0)
+        if units.is_unit_like(boxsize):
+            boxsize = boxsize.in_units(self._position_units, **context)
+
+        time = sim.properties.get('time', 0.0)
+        if units.is_unit_like(time):
+            time = time.in_units('Gyr', **context)
+
+        a = sim.properties.get('a', 1.0)
+
+        header = f.create_group('Header')
+        header.attrs['NumPart_ThisFile'] = npart_this_file
+        header.attrs['NumPart_Total'] = (npart_total & 0xffffffff).astype(np.uint32)
+        header.attrs['NumPart_Total_HighWord'] = (npart_total >> 32).astype(np.uint32)
+        header.attrs['MassTable'] = np.zeros(self._num_types)
+        header.attrs['NumFilesPerSnapshot'] = np.int32(self._num_files)
+        header.attrs['Time'] = a
+        header.attrs['Redshift'] = 1. / a - 1.
+        header.attrs['BoxSize'] = float(boxsize)
+        header.attrs['Time_GYR'] = float(time)
+        header.attrs['Omega0'] = sim.properties.get('omegaM0', 0.0)
+        header.attrs['OmegaLambda'] = sim.properties.get('omegaL0', 0.0)
+        header.attrs['HubbleParam'] = sim.properties.get('h', 1.0)
+        if 'omegaB0' in sim.properties:
+            header.attrs['OmegaBaryon'] = sim.properties['omegaB0']
+
+        unit_attrs = f.create_group('Units').attrs
+        unit_attrs['UnitLength_in_cm'] = self._length_unit
+        unit_attrs['UnitMass_in_g'] = self._mass_unit
+        unit_attrs['UnitVelocity_in_cm_per_s'] = self._velocity_unit
+        unit_attrs['UnitTime_in_s'] = self._length_unit / self._velocity_unit
+
+    def _write_dataset(self, group, array_name, data, i0, i1):
+        hdf_name = self._translate_array_name(array_name)
+        factor, attrs = self._unit_attributes(getattr(data, "units", units.no_unit), array_name)
+        shape = (i1 - i0,) + data.shape[1:]
+        dtype = data.dtype
+        source = data[i0:i1]
+
+        if shape[0] == 0:
+            dataset = group.create_dataset(hdf_name, shape, dtype)
+        else:
+            chunk_shape = (min(self._chunk_size, shape[0]),) + shape[1:]
+            dataset = group.create_dataset(hdf_name, shape, dtype, chunks=chunk_shape,
+                                           compression=self._compression,
+                                           compression_opts=self._compression_opts,
+                                           shuffle=self._shuffle)
+        dataset.attrs.update(attrs)
+
+        if self._compression == 'gzip' and shape[0] > 0:
+            self._write_gzip_chunks(dataset, source, factor, chunk_shape)
+        else:
+            for sl in self._write_control.iterate(shape[0]):
+                block = np.asarray(source[sl])
+                if factor != 1.0:
+                    block = block * factor
+                dataset[sl] = block
+                self._write_control.record(block.nbytes)
+
+    def _write_gzip_chunks(self, dataset, source, factor, chunk_shape):
+        """Compress chunks in parallel and write them directly, bypassing the (serial) HDF5 filter pipeline"""
+        level = 4 if self._compression_opts is None else self._compression_opts
+        rows = chunk_shape[0]
+        for sl in self._write_control.iterate(len(source)):
+            starts = range(sl.start, sl.stop, rows)
+            compressed = self._compression_pool.map(
+                lambda i: _compress_hdf_chunk(source[i:i + rows], factor, dataset.dtype, chunk_shape,
+                                              self._shuffle, level), starts)
+            for i, chunk_bytes in zip(starts, compressed):
+                dataset.id.write_direct_chunk((i,) + (0,) * (len(chunk_shape) - 1), chunk_bytes)
+            self._write_control.record((sl.stop - sl.start) * source[:1].nbytes)
+
+
 class GadgetHDFSnap(SimSnap):
     """
     Class that reads HDF Gadget snapshots.
@@ -299,8 +535,31 @@ class GadgetHDFSnap(SimSnap):
 
 
     @staticmethod
-    def _write(self, filename=None):
-        raise RuntimeError("Not implemented")
+    def _write(self, filename=None, num_files=1, compression=None, compression_opts=None, shuffle=False,
+               chunk_size=2**16):
+        """Write the snapshot to one or more GadgetHDF files.
+
+        Parameters
+        ----------
+        filename : str
+            The file to write. If *num_files* > 1, the files written are ``filename.0.hdf5``, ``filename.1.hdf5``, ...
+        num_files : int
+            The number of files across which to split the particles. The files are written in parallel.
+        compression : str, optional
+            The HDF5 compression filter to apply to every dataset: ``'gzip'``, ``'lzf'`` or None (the default).
+            Gzip compression is performed in parallel using ``config['number_of_threads']`` threads.
+        compression_opts : int, optional
+            The gzip compression level (0-9)
+        shuffle : bool
+            If True, apply the HDF5 byte-shuffle filter, which generally improves compression
+        chunk_size : int
+            The number of particles in each HDF5 chunk
+        """
+        if h5py is None:
+            raise ImportError("Writing GadgetHDF files requires h5py")
+        if filename is None:
+            raise ValueError("A filename must be specified when writing a GadgetHDF file")
+        _GadgetHdfWriter(self, num_files, compression, compression_opts, shuffle, chunk_size).write(str(filename))
 
     def write_array(self, array_name, fam=None, overwrite=False):
         translated_name = self._translate_array_name(array_name)[0]
@@ -326,7 +585,11 @@ class GadgetHDFSnap(SimSnap):
                                                           target_array_this.shape,
                                                           target_array_this.dtype)
 
-                dataset.write_direct(target_array_this.reshape(dataset.shape))
+                target_array_this = target_array_this.reshape(dataset.shape)
+                with chunk.WriteControl(description=dataset.name) as write_control:
+                    for sl in write_control.iterate(len(target_array_this)):
+                        dataset.write_direct(target_array_this, sl, sl)
+                        write_control.record(target_array_this[sl].nbytes)
 
                 i0 = i1
 
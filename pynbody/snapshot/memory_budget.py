@@ -0,0 +1,166 @@
+"""Memory-budgeted eviction of arrays that can be recreated on demand.
+
+Users should not normally need to use this module directly; instead call
+:meth:`~pynbody.snapshot.simsnap.SimSnap.set_memory_budget` on a snapshot, or set ``memory-budget`` in the
+``[general]`` section of the configuration.
+
+Once a budget is set, arrays that were lazy-loaded from disk or automatically derived are tracked in
+least-recently-used order. Whenever the total size of the snapshot's arrays exceeds the budget, the least recently
+used of these arrays are deleted; they will be transparently reloaded or re-derived if accessed again.
+
+The following arrays are never evicted:
+
+* arrays that were created or modified by the user (including by changing their units);
+* arrays referenced by a :class:`~pynbody.kdtree.KDTree`;
+* arrays that are referenced from elsewhere (e.g. held in a user variable), since deleting them from the snapshot
+  would not free any memory;
+* arrays that are being used by an ongoing derivation.
+"""
+
+import collections
+import logging
+import sys
+import threading
+import weakref
+
+import numpy as np
+
+logger = logging.getLogger('pynbody.snapshot.memory_budget')
+
+
+def parse_memory_size(size):
+    """Convert a memory size such as ``"4 GB"``, ``"512MB"`` or ``1e9`` into a number of bytes.
+
+    A size of zero, None or ``"none"`` means no limit, and is returned as None."""
+    if size is None:
+        return None
+    if isinstance(size, str):
+        size = size.strip().upper()
+        if size in ("", "NONE", "0"):
+            return None
+        multiplier = 1
+        for suffix, value in (("TB", 1024**4), ("GB", 1024**3), ("MB", 1024**2), ("KB", 1024), ("B", 1)):
+            if size.endswith(suffix):
+                size = size[:-len(suffix)]
+                multiplier = value
+                break
+        size = float(size) * multiplier
+    size = int(size)
+    return size if size > 0 else None
+
+
+class MemoryBudget:
+    """Tracks evictable arrays for a snapshot in least-recently-used order, and evicts them to meet a budget"""
+
+    def __init__(self, sim, budget):
+        """Create a memory budget for the given (ancestor) snapshot, with the budget specified in bytes"""
+        self._sim = weakref.ref(sim)
+        self.budget = budget
+        self._evictable = collections.OrderedDict()  # keys are (name, family or None); values unused
+        self._kdtree_arrays = weakref.WeakKeyDictionary()
+        self._lock = threading.RLock()
+
+    def register(self, name, fam=None):
+        """Note that the named array has been loaded or derived, and could therefore be recreated on demand"""
+        with self._lock:
+            self._evictable[(name, fam)] = None
+            self._evictable.move_to_end((name, fam))
+        self.enforce(protect={name})
+
+    def touch(self, name):
+        """Note that the named array has been accessed"""
+        with self._lock:
+            for key in [k for k in self._evictable if k[0] == name]:
+                self._evictable.move_to_end(key)
+
+    def pin(self, name):
+        """Note that the named array has been modified, so must not be evicted"""
+        with self._lock:
+            for key in [k for k in self._evictable if k[0] == name]:
+                del self._evictable[key]
+
+    def discard(self, name, fam=None):
+        """Note that the named array has been deleted or replaced"""
+        with self._lock:
+            self._evictable.pop((name, fam), None)
+
+    def pin_for_kdtree(self, kdtree, ar):
+        """Note that the given array is referenced by a KDTree, so must not be evicted while the tree is alive"""
+        with self._lock:
+            self._kdtree_arrays.setdefault(kdtree, []).append(ar)
+
+    def resident_bytes(self):
+        """Return the number of bytes used by all the arrays of the snapshot"""
+        return sum(ar.nbytes for _, _, ar in self._iter_arrays())
+
+    def _iter_arrays(self):
+        sim = self._sim()
+        if sim is None:
+            return
+        for name, ar in list(sim._arrays.items()):
+            if sim._array_name_1D_to_ND(name) is None:
+                yield name, None, ar
+        for name, fam_arrays in list(sim._family_arrays.items()):
+            if sim._array_name_1D_to_ND(name) is None:
+                for fam, ar in list(fam_arrays.items()):
+                    yield name, fam, ar
+
+    def _get_array(self, name, fam):
+        sim = self._sim()
+        if fam is None:
+            return sim._arrays.get(name, None)
+        else:
+            return sim._family_arrays.get(name, {}).get(fam, None)
+
+    def _is_referenced_elsewhere(self, ar):
+        """Return True if the array is referenced anywhere other than the snapshot's dictionaries.
+
+        The expected references are the caller's local variable, the argument to this method, the argument to
+        getrefcount, the snapshot's dictionary, and any 1D views (e.g. x, y, z) stored in the snapshot's dictionaries."""
+        num_views = sum(1 for _, _, other in self._iter_views() if other.base is ar)
+        return sys.getrefcount(ar) > 4 + num_views
+
+    def _iter_views(self):
+        sim = self._sim()
+        for name, ar in list(sim._arrays.items()):
+            if sim._array_name_1D_to_ND(name) is not None:
+                yield name, None, ar
+        for name, fam_arrays in list(sim._family_arrays.items()):
+            if sim._array_name_1D_to_ND(name) is not None:
+                for fam, ar in list(fam_arrays.items()):
+                    yield name, fam, ar
+
+    def _is_used_by_kdtree(self, ar):
+        return any(np.may_share_memory(ar, other) for arrays in list(self._kdtree_arrays.values())
+                   for other in arrays)
+
+    def enforce(self, protect=()):
+        """Evict least-recently-used arrays until the snapshot's arrays fit within the budget.
+
+        Arrays named in *protect*, or being calculated by the snapshot's dependency tracker, are not evicted."""
+        sim = self._sim()
+        if sim is None or self.budget is None:
+            return
+        with self._lock:
+            resident = self.resident_bytes()
+            if resident <= self.budget:
+                return
+            protect = set(protect).union(sim._dependency_tracker._current_calculation_stack)
+            for name, fam in list(self._evictable):
+                if resident <= self.budget:
+                    break
+                if name in protect:
+                    continue
+                ar = self._get_array(name, fam)
+                if ar is None:
+                    del self._evictable[(name, fam)]
+                    continue
+                if self._is_referenced_elsewhere(ar) or self._is_used_by_kdtree(ar):
+                    continue
+                nbytes = ar.nbytes
+                del ar
+                del self._evictable[(name, fam)]
+                sim._evict_array(name, fam)
+                resident -= nbytes
+                logger.info("Evicted array %r%s (%.1f MB) to stay within memory budget", name,
+                            "" if fam is None else " for family " + fam.name, nbytes / 1e6)
@@ -28,6 +28,7 @@ from .. import (
     dependencytracker,
     family,
     filt,
+    instrumentation,
     simdict,
     transformation,
     units,
@@ -147,6 +148,7 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
 
         self._dependency_tracker = dependencytracker.DependencyTracker()
         self._immediate_cache_lock = threading.RLock()
+        self._memory_budget = None
 
         self._persistent_objects = {}
 
@@ -288,6 +290,8 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
         self._set_array(name, ax, index)
 
     def __delitem__(self, name):
+        if self._memory_budget is not None:
+            self._memory_budget.discard(name)
         if name in self._family_arrays:
             # mustn't have simulation-level array of this name
             assert name not in self._arrays
@@ -324,27 +328,33 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
                 if nd_name is not None:
                     self._dependency_tracker.touching(nd_name)
 
+                if self.ancestor._memory_budget is not None:
+                    self.ancestor._memory_budget.touch(nd_name or name)
+
             elif not self.lazy_off:
-                # The array is not currently in memory at the level we need it, and there is a possibility
-                # of getting it into memory using lazy derivation or loading. First, if there is a family level
-                # array by the same name, dispose of it. (Note if this is being called on a FamilySubSnap, the below
-                # has no effect, and anyway we wouldn't reach this point in the code if the family array were available.)
-                self.__resolve_obscuring_family_array(name)
-
-                # Now, we'll try to load the array...
-                if not self.lazy_load_off:
-                    # Note that we don't want this to be inside _dependency_tracker.calculating(name), because there is a
-                    # small possibility the load will be mapped into a derivation by the loader class. Specifically this
-                    # happens in ramses snapshots for the mass array (which is derived from the density array for gas cells).
-                    self.__load_if_required(name)
-
-                if name in self:
-                    # We managed to load it. Note the dependency.
-                    self._dependency_tracker.touching(name)
-                elif not self.lazy_derive_off:
-                    # Try deriving instead
-                    with self._dependency_tracker.calculating(name):
-                        self.__derive_if_required(name)
+                with instrumentation.region('lazy_get', name, sim=self):
+                    # The array is not currently in memory at the level we need it, and there is a possibility
+                    # of getting it into memory using lazy derivation or loading. First, if there is a family level
+                    # array by the same name, dispose of it. (Note if this is being called on a FamilySubSnap, the
+                    # below has no effect, and anyway we wouldn't reach this point in the code if the family array
+                    # were available.)
+                    self.__resolve_obscuring_family_array(name)
+
+                    # Now, we'll try to load the array...
+                    if not self.lazy_load_off:
+                        # Note that we don't want this to be inside _dependency_tracker.calculating(name), because
+                        # there is a small possibility the load will be mapped into a derivation by the loader class.
+                        # Specifically this happens in ramses snapshots for the mass array (which is derived from
+                        # the density array for gas cells).
+                        self.__load_if_required(name)
+
+                    if name in self:
+                        # We managed to load it. Note the dependency.
+                        self._dependency_tracker.touching(name)
+                    elif not self.lazy_derive_off:
+                        # Try deriving instead
+                        with self._dependency_tracker.calculating(name):
+                            self.__derive_if_required(name)
 
         # At this point we've done everything we can to get the array into memory. If it's still not there, we'll
         # get a KeyError from the below.
@@ -870,14 +880,15 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
             # a simulation array gets promoted mid-way through our loading process.
             #
             # see the gadget unit test, test_unit_persistence
-            if fam is not None:
-                self._load_array(array_name, fam)
-            else:
-                try:
+            with instrumentation.region('load', array_name, sim=self):
+                if fam is not None:
                     self._load_array(array_name, fam)
-                except OSError:
-                    for fam_x in self.families():
-                        self._load_array(array_name, fam_x)
+                else:
+                    try:
+                        self._load_array(array_name, fam)
+                    except OSError:
+                        for fam_x in self.families():
+                            self._load_array(array_name, fam_x)
 
             # Find out what was loaded
             new_keys = set(anc.keys()) - pre_keys
@@ -885,7 +896,7 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
             for fami in new_fam_keys:
                 new_fam_keys[fami] = new_fam_keys[fami] - pre_fam_keys[fami]
 
-            with self.lazy_off:
+            with self.lazy_off, instrumentation.region('convert_units', array_name, sim=self):
                 # If the loader hasn't given units already, try to determine the defaults
                 # Then, attempt to convert what was loaded into friendly units
                 for v in new_keys:
@@ -898,6 +909,16 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
                             anc[f][v].units = anc._default_units_for(v)
                         anc._autoconvert_array_unit(anc[f][v])
 
+        if anc._memory_budget is not None:
+            # Register what was loaded as evictable, only now that any delayed promotion of family arrays is complete
+            for v in new_keys.union(*new_fam_keys.values()):
+                v = anc._array_name_1D_to_ND(v) or v
+                if v in anc._arrays:
+                    anc._memory_budget.register(v)
+                else:
+                    for f in anc._family_arrays.get(v, {}):
+                        anc._memory_budget.register(v, f)
+
 
 
     ############################################
@@ -941,7 +962,7 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
     # WRITING FUNCTIONS
     ############################################
     def write(self, fmt=None, filename=None, **kwargs):
-        if filename is None and "<" in self.filename:
+        if filename is None and "<" in str(self.filename):
             raise RuntimeError(
                 'Cannot infer a filename; please provide one (use obj.write(filename="filename"))')
 
@@ -1074,6 +1095,9 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
         source_array._name = array_name
         source_array.family = None
 
+        if self._memory_budget is not None:
+            self._memory_budget.discard(array_name)
+
         self._arrays[array_name] = source_array
 
         if derived:
@@ -1189,6 +1213,8 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
 
     def _del_family_array(self, array_name, family):
         """Delete the array with the specified name for the specified family"""
+        if self._memory_budget is not None:
+            self._memory_budget.discard(array_name, family)
         del self._family_arrays[array_name][family]
         if len(self._family_arrays[array_name]) == 0:
             del self._family_arrays[array_name]
@@ -1520,7 +1546,7 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
         fn = self._find_deriving_function(name)
         if fn:
             logger.info("Deriving array %s" % name)
-            with self.auto_propagate_off:
+            with self.auto_propagate_off, instrumentation.region('derive', name, sim=self):
                 if fam is None:
                     result = fn(self)
                     ndim = result.shape[-1] if len(
@@ -1556,6 +1582,9 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
                 if units.has_units(result):
                     write_array.units = result.units
 
+            if self._memory_budget is not None:
+                self._memory_budget.register(name, fam if name not in self._arrays else None)
+
 
 
 
@@ -1565,6 +1594,8 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
         quantities which depend on it"""
 
         name = self._array_name_1D_to_ND(name) or name
+        if self.ancestor._memory_budget is not None:
+            self.ancestor._memory_budget.pin(name)
         if name=='pos':
             for v in self.ancestor._persistent_objects.values():
                 if 'kdtree' in v:
@@ -1618,6 +1649,47 @@ class SimSnap(ContainerWithPhysicalUnitsOption, iter_subclasses.IterableSubclass
         else:
             raise RuntimeError("Not a derived array")
 
+    def set_memory_budget(self, budget):
+        """Limit the memory used by arrays that can be reloaded from disk or re-derived on demand.
+
+        Once the total size of the snapshot's arrays exceeds the budget, the least recently used arrays that were
+        lazy-loaded or automatically derived are deleted. They are transparently reloaded or re-derived if accessed
+        again. Arrays that have been created or modified by the user, or that are in use by a KDTree or referenced
+        from elsewhere, are never deleted.
+
+        The budget applies to the whole snapshot, even if this method is called on a subsnap.
+
+        Parameters
+        ----------
+        budget : int | float | str | None
+            The budget in bytes, or a string such as ``"4 GB"``. None or 0 removes any budget.
+        """
+        from . import memory_budget
+        anc = self.ancestor
+        budget = memory_budget.parse_memory_size(budget)
+        if budget is None:
+            anc._memory_budget = None
+        elif anc._memory_budget is None:
+            anc._memory_budget = memory_budget.MemoryBudget(anc, budget)
+        else:
+            anc._memory_budget.budget = budget
+            anc._memory_budget.enforce()
+
+    def _evict_array(self, name, fam=None):
+        """Delete an array (and any 1D views of it) to free memory, on the understanding it can be recreated"""
+        if fam is None:
+            ar = self._arrays[name]
+            for name_1D in self._array_name_ND_to_1D(name):
+                if getattr(self._arrays.get(name_1D), 'base', None) is ar:
+                    del self._arrays[name_1D]
+            del self[name]
+        else:
+            ar = self._family_arrays[name][fam]
+            for name_1D in self._array_name_ND_to_1D(name):
+                if getattr(self._family_arrays.get(name_1D, {}).get(fam), 'base', None) is ar:
+                    self._del_family_array(name_1D, fam)
+            self._del_family_array(name, fam)
+
     ############################################
     # CONVENIENCE FUNCTIONS
     ############################################
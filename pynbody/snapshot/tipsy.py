@@ -34,6 +34,58 @@ from . import SimSnap, nchilada
 logger = logging.getLogger('pynbody.snapshot.tipsy')
 
 
+class _AsciiBlockReader:
+    """Reads values from a whitespace-separated ASCII file, tokenising large blocks in parallel"""
+
+    _block_bytes = 2**24
+
+    def __init__(self, f, dtype):
+        self._f = f
+        dtype = np.dtype(dtype)
+        if dtype in (np.float32, np.float64, np.int32, np.int64):
+            self._parse_dtype = dtype
+        elif issubclass(dtype.type, np.integer):
+            self._parse_dtype = np.dtype(np.int64)
+        else:
+            self._parse_dtype = np.dtype(np.float64)
+        self._values = np.empty(0, dtype=self._parse_dtype)
+        self._values_offset = 0
+        self._pending_text = b""
+        self._eof = False
+
+    def _available(self):
+        return len(self._values) - self._values_offset
+
+    def _fill(self, count):
+        while self._available() < count:
+            if self._eof:
+                raise OSError("Unexpected end of auxiliary array file")
+            text = self._f.read(self._block_bytes)
+            if len(text) == 0:
+                self._eof = True
+                text = b"\n"
+            text = self._pending_text + text
+            new_values, consumed = util.parse_ascii_numbers(text, self._parse_dtype)
+            self._pending_text = text[consumed:]
+            self._values = np.concatenate((self._values[self._values_offset:], new_values))
+            self._values_offset = 0
+
+    def read(self, count):
+        """Return the next *count* values from the file"""
+        self._fill(count)
+        result = self._values[self._values_offset:self._values_offset + count]
+        self._values_offset += count
+        return result
+
+    def skip(self, count):
+        """Discard the next *count* values from the file"""
+        while count > 0:
+            n = min(count, self._available() or 1)
+            self._fill(n)
+            self._values_offset += n
+            count -= n
+
+
 class TipsySnap(SimSnap):
     _basic_loadable_keys = {family.dm: {'phi', 'pos', 'eps', 'mass', 'vel'},
                             family.gas: {'phi', 'temp', 'pos', 'metals', 'eps',
@@ -483,18 +535,14 @@ class TipsySnap(SimSnap):
 
         max_block_size = 1024 ** 2  # particles
 
-        with self.lazy_derive_off:
+        with self.lazy_derive_off, chunk.WriteControl(max_block_size, filename) as write_control:
             for n_left, fam, dtype in file_structure:
-                n_done = 0
                 self_type = self[fam]
-                while n_left > 0:
-                    n_block = min(n_left, max_block_size)
-
-                #g = np.zeros((n_block,len(st)),dtype=np.float32)
+                for block_slice in write_control.iterate(n_left):
 
-                    g = np.empty(n_block, dtype=dtype)
+                    g = np.empty(block_slice.stop - block_slice.start, dtype=dtype)
 
-                    self_type_block = self_type[n_done:n_done + n_block]
+                    self_type_block = self_type[block_slice]
 
                     with self_type_block.immediate_mode:
                         # Copy from the correct arrays
@@ -510,10 +558,7 @@ class TipsySnap(SimSnap):
                     else:
                         g.tofile(f)
 
-                    # Increment total ptcls written, decrement ptcls left of
-                    # this type
-                    n_left -= n_block
-                    n_done += n_block
+                    write_control.record(g.nbytes)
 
         f.close()
 
@@ -521,11 +566,19 @@ class TipsySnap(SimSnap):
 
         with self.lazy_off:  # prevent any lazy reading or evaluation
 
-            for x in set(self.keys()).union(self.family_keys()):
-                if not self.is_derived_array(x) and x not in ["mass", "pos", "x", "y", "z", "vel", "vx", "vy", "vz", "rho", "temp",
-                                                              "eps", "metals", "phi", "tform"]:
-                    TipsySnap._write_array(
-                        self, x, filename=filename + "." + x, binary=binary_aux_arrays)
+            aux_arrays = [x for x in set(self.keys()).union(self.family_keys())
+                          if not self.is_derived_array(x) and
+                          x not in ["mass", "pos", "x", "y", "z", "vel", "vx", "vy", "vz", "rho", "temp",
+                                    "eps", "metals", "phi", "tform"]]
+
+            # each auxiliary array goes to its own file, so they can be written in parallel
+            write_aux = lambda x: TipsySnap._write_array(self, x, filename=filename + "." + x,
+                                                         binary=binary_aux_arrays)
+            for i0 in range(0, len(aux_arrays), config['number_of_threads']):
+                util.thread_map(write_aux, aux_arrays[i0:i0 + config['number_of_threads']])
+
+        if isinstance(self, TipsySnap):
+            self._update_loadable_keys()
 
 
     @staticmethod
@@ -536,36 +589,33 @@ class TipsySnap(SimSnap):
             return np.float32
 
     @staticmethod
-    def __write_block(f, ar, binary, byteswap):
-
-        ar = np.asarray(ar, dtype=TipsySnap.__get_write_dtype(ar.dtype))
-        if binary:
-            if byteswap:
-                ar.byteswap().tofile(f)
-            else:
-                ar.tofile(f)
+    def __write_block(f, ar, binary, byteswap, write_control):
 
+        write_dtype = TipsySnap.__get_write_dtype(ar.dtype)
+        if issubclass(write_dtype, np.integer):
+            fmt = "%d"
         else:
-            if issubclass(ar.dtype.type, np.integer):
-                fmt = "%d"
-            else:
-                fmt = "%e"
-            np.savetxt(f, ar, fmt=fmt)
+            fmt = "%e"
 
-    def _get_loadable_array_metadata(self, array_name):
-        """Given an array name, returns the metadata consisting of
-        the tuple units, families.
-
-        Returns:
-         *units*: the units of this data on disk
-         *families*: a list of family objects for which data is on disk
-                     for this array, or None if this cannot be determined"""
+        # convert and write in chunks, so that no full-size temporary copy is required
+        for sl in write_control.iterate(len(ar)):
+            block = np.asarray(ar[sl], dtype=write_dtype)
+            if binary:
+                if byteswap:
+                    block.byteswap().tofile(f)
+                else:
+                    block.tofile(f)
+            else:
+                np.savetxt(f, block, fmt=fmt)
+            write_control.record(block.nbytes)
 
+    def _read_array_metafile(self, array_name):
+        """Return the key/value pairs stored in the .pynbody-meta file for the named array, or None if there is none"""
         try:
             with open(self.filename + "." + array_name + ".pynbody-meta") as f:
                 lines = f.readlines()
         except OSError:
-            return self._default_units_for(array_name), None, None
+            return None
 
         res = {}
         for l in lines:
@@ -575,6 +625,21 @@ class TipsySnap(SimSnap):
             if len(X) == 2:
                 res[X[0].strip()] = X[1].strip()
 
+        return res
+
+    def _get_loadable_array_metadata(self, array_name):
+        """Given an array name, returns the metadata consisting of
+        the tuple units, families.
+
+        Returns:
+         *units*: the units of this data on disk
+         *families*: a list of family objects for which data is on disk
+                     for this array, or None if this cannot be determined"""
+
+        res = self._read_array_metafile(array_name)
+        if res is None:
+            return self._default_units_for(array_name), None, None
+
         try:
             u = units.Unit(res['units'])
         except Exception:
@@ -592,8 +657,84 @@ class TipsySnap(SimSnap):
 
         return u, fams, dtype
 
+    def _get_aux_array_format(self, array_name, filename, reprobe=False):
+        """Return the storage format of an auxiliary array file as a tuple (binary, dtype).
+
+        *binary* is True for a tipsy binary file and False for an ASCII file; *dtype* is the type
+        that the contents would be read as in the absence of any other information. The result is
+        cached in the .pynbody-meta file (creating it if necessary and possible) so that the file
+        need not be inspected again. If *reprobe* is True, any cached information is ignored and replaced."""
+
+        res = self._read_array_metafile(array_name)
+        cached = None
+        if res is not None and 'format' in res:
+            try:
+                storage, dtype = res['format'].split()
+                cached = storage == 'binary', np.dtype(dtype)
+            except (ValueError, TypeError):
+                pass
+
+        if cached is not None and not reprobe:
+            return cached
+
+        binary, dtype = self._probe_aux_array_format(array_name, filename)
+        if cached == (binary, dtype):
+            return cached
+
+        try:
+            self._record_aux_array_format(array_name, res, binary, dtype)
+        except OSError:
+            logger.debug("Unable to record format of auxiliary array %s", array_name)
+
+        return binary, dtype
+
+    def _probe_aux_array_format(self, array_name, filename):
+        with util.open_(filename, 'rb') as f:
+            try:
+                int(f.readline())
+                binary = False
+            except ValueError:
+                binary = True
+
+            if binary:
+                int_arrays = list(map(
+                    str.strip, config_parser.get('tipsy', 'binary-int-arrays').split(",")))
+                if array_name in int_arrays:
+                    dtype = np.dtype('i')
+                else:
+                    dtype = np.dtype('f')
+            else:
+                # Inspect the first non-zero line to see whether it's float or int
+                l = b"0\n"
+                while l.strip() == b"0":
+                    l = f.readline()
+                l = l.strip()
+                if b"." in l or b"e" in l or b"inf" in l or b"nan" in l:
+                    dtype = np.dtype(float)
+                else:
+                    dtype = np.dtype(int)
+
+        return binary, dtype
+
+    def _record_aux_array_format(self, array_name, metadata, binary, dtype):
+        meta_filename = self.filename + "." + array_name + ".pynbody-meta"
+        format_line = "format: %s %s" % ("binary" if binary else "ascii", np.dtype(dtype).name)
+        if metadata is not None:
+            with open(meta_filename, "a") as f:
+                print(format_line, file=f)
+        else:
+            # create a metadata file which is equivalent to having no metadata file, apart from
+            # the cached format information
+            units_out = self._default_units_for(array_name)
+            with open(meta_filename, "w") as f:
+                print("# This file automatically created by pynbody", file=f)
+                if units_out is not None and not hasattr(units_out, "_no_unit"):
+                    print("units:", units_out, file=f)
+                print("families:", " ".join(x.name for x in (family.gas, family.dm, family.star)), file=f)
+                print(format_line, file=f)
+
     @staticmethod
-    def _write_array_metafile(self, filename, units, families, dtype):
+    def _write_array_metafile(self, filename, units, families, dtype, binary=None, stored_dtype=None):
 
         with open(filename + ".pynbody-meta", "w") as f:
             print("# This file automatically created by pynbody", file=f)
@@ -605,6 +746,15 @@ class TipsySnap(SimSnap):
             print(file=f)
             if dtype is not None:
                 print("dtype:", TipsySnap.__get_write_dtype(dtype), file=f)
+            if binary is not None and stored_dtype is not None:
+                # record how the file should be read back, so that it need not be probed
+                if binary:
+                    read_dtype = np.dtype(TipsySnap.__get_write_dtype(stored_dtype))
+                elif issubclass(stored_dtype.type, np.integer):
+                    read_dtype = np.dtype(int)
+                else:
+                    read_dtype = np.dtype(float)
+                print("format:", "binary" if binary else "ascii", read_dtype.name, file=f)
 
         if isinstance(self, TipsySnap):
             # update the loadable keys if this operation is likely to have
@@ -712,35 +862,37 @@ class TipsySnap(SimSnap):
                 fhand = util.open_(filename, 'wb')
                 fhand.write((str(len(self)) + '\n').encode('utf-8'))
 
-            if contents is None:
-                if array_name in self.family_keys():
-                    for f in [family.gas, family.dm, family.star]:
-                        try:
-                            dtype = self[f][array_name].dtype
-                            ar = self[f][array_name]
-                            units_out = ar.units
+            with chunk.WriteControl(description=filename) as write_control:
+                if contents is None:
+                    if array_name in self.family_keys():
+                        for f in [family.gas, family.dm, family.star]:
+                            try:
+                                dtype = self[f][array_name].dtype
+                                ar = self[f][array_name]
+                                units_out = ar.units
 
-                        except KeyError:
-                            ar = np.zeros(len(self[f]), dtype=int)
+                            except KeyError:
+                                ar = np.zeros(len(self[f]), dtype=int)
 
-                        TipsySnap.__write_block(fhand, ar, binary, byteswap)
+                            TipsySnap.__write_block(fhand, ar, binary, byteswap, write_control)
 
-                else:
-                    ar = self[array_name]
-                    dtype = self[array_name].dtype
-                    units_out = ar.units
-                    TipsySnap.__write_block(fhand, ar, binary, byteswap)
+                    else:
+                        ar = self[array_name]
+                        dtype = self[array_name].dtype
+                        units_out = ar.units
+                        TipsySnap.__write_block(fhand, ar, binary, byteswap, write_control)
 
-            else:
-                TipsySnap.__write_block(fhand, contents, binary, byteswap)
-                units_out = contents.units
+                else:
+                    TipsySnap.__write_block(fhand, contents, binary, byteswap, write_control)
+                    units_out = contents.units
 
         fhand.close()
 
         if fam is None:
             fam = [family.gas, family.dm, family.star]
 
-        TipsySnap._write_array_metafile(self, filename, units_out, fam, dtype)
+        TipsySnap._write_array_metafile(self, filename, units_out, fam, dtype, binary,
+                                        dtype if contents is None else contents.dtype)
 
     def _load_array(self, array_name, fam=None, filename=None,
                     packed_vector=None):
@@ -793,14 +945,11 @@ class TipsySnap(SimSnap):
             except OSError:
                 pass
 
-        # N.B. this code is a bit inefficient for loading
-        # family-specific arrays, because it reads in the whole array
-        # then slices it.  But of course the memory is only wasted
-        # while still inside this routine, so it's only really the
-        # wasted time that's a problem.
-
         # determine whether the array exists in a file
 
+        # the format of the file is cached in the metadata only for arrays at the standard location
+        cache_format = filename is None
+
         if filename is None:
             if self._filename[-3:] == '.gz':
                 filename = self._filename[:-3] + "." + array_name
@@ -815,35 +964,49 @@ class TipsySnap(SimSnap):
         if dtype is None:
             dtype = self._get_preferred_dtype(array_name)
 
+        all_fam = [family.dm, family.gas, family.star]
+        if fam is None:
+            fam = all_fam
+
         try:
-            f = util.open_(filename, 'r')
-            l = int(f.readline())
-            binary = False
-            if l != self._load_control.disk_num_particles:
-                raise OSError("Incorrect file format")
+            binary, r = self.__read_aux_file(array_name, filename, fam, all_fam, dtype, cache_format)
+        except OSError:
+            if not cache_format:
+                raise
+            # the cached format may be out of date if the file has been replaced; check again
+            binary, r = self.__read_aux_file(array_name, filename, fam, all_fam, dtype, cache_format,
+                                             reprobe=True)
 
-            if not dtype:
-                # Inspect the first line to see whether it's float or int
-                l = "0\n"
-                while l == "0\n":
-                    l = f.readline()
-                if "." in l or "e" in l or l[:-1] == "inf":
-                    dtype = float
-                else:
-                    dtype = int
+        self.ancestor._tipsy_arrays_binary = binary
 
-                # Restart at head of file
-                f.seek(0)
-                f.readline()
+        if units is not None:
+            r.units = units
 
-            loadblock = lambda count: np.fromfile(
-                f, dtype=dtype, sep="\n", count=count)
-            # data = np.fromfile(f, dtype=tp, sep="\n")
-        except ValueError:
-            f.close()
-            # this is probably a binary file
-            binary = True
-            f = util.open_(filename, 'rb')
+        return r
+
+    def __read_aux_file(self, array_name, filename, fam, all_fam, dtype, cache_format, reprobe=False):
+        if cache_format:
+            binary, format_dtype = self._get_aux_array_format(array_name, filename, reprobe)
+        else:
+            binary, format_dtype = self._probe_aux_array_format(array_name, filename)
+        if not dtype:
+            dtype = format_dtype
+
+        if fam is all_fam:
+            r = np.empty(len(self), dtype=dtype).view(array.SimArray)
+        else:
+            r = np.empty(len(self[fam]), dtype=dtype).view(array.SimArray)
+
+        if binary:
+            self.__read_binary_array(filename, r, all_fam, fam)
+        else:
+            self.__read_ascii_array(filename, r, all_fam, fam)
+
+        return binary, r
+
+    def __read_binary_array(self, filename, r, all_fam, fam):
+        """Read a TIPSY-BINARY auxiliary file into r, seeking directly to the data for the requested families"""
+        with util.open_(filename, 'rb') as f:
             # Read header and check endianness
             if self._byteswap:
                 l = struct.unpack(">i", f.read(4))[0]
@@ -853,47 +1016,60 @@ class TipsySnap(SimSnap):
             if l != self._load_control.disk_num_particles:
                 raise OSError("Incorrect file format")
 
-            if dtype is None:
-                # Set data format to be read (float or int) based on config
-                int_arrays = list(map(
-                    str.strip, config_parser.get('tipsy', 'binary-int-arrays').split(",")))
-                if array_name in int_arrays:
-                    dtype = 'i'
-                else:
-                    dtype = 'f'
-
-            # Read longest data array possible.
-            # Assume byteswap since most will be.
+            # Binary auxiliary files are always written as 4-byte values
+            disk_dtype = np.dtype('i4' if issubclass(r.dtype.type, np.integer) else 'f4')
             if self._byteswap:
-                loadblock = lambda count: np.frombuffer(
-                    f.read(count * 4), dtype=dtype, count=count).byteswap()
-                # data = np.fromstring(f.read(3*len(self)*4),dtype).byteswap()
+                disk_dtype = disk_dtype.newbyteorder('>')
             else:
-                loadblock = lambda count: np.frombuffer(
-                    f.read(count * 4), dtype=dtype, count=count)
-                # data = np.fromstring(f.read(3*len(self)*4),dtype)
+                disk_dtype = disk_dtype.newbyteorder('=')
+
+            if not self.partial_load:
+                # Simple case: each family occupies a contiguous byte range which can be read directly
+                mem_offset = 0
+                for fam_i in sorted(fam, key=lambda x: self._load_control.mem_family_slice[x].start):
+                    disk_sl = self._load_control.mem_family_slice[fam_i]
+                    if fam is all_fam:
+                        mem_sl = disk_sl
+                    else:
+                        mem_sl = slice(mem_offset, mem_offset + disk_sl.stop - disk_sl.start)
+                        mem_offset = mem_sl.stop
+                    f.seek(4 + disk_dtype.itemsize * disk_sl.start)
+                    r[mem_sl] = self.__read_binary_block(f, disk_dtype, disk_sl.stop - disk_sl.start)
+                return
 
-        self.ancestor._tipsy_arrays_binary = binary
+            for readlen, buf_index, mem_index in self._load_control.iterate(all_fam, fam, multiskip=True):
+                if mem_index is None:
+                    f.seek(disk_dtype.itemsize * readlen, 1)
+                else:
+                    buf = self.__read_binary_block(f, disk_dtype, readlen)
+                    r[mem_index] = buf[buf_index]
 
-        all_fam = [family.dm, family.gas, family.star]
-        if fam is None:
-            fam = all_fam
-            r = np.empty(len(self), dtype=dtype).view(array.SimArray)
-        else:
-            r = np.empty(len(self[fam]), dtype=dtype).view(array.SimArray)
+    @staticmethod
+    def __read_binary_block(f, disk_dtype, count):
+        buf = f.read(disk_dtype.itemsize * count)
+        if len(buf) != disk_dtype.itemsize * count:
+            raise OSError("Unexpected end of auxiliary array file")
+        return np.frombuffer(buf, dtype=disk_dtype)
+
+    def __read_ascii_array(self, filename, r, all_fam, fam):
+        """Read a TIPSY-ASCII auxiliary file into r, using a parallel tokeniser on large blocks of the file"""
+        with util.open_(filename, 'rb') as f:
+            try:
+                l = int(f.readline())
+            except ValueError:
+                raise OSError("Incorrect file format")
 
-        try:
-            for readlen, buf_index, mem_index in self._load_control.iterate(all_fam, fam):
-                buf = loadblock(readlen)
-                if mem_index is not None:
-                    r[mem_index] = buf[buf_index]
-        finally:
-            f.close()
+            if l != self._load_control.disk_num_particles:
+                raise OSError("Incorrect file format")
 
-        if units is not None:
-            r.units = units
+            reader = _AsciiBlockReader(f, r.dtype)
 
-        return r
+            for readlen, buf_index, mem_index in self._load_control.iterate(all_fam, fam, multiskip=True):
+                if mem_index is None:
+                    reader.skip(readlen)
+                else:
+                    buf = reader.read(readlen)
+                    r[mem_index] = buf[buf_index]
 
     def read_starlog(self, fam=None):
         """Read a TIPSY-starlog file."""
@@ -0,0 +1,540 @@
+"""Rendering sequences of SPH images along a camera path, e.g. to make movies.
+
+Rendering a movie by calling :func:`pynbody.plot.sph.image` once per frame repeats a lot of work: transformations
+are applied to (and then reverted from) the whole snapshot, a new render pipeline is constructed, and every particle
+is passed to the renderer even though most lie outside the field of view. The :class:`FrameSequenceRenderer` in this
+module instead:
+
+* loads the required arrays (positions, smoothing lengths, densities, masses and the quantity to be rendered) from
+  the snapshot once, without modifying the snapshot itself;
+* selects the particles that may contribute to a frame, with a margin around the field of view, and copies them into
+  a working buffer expressed in the camera frame of that frame. Subsequent frames whose field of view lies within the
+  margin reuse the same selection, applying only the camera motion relative to the reference frame (or only a
+  translation, if the camera has not rotated);
+* reuses a single render pipeline for as long as the selection is unchanged, updating its width and camera position
+  for each frame;
+* optionally renders frames in parallel across worker processes, which share the loaded input arrays, streaming each
+  frame to disk as soon as it is complete.
+
+The path of the camera is described by a :class:`CameraPath`, which can be interpolated between keyframes or generated
+for a simple orbit. For example, to render a 200-frame orbit around a galaxy:
+
+>>> import pynbody
+>>> from pynbody.sph import animation
+>>> f = pynbody.load('testdata/gasoline_ahf/g15784.lr.01024')
+>>> pynbody.analysis.faceon(f.halos()[1])
+>>> path = animation.CameraPath.orbit(centre=[0, 0, 0], width=30.0, n_frames=200, axis='x')
+>>> renderer = animation.FrameSequenceRenderer(f.g, path, quantity='rho', out_units='Msol kpc^-2')
+>>> renderer.render_to_files('frames/frame_{:04d}.png', vmin=1e5, vmax=1e9)
+
+Note that periodic wrapping is not applied to the images, since the camera frame is not in general aligned with the
+simulation box.
+"""
+
+from __future__ import annotations
+
+import logging
+import multiprocessing
+import os
+from types import NoneType
+
+import numpy as np
+import scipy.spatial.transform
+
+from .. import array as array_module, config, snapshot, units
+from . import kernels, renderers
+
+logger = logging.getLogger('pynbody.sph.animation')
+
+
+class CameraPath:
+    """A sequence of camera positions, orientations, widths and (optionally) perspective distances.
+
+    Each frame is specified by a centre, a rotation matrix, an image width and a camera distance. A particle at
+    position *p* in the simulation appears at position ``rotation @ (p - centre)`` in the camera frame, i.e. the rows
+    of the rotation matrix are the image x and y axes and the direction towards the viewer. This is the same
+    convention as :meth:`pynbody.snapshot.simsnap.SimSnap.rotate`. All lengths are in the position units of the
+    snapshot being rendered."""
+
+    def __init__(self, centres, rotations=None, widths=10.0, z_cameras=None):
+        """Create a camera path from per-frame arrays.
+
+        Parameters
+        ----------
+
+        centres : array_like
+            The centre of each frame, with shape (n_frames, 3).
+
+        rotations : array_like, optional
+            The orientation of each frame, as rotation matrices with shape (n_frames, 3, 3). If None, the camera
+            looks down the simulation z axis in every frame.
+
+        widths : float or array_like, optional
+            The width of each frame, or a single width for all frames.
+
+        z_cameras : float or array_like, optional
+            The distance of the camera from the centre for perspective rendering, for each frame or for all frames.
+            If None (default), the frames are rendered without perspective. See
+            :meth:`~pynbody.sph.renderers.ImageGeometry.set_camera_z`.
+        """
+        self.centres = np.atleast_2d(np.asarray(centres, dtype=np.float64))
+        n_frames = len(self.centres)
+        if rotations is None:
+            rotations = np.broadcast_to(np.eye(3), (n_frames, 3, 3))
+        self.rotations = np.array(rotations, dtype=np.float64).reshape((n_frames, 3, 3))
+        self.widths = np.array(np.broadcast_to(np.asarray(widths, dtype=np.float64), (n_frames,)))
+        if z_cameras is None:
+            self.z_cameras = None
+        else:
+            self.z_cameras = np.array(np.broadcast_to(np.asarray(z_cameras, dtype=np.float64), (n_frames,)))
+
+        if self.centres.shape != (n_frames, 3):
+            raise ValueError("Camera centres must have shape (n_frames, 3)")
+
+    @classmethod
+    def from_keyframes(cls, times, centres, rotations, widths, n_frames, z_cameras=None):
+        """Create a camera path by interpolating between keyframes.
+
+        Centres and camera distances are interpolated linearly, widths logarithmically (so that zooms proceed at a
+        constant rate) and orientations by spherical linear interpolation.
+
+        Parameters
+        ----------
+
+        times : array_like
+            The times of the keyframes, which must be increasing. The frames are evenly spaced in time between the
+            first and last keyframe, inclusive.
+
+        centres : array_like
+            The centre at each keyframe, with shape (n_keyframes, 3).
+
+        rotations : array_like
+            The rotation matrix at each keyframe, with shape (n_keyframes, 3, 3).
+
+        widths : array_like
+            The image width at each keyframe.
+
+        n_frames : int
+            The number of frames to generate.
+
+        z_cameras : array_like, optional
+            The camera distance at each keyframe, for perspective rendering.
+        """
+        times = np.asarray(times, dtype=np.float64)
+        frame_times = np.linspace(times[0], times[-1], n_frames)
+        centres = np.asarray(centres, dtype=np.float64)
+
+        frame_centres = np.stack([np.interp(frame_times, times, centres[:, i]) for i in range(3)], axis=-1)
+        frame_widths = np.exp(np.interp(frame_times, times, np.log(np.asarray(widths, dtype=np.float64))))
+        slerp = scipy.spatial.transform.Slerp(times, scipy.spatial.transform.Rotation.from_matrix(rotations))
+        frame_rotations = slerp(frame_times).as_matrix()
+        if z_cameras is not None:
+            z_cameras = np.interp(frame_times, times, z_cameras)
+
+        return cls(frame_centres, frame_rotations, frame_widths, z_cameras)
+
+    @classmethod
+    def orbit(cls, centre, width, n_frames, axis='y', angle=360.0, rotation=None, z_camera=None):
+        """Create a camera path in which the scene rotates about an axis through a fixed centre.
+
+        Parameters
+        ----------
+
+        centre : array_like
+            The centre of rotation, which is also the centre of every frame.
+
+        width : float
+            The width of every frame.
+
+        n_frames : int
+            The number of frames.
+
+        axis : str or array_like, optional
+            The axis of rotation, either 'x', 'y', 'z' or a vector in simulation coordinates. Default is 'y'.
+
+        angle : float, optional
+            The total angle, in degrees, through which the scene rotates. Frame *i* is rotated by
+            ``angle * i / n_frames``, so that a full orbit of 360 degrees loops seamlessly. Default is 360.
+
+        rotation : array_like, optional
+            The orientation of the first frame, as a rotation matrix. Default is to look down the z axis.
+
+        z_camera : float, optional
+            The camera distance for perspective rendering.
+        """
+        if isinstance(axis, str):
+            axis = np.eye(3)['xyz'.index(axis)]
+        axis = np.asarray(axis, dtype=np.float64)
+        axis = axis / np.linalg.norm(axis)
+
+        if rotation is None:
+            rotation = np.eye(3)
+
+        angles = np.radians(angle) * np.arange(n_frames) / n_frames
+        spins = scipy.spatial.transform.Rotation.from_rotvec(angles[:, np.newaxis] * axis).as_matrix()
+        rotations = np.asarray(rotation) @ spins
+        centres = np.broadcast_to(np.asarray(centre, dtype=np.float64), (n_frames, 3))
+
+        return cls(centres, rotations, width, z_camera)
+
+    def __len__(self):
+        return len(self.centres)
+
+    def __getitem__(self, i):
+        """Return the centre, rotation, width and camera distance (or None) of frame *i*"""
+        z_camera = None if self.z_cameras is None else float(self.z_cameras[i])
+        return self.centres[i], self.rotations[i], float(self.widths[i]), z_camera
+
+
+def _iter_renderers(renderer):
+    yield renderer
+    for r in getattr(renderer, '_subrenderers', []):
+        yield from _iter_renderers(r)
+
+
+def _set_frame_geometry(renderer, width, z_camera, restrict_depth):
+    """Update the width and camera distance of every stage of a render pipeline, preserving aspect ratios"""
+    geometries = {}
+    for r in _iter_renderers(renderer):
+        g = r._geometry
+        if isinstance(g, renderers.ReadOnlyGeometry):
+            g = g._geometry
+        geometries[id(g)] = g
+
+    for g in geometries.values():
+        g.set_width(width)
+        g.y1 *= g.ny / g.nx
+        g.y2 *= g.ny / g.nx
+        if restrict_depth:
+            g.restrict_z_range()
+        g.set_camera_z(z_camera)
+
+
+_worker_renderer = None
+
+
+def _render_frames_in_worker(args):
+    start, stop, filename_pattern, image_kwargs = args
+    _worker_renderer._reset_working_buffer()
+    return _worker_renderer._render_frames_to_files(start, stop, filename_pattern, **image_kwargs)
+
+
+class FrameSequenceRenderer:
+    """Renders a sequence of SPH images of a snapshot along a :class:`CameraPath`.
+
+    For an overview, see the documentation for the :mod:`pynbody.sph.animation` module."""
+
+    def __init__(self, sim: snapshot.SimSnap, camera_path: CameraPath, /,
+                 quantity: str | np.ndarray = 'rho',
+                 resolution: int | NoneType = None,
+                 nx: int | NoneType = None, ny: int | NoneType = None,
+                 out_units: str | units.UnitBase | NoneType = None,
+                 weight: bool | str | np.ndarray | NoneType = None,
+                 restrict_depth: bool = False,
+                 kernel: NoneType | str | kernels.KernelBase = None,
+                 smooth_floor: float = 0.0,
+                 threaded: bool | NoneType = None,
+                 approximate_fast: bool | NoneType = None,
+                 denoise: bool | NoneType = None,
+                 margin: float = 0.25):
+        """Prepare to render a sequence of images.
+
+        The arrays required for rendering are loaded (or derived) from the snapshot immediately.
+
+        Parameters
+        ----------
+
+        sim : snapshot.SimSnap
+            The simulation snapshot to be rendered. This is not modified.
+
+        camera_path : CameraPath
+            The path of the camera.
+
+        margin : float, optional
+            The margin around the field of view, as a fraction of the image width, within which particles are
+            selected for the working buffer. Larger margins mean the selection is reused for more frames, at the
+            cost of rendering more particles that lie outside the image. Default is 0.25.
+
+        Other parameters are as for :func:`~pynbody.sph.renderers.make_render_pipeline`. Widths and camera
+        distances are taken from the camera path.
+        """
+        self._sim = sim
+        self._camera_path = camera_path
+        self._margin = margin
+        self._restrict_depth = restrict_depth
+
+        if resolution is None:
+            resolution = config['image-default-resolution']
+        self._nx = resolution if nx is None else nx
+        self._ny = resolution if ny is None else ny
+
+        # decide on denoising by reference to the original snapshot, since the decision depends on its format
+        probe = renderers.make_render_pipeline(sim, quantity=quantity, out_units=out_units, weight=weight,
+                                               kernel=kernel, threaded=False, approximate_fast=False,
+                                               denoise=denoise)
+        denoise = any(isinstance(r, renderers.DenoisedImageRenderer) for r in _iter_renderers(probe))
+
+        self._kernel_max_d = kernels.create_kernel(kernel).max_d
+        self._smooth_floor = probe._to_position_units(smooth_floor)
+
+        self._arrays = {name: sim[name] for name in ('pos', 'smooth', 'rho', 'mass')}
+        self._quantity_name = self._load_array(quantity, 'quantity')
+        self._weight_name = weight if isinstance(weight, (bool, NoneType)) else self._load_array(weight, 'weight')
+
+        self._pipeline_kwargs = dict(quantity=self._quantity_name, nx=self._nx, ny=self._ny, resolution=self._nx,
+                                     out_units=out_units, weight=self._weight_name, restrict_depth=restrict_depth,
+                                     kernel=kernel, smooth_floor=self._smooth_floor, threaded=threaded,
+                                     approximate_fast=approximate_fast, denoise=denoise)
+
+        self._reset_working_buffer()
+
+    def _load_array(self, array, default_name):
+        if isinstance(array, str):
+            name = array
+            array = self._sim[array]
+        else:
+            name = default_name
+            if len(array) != len(self._sim):
+                raise ValueError("Arrays to be rendered must have the same length as the snapshot")
+        self._arrays[name] = array
+        return name
+
+    def __len__(self):
+        return len(self._camera_path)
+
+    def _reset_working_buffer(self):
+        self._working_snapshot = None
+        self._working_positions = None
+        self._pipeline = None
+        self._reference = None
+        self._region = None
+
+    def _view_region(self, width, z_camera):
+        """Return the half-widths in x and y, and the z range, of the region that is visible in a frame"""
+        half_x = width / 2
+        half_y = half_x * self._ny / self._nx
+        z1, z2 = (-half_x, half_x) if self._restrict_depth else (-np.inf, np.inf)
+        if z_camera:
+            # the field of view widens with distance from the camera
+            z2 = min(z2, z_camera)
+            scale = max(1.0, (z_camera - z1) / z_camera)
+            half_x *= scale
+            half_y *= scale
+        return half_x, half_y, z1, z2
+
+    def _relative_transform(self, centre, rotation):
+        """Return the rotation and translation taking the working buffer into the camera frame of a given frame"""
+        ref_centre, ref_rotation = self._reference
+        relative_rotation = rotation @ ref_rotation.T
+        relative_translation = rotation @ (ref_centre - centre)
+        return relative_rotation, relative_translation
+
+    def _region_contains_view(self, frame):
+        """Return True if the particles in the working buffer include all those that could contribute to a frame"""
+        if self._region is None:
+            return False
+
+        centre, rotation, width, z_camera = frame
+        half_x, half_y, z1, z2 = self._view_region(width, z_camera)
+        region_x, region_y, region_z1, region_z2 = self._region
+
+        if not np.isfinite(region_x):
+            # no culling was applied
+            return True
+
+        if not np.isfinite(half_x):
+            return False
+
+        relative_rotation, relative_translation = self._relative_transform(centre, rotation)
+
+        if np.isfinite(z1) and np.isfinite(z2):
+            corners = np.array([(x, y, z) for x in (-half_x, half_x) for y in (-half_y, half_y) for z in (z1, z2)])
+        else:
+            # the line of sight must be unchanged
+            if abs(relative_rotation[2, 2]) < 1.0 - 1e-9:
+                return False
+            corners = np.array([(x, y, 0.0) for x in (-half_x, half_x) for y in (-half_y, half_y)])
+
+        corners = (corners - relative_translation) @ relative_rotation
+        inside = (np.abs(corners[:, 0]) <= region_x) & (np.abs(corners[:, 1]) <= region_y)
+        if np.isfinite(z1) and np.isfinite(z2):
+            inside &= (corners[:, 2] >= region_z1) & (corners[:, 2] <= region_z2)
+        return bool(inside.all())
+
+    def _select_particles(self, frame):
+        """Fill the working buffer with the particles that could contribute to frames near the given frame"""
+        centre, rotation, width, z_camera = frame
+        half_x, half_y, z1, z2 = self._view_region(width, z_camera)
+
+        pos = (self._arrays['pos'].view(np.ndarray) - centre) @ rotation.T
+
+        if np.isfinite(half_x):
+            region = (half_x + self._margin * width, half_y + self._margin * width,
+                      z1 - self._margin * width, z2 + self._margin * width)
+            reach = self._kernel_max_d * np.maximum(self._arrays['smooth'].view(np.ndarray), self._smooth_floor)
+            selected = ((np.abs(pos[:, 0]) <= region[0] + reach) & (np.abs(pos[:, 1]) <= region[1] + reach)
+                        & (pos[:, 2] >= region[2] - reach) & (pos[:, 2] <= region[3] + reach))
+            selected = np.where(selected)[0]
+            pos = pos[selected]
+        else:
+            region = (np.inf, np.inf, -np.inf, np.inf)
+            selected = slice(None)
+
+        logger.debug("Selected %d particles for the working buffer", len(pos))
+
+        working = snapshot.new(gas=len(pos))
+        working.properties.update({k: v for k, v in self._sim.properties.items() if k != 'boxsize'})
+        for name, ar in self._arrays.items():
+            if name == 'pos':
+                working[name] = pos
+            else:
+                working[name] = ar.view(np.ndarray)[selected]
+            if getattr(ar, 'units', None) is not None:
+                working[name].units = ar.units
+
+        weight = self._weight_name
+        if isinstance(weight, str):
+            weight = working[weight]
+
+        self._working_snapshot = working
+        self._working_positions = pos
+        self._reference = (centre, rotation)
+        self._region = region
+        self._pipeline = renderers.make_render_pipeline(working, width=width, z_camera=z_camera,
+                                                        **(self._pipeline_kwargs | {'weight': weight}))
+
+    def render_frame(self, i: int) -> array_module.SimArray:
+        """Render frame *i* of the sequence and return it as a SimArray."""
+        frame = self._camera_path[i]
+        if not self._region_contains_view(frame):
+            self._select_particles(frame)
+
+        centre, rotation, width, z_camera = frame
+        relative_rotation, relative_translation = self._relative_transform(centre, rotation)
+
+        target = self._working_snapshot['pos'].view(np.ndarray)
+        if np.allclose(relative_rotation, np.eye(3), rtol=0.0, atol=1e-12):
+            np.add(self._working_positions, relative_translation, out=target)
+        else:
+            np.matmul(self._working_positions, relative_rotation.T, out=target)
+            target += relative_translation
+
+        _set_frame_geometry(self._pipeline, width, z_camera, self._restrict_depth)
+        return self._pipeline.render()
+
+    def frames(self, start: int = 0, stop: int | NoneType = None):
+        """Yield the rendered images for frames *start* to *stop* (exclusive) in turn, without retaining them."""
+        if stop is None:
+            stop = len(self)
+        for i in range(start, stop):
+            yield self.render_frame(i)
+
+    def _render_frames_to_files(self, start, stop, filename_pattern, **image_kwargs):
+        filenames = []
+        for i, image in enumerate(self.frames(start, stop), start):
+            filename = filename_pattern.format(i)
+            save_frame(image, filename, **image_kwargs)
+            filenames.append(filename)
+        return filenames
+
+    def render_to_files(self, filename_pattern: str, processes: int | NoneType = None, log: bool = True,
+                        vmin: float | NoneType = None, vmax: float | NoneType = None, cmap=None) -> list[str]:
+        """Render every frame of the sequence and write each to disk as soon as it is complete.
+
+        Parameters
+        ----------
+
+        filename_pattern : str
+            A format string for the filenames, e.g. ``'frames/frame_{:04d}.png'``, which is formatted with the
+            frame number. Frames are written as images if the extension is ``.png`` (or any other format supported
+            by matplotlib), or as numpy arrays if it is ``.npy``.
+
+        processes : int, optional
+            The number of worker processes to render frames in parallel. Workers share the arrays loaded from the
+            snapshot, and each renders a contiguous block of frames. Defaults to the ``number_of_threads``
+            configuration option; the threads (if any) are divided between the processes for rendering each frame.
+
+        Other parameters are as for :func:`save_frame`.
+
+        Returns
+        -------
+
+        list of str
+            The filenames written, in frame order.
+        """
+        global _worker_renderer
+
+        image_kwargs = dict(log=log, vmin=vmin, vmax=vmax, cmap=cmap)
+
+        if processes is None:
+            processes = config['number_of_threads']
+        processes = max(1, min(processes, len(self)))
+
+        directory = os.path.dirname(filename_pattern.format(0))
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        if processes == 1 or 'fork' not in multiprocessing.get_all_start_methods():
+            return self._render_frames_to_files(0, len(self), filename_pattern, **image_kwargs)
+
+        # several blocks per process balance the load, while keeping consecutive frames together
+        boundaries = np.linspace(0, len(self), min(len(self), 4 * processes) + 1).astype(int)
+        blocks = [(int(a), int(b), filename_pattern, image_kwargs)
+                  for a, b in zip(boundaries[:-1], boundaries[1:]) if b > a]
+
+        old_threads = config['number_of_threads']
+        _worker_renderer = self
+        try:
+            config['number_of_threads'] = max(1, old_threads // processes)
+            with multiprocessing.get_context('fork').Pool(processes) as pool:
+                filenames = pool.map(_render_frames_in_worker, blocks)
+                pool.close()
+                pool.join()
+        finally:
+            config['number_of_threads'] = old_threads
+            _worker_renderer = None
+
+        return [f for block in filenames for f in block]
+
+
+def save_frame(image, filename: str, log: bool = True, vmin: float | NoneType = None, vmax: float | NoneType = None,
+               cmap=None):
+    """Write a rendered image to disk, as a numpy array if the filename ends with ``.npy``, or otherwise as an image.
+
+    Parameters
+    ----------
+
+    image : numpy.ndarray
+        The image, as returned by a renderer.
+
+    filename : str
+        The filename to write.
+
+    log : bool, optional
+        If True (default), the image is log-scaled before being converted to colours. Ignored for ``.npy`` files.
+
+    vmin, vmax : float, optional
+        The values corresponding to the ends of the colour scale (before log scaling). If None, the range of each
+        frame is used; to avoid flickering in movies, it is best to specify both. Ignored for ``.npy`` files.
+
+    cmap : str or matplotlib.colors.Colormap, optional
+        The colour map. Ignored for ``.npy`` files.
+    """
+    image = np.asarray(image)
+    if filename.endswith('.npy'):
+        np.save(filename, image)
+        return
+
+    import matplotlib.image
+
+    if log:
+        positive = image[image > 0]
+        if vmin is None:
+            vmin = positive.min() if len(positive) else 1.0
+        if vmax is None:
+            vmax = positive.max() if len(positive) else 1.0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            image = np.log10(np.where(image > 0, image, vmin))
+        vmin, vmax = np.log10(vmin), np.log10(vmax)
+
+    matplotlib.image.imsave(filename, image, vmin=vmin, vmax=vmax, cmap=cmap, origin='lower')
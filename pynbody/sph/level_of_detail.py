@@ -0,0 +1,263 @@
+"""Level-of-detail approximation for SPH rendering, merging groups of particles into KDTree node aggregates.
+
+When an image covers a large volume, many particles may fall within a single pixel, and rendering each of them
+individually wastes time. The functions in this module walk the :class:`~pynbody.kdtree.KDTree` of the snapshot
+being rendered, and replace any node that is small compared with both the pixel size and the smoothing lengths of
+its particles by a single 'super-particle'. The super-particle carries
+
+* the summed mass of the node's particles;
+* the volume-weighted mean of the quantity being rendered, together with a density chosen such that the integral
+  of the rendered quantity is exactly conserved;
+* a position at the volume-weighted centroid of the particles;
+* an effective smoothing length, chosen such that the second moment of the super-particle's kernel matches that of
+  the particles it replaces (taking into account their spatial spread).
+
+In projected images, super-particles whose kernels are smaller than a pixel are simply deposited into the pixel
+containing them, rather than sampling their kernel at the pixel centre. This conserves the projected quantity even
+where individual particles are far smaller than a pixel (a regime in which the exact renderer is very noisy).
+
+The cost of rendering is then bounded by the number of pixels rather than the number of particles. The accuracy is
+controlled by a tolerance, which gives the maximum size of an aggregated node as a fraction of the larger of the
+pixel size and the smallest smoothing length in the node.
+
+Users should not normally need to use this module directly; instead pass ``level_of_detail`` to
+:func:`pynbody.plot.sph.image` or :func:`pynbody.sph.renderers.make_render_pipeline`, or call
+:meth:`~pynbody.sph.renderers.ImageRendererBase.set_level_of_detail` on a renderer.
+"""
+
+from __future__ import annotations
+
+import functools
+import logging
+
+import numpy as np
+import scipy.integrate as integrate
+
+logger = logging.getLogger('pynbody.sph.level_of_detail')
+
+
+def _array_identity(a):
+    """Return a tuple identifying the memory viewed by an array, which remains the same for every view of the
+    same data (e.g. as returned by repeatedly accessing an array of a family sub-snapshot)"""
+    root = a
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+    return id(root), a.__array_interface__['data'][0], a.shape, a.strides, a.dtype
+
+
+@functools.lru_cache
+def kernel_variance(kernel_class):
+    """Return the variance along each axis of the given 3D kernel class, for unit smoothing length"""
+    kernel = kernel_class()
+    norm = integrate.quad(lambda r: kernel.get_value(r) * r ** 2, 0, kernel.max_d)[0]
+    second_moment = integrate.quad(lambda r: kernel.get_value(r) * r ** 4, 0, kernel.max_d)[0]
+    return second_moment / (3 * norm)
+
+
+class NodeMoments:
+    """Sums over the particles in every node of a KDTree, from which super-particles can be constructed."""
+
+    _quantity_cache_size = 4
+
+    def __init__(self, kdtree, x, y, z, mass, rho, smooth):
+        """Calculate the moments for the given KDTree and (particle-ordered) arrays"""
+        self._source_arrays = [_array_identity(a) for a in (x, y, z, mass, rho, smooth)]
+        self._quantity_cache = {}
+
+        nodes = kdtree.kdnodes
+        self.particle_offsets = kdtree.particle_offsets
+        self.leaf = nodes['iDim'] == -1
+        self.p_lower = nodes['pLower']
+        self.p_upper = nodes['pUpper']
+        self.bound_min = nodes['bnd']['fMin'].astype(np.float64)
+        self.bound_max = nodes['bnd']['fMax'].astype(np.float64)
+        self.count = self.p_upper - self.p_lower + 1
+
+        leaves = np.nonzero(self.leaf)[0]
+        self._leaves = leaves[np.argsort(self.p_lower[leaves])]
+        self._num_split = len(nodes) // 2
+
+        mass, rho, smooth = (np.asarray(a, dtype=np.float64) for a in (mass, rho, smooth))
+        volume = mass / rho
+
+        self.mass = self.sum(mass)
+        self.volume = self.sum(volume)
+        self.centroid = np.empty((len(nodes), 3))
+        self.variance = np.empty((len(nodes), 3))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for axis, coordinate in enumerate((x, y, z)):
+                coordinate = np.asarray(coordinate, dtype=np.float64)
+                self.centroid[:, axis] = self.sum(volume * coordinate) / self.volume
+                self.variance[:, axis] = (self.sum(volume * coordinate ** 2) / self.volume
+                                          - self.centroid[:, axis] ** 2)
+            self.mean_smooth_squared = self.sum(volume * smooth ** 2) / self.volume
+
+        # guard against rounding errors in the variance, which cannot exceed that of a uniform box
+        np.clip(self.variance, 0, ((self.bound_max - self.bound_min) / 2) ** 2, out=self.variance)
+
+        self.smooth_min = self.sum(smooth, np.minimum)
+        self.smooth_max = self.sum(smooth, np.maximum)
+
+    def quantity_volume_sum(self, quantity, mass, rho):
+        """Return the sum over each node of the given quantity multiplied by the particle volume.
+
+        The most recent results are cached, so that repeated renders of the same quantity (e.g. from different
+        viewpoints) need not visit every particle."""
+        identity = _array_identity(quantity)
+        if identity not in self._quantity_cache:
+            quantity_volume = np.asarray(quantity, dtype=np.float64) * np.asarray(mass) / np.asarray(rho)
+            quantity_volume[np.isnan(quantity_volume)] = 0.0
+            if len(self._quantity_cache) >= self._quantity_cache_size:
+                del self._quantity_cache[next(iter(self._quantity_cache))]
+            self._quantity_cache[identity] = self.sum(quantity_volume)
+        return self._quantity_cache[identity]
+
+    def is_valid_for(self, *arrays):
+        """Return True if the moments were calculated from exactly the given arrays"""
+        return all(identity == _array_identity(a) for identity, a in zip(self._source_arrays, arrays))
+
+    def sum(self, values, ufunc=np.add):
+        """Reduce the given particle-ordered values over every node, by default by summing them"""
+        result = np.zeros(len(self.leaf), dtype=np.float64)
+        tree_ordered = values[self.particle_offsets]
+        result[self._leaves] = ufunc.reduceat(tree_ordered, self.p_lower[self._leaves])
+
+        level_start = self._num_split // 2
+        while level_start >= 1:
+            index = np.arange(level_start, 2 * level_start)
+            index = index[~self.leaf[index]]
+            result[index] = ufunc(result[2 * index], result[2 * index + 1])
+            level_start //= 2
+        return result
+
+
+def get_node_moments(kdtree, x, y, z, mass, rho, smooth):
+    """Return the :class:`NodeMoments` for the given tree and arrays, calculating them only if necessary"""
+    moments = getattr(kdtree, '_level_of_detail_moments', None)
+    if moments is None or not moments.is_valid_for(x, y, z, mass, rho, smooth):
+        logger.info("Calculating KDTree node moments for level-of-detail rendering")
+        moments = NodeMoments(kdtree, x, y, z, mass, rho, smooth)
+        kdtree._level_of_detail_moments = moments
+    return moments
+
+
+def select_nodes(moments, geometry, tolerance, kernel_max_d, smooth_range, smooth_floor, projected, z_plane,
+                 culling):
+    """Walk the tree, returning the nodes to be rendered as super-particles and the indices of the particles to be
+    rendered individually.
+
+    Parameters
+    ----------
+    moments : NodeMoments
+        The moments of the tree to walk
+    geometry : ImageGeometry
+        The geometry of the image
+    tolerance : float
+        The maximum size of a node that may be aggregated, as a fraction of the larger of the pixel size and the
+        minimum smoothing length within the node
+    kernel_max_d : float
+        The extent of the kernel in units of the smoothing length
+    smooth_range : tuple
+        The minimum and maximum smoothing lengths to be rendered, in units of the pixel size. Nodes are aggregated
+        only if all or none of their particles fall in this range; in the latter case, they are discarded.
+    smooth_floor : float
+        The minimum smoothing length to be applied to all particles
+    projected : bool
+        Whether the image is projected, in which case only the extent of nodes in x and y is considered
+    z_plane : float or None
+        The z coordinate of the slice being rendered, or None if the image integrates along z (i.e. a projection or
+        a 3D grid)
+    culling : bool
+        Whether nodes lying entirely outside the image may be discarded (not possible for periodic images)
+    """
+    pixel_size = (geometry.x2 - geometry.x1) / geometry.nx
+    z_camera = geometry.z_camera or 0.0
+    axes = [0, 1] if projected else [0, 1, 2]
+
+    accepted = []
+    expanded_leaves = []
+    active = np.array([1])
+
+    while len(active) > 0:
+        lo, hi = moments.bound_min[active], moments.bound_max[active]
+        smooth_min = np.maximum(moments.smooth_min[active], smooth_floor)
+        smooth_max = np.maximum(moments.smooth_max[active], smooth_floor)
+
+        if z_camera != 0.0:
+            # pixels are smallest at the point of the node nearest the camera
+            depth = z_camera - (hi[:, 2] if z_camera > 0 else lo[:, 2])
+            local_pixel_size = pixel_size * depth / z_camera
+        else:
+            local_pixel_size = np.full(len(active), pixel_size)
+
+        keep = moments.count[active] > 0
+        if culling and z_camera == 0.0:
+            reach = kernel_max_d * smooth_max
+            keep &= (hi[:, 0] > geometry.x1 - reach) & (lo[:, 0] < geometry.x2 + reach)
+            keep &= (hi[:, 1] > geometry.y1 - reach) & (lo[:, 1] < geometry.y2 + reach)
+            if z_plane is not None:
+                keep &= (hi[:, 2] > z_plane - reach) & (lo[:, 2] < z_plane + reach)
+        keep &= (hi[:, 2] >= geometry.z1) & (lo[:, 2] <= geometry.z2)
+        keep &= smooth_max >= local_pixel_size * smooth_range[0]
+        keep &= smooth_min <= local_pixel_size * smooth_range[1]
+
+        extent = (hi - lo)[:, axes].max(axis=1)
+        accept = (extent <= tolerance * np.maximum(local_pixel_size, smooth_min)) & (local_pixel_size > 0)
+        if z_plane is not None:
+            # in a slice, the kernel is sampled along z on the scale of the smoothing length, not the pixel size
+            accept &= (hi[:, 2] - lo[:, 2]) <= tolerance * smooth_min
+        accept &= (lo[:, 2] >= geometry.z1) & (hi[:, 2] <= geometry.z2)
+        accept &= ((smooth_min >= local_pixel_size * smooth_range[0])
+                   & (smooth_max <= local_pixel_size * smooth_range[1]))
+        accept &= keep
+
+        is_leaf = moments.leaf[active]
+        accepted.append(active[accept])
+        expanded_leaves.append(active[keep & ~accept & is_leaf])
+        opened = active[keep & ~accept & ~is_leaf]
+        active = np.concatenate((2 * opened, 2 * opened + 1))
+
+    accepted = np.concatenate(accepted)
+    expanded_leaves = np.concatenate(expanded_leaves)
+
+    counts = moments.count[expanded_leaves]
+    offsets = np.repeat(moments.p_lower[expanded_leaves] - np.cumsum(counts) + counts, counts)
+    particles = moments.particle_offsets[offsets + np.arange(counts.sum())]
+
+    logger.info("Level-of-detail rendering: %d super-particles and %d individual particles, replacing %d",
+                len(accepted), len(particles), len(moments.particle_offsets))
+
+    return accepted, particles
+
+
+def super_particles(moments, nodes, quantity_volume_sums, kernel_class, smooth_floor, projected):
+    """Return the positions, smoothing lengths, quantities, masses and densities of super-particles for the
+    given nodes.
+
+    *quantity_volume_sums* gives the sum over each node of the quantity multiplied by the particle volume."""
+    axes = [0, 1] if projected else [0, 1, 2]
+    volume = moments.volume[nodes]
+    mean_smooth_squared = np.maximum(moments.mean_smooth_squared[nodes], smooth_floor ** 2)
+    spread = moments.variance[nodes][:, axes].mean(axis=1) / kernel_variance(kernel_class)
+    smooth = np.sqrt(mean_smooth_squared + spread)
+    mass = moments.mass[nodes]
+    rho = mass / volume
+    qty = quantity_volume_sums[nodes] / volume
+    pos = moments.centroid[nodes]
+    return pos[:, 0], pos[:, 1], pos[:, 2], smooth, qty, mass, rho
+
+
+def deposit_to_pixels(x, y, quantity_volume, geometry):
+    """Return a projected image of super-particles that are much smaller than a pixel.
+
+    The product of the quantity and volume of each super-particle is divided by the pixel area and deposited
+    into the pixel containing its position. For particles distributed across the pixel, this is the expectation
+    of the result from the kernel-sampling renderer, but is obtained at a fraction of the cost."""
+    pixel_dx = (geometry.x2 - geometry.x1) / geometry.nx
+    pixel_dy = (geometry.y2 - geometry.y1) / geometry.ny
+    x_pos = np.floor((x - geometry.x1) / pixel_dx).astype(np.intp)
+    y_pos = np.floor((y - geometry.y1) / pixel_dy).astype(np.intp)
+    inside = (x_pos >= 0) & (x_pos < geometry.nx) & (y_pos >= 0) & (y_pos < geometry.ny)
+    image = np.bincount(y_pos[inside] * geometry.nx + x_pos[inside], weights=quantity_volume[inside],
+                        minlength=geometry.nx * geometry.ny)
+    return (image / (pixel_dx * pixel_dy)).reshape(geometry.ny, geometry.nx).astype(np.float32)
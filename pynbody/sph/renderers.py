@@ -12,14 +12,16 @@ from __future__ import annotations
 import concurrent
 import concurrent.futures
 import copy
+import threading
+import weakref
 from types import NoneType
 
 import numpy as np
 import scipy
 
-from .. import array as array_module, config, snapshot, units
+from .. import array as array_module, config, instrumentation, snapshot, units
 from ..configuration import config_parser, logger
-from . import _render, kernels
+from . import _render, kernels, level_of_detail
 
 
 def _kernel_suitable_for_denoise(kernel):
@@ -129,6 +131,7 @@ class ImageRendererBase:
 
         self.set_smooth_range()
         self.set_smooth_floor()
+        self.set_level_of_detail()
 
     @property
     def geometry(self):
@@ -193,6 +196,26 @@ class ImageRendererBase:
         """
         self._smooth_floor = self._to_position_units(smooth_floor)
 
+    def set_level_of_detail(self, tolerance: float | NoneType = None):
+        """Set the tolerance for merging groups of particles into KDTree node aggregates before rendering.
+
+        Any KDTree node whose size is smaller than *tolerance* times the larger of the pixel size and the minimum
+        smoothing length of its particles is rendered as a single super-particle, conserving the integral of the
+        rendered quantity. This bounds the cost of rendering large, wide-field images by the number of pixels rather
+        than the number of particles. For more information, see :mod:`pynbody.sph.level_of_detail`.
+
+        A KDTree is built for the snapshot if one is not already available.
+
+        Parameters
+        ----------
+        tolerance : float, optional
+            The tolerance; smaller values are more accurate but slower. If None (default), every particle is
+            rendered individually.
+        """
+        self._level_of_detail = tolerance
+        self._level_of_detail_cache = {}
+        self._level_of_detail_lock = threading.Lock()
+
     def set_particle_array_slice(self, slice):
         """Set the slice of particles to be rendered.
 
@@ -439,6 +462,7 @@ class MultipassImageRenderer(ImageRendererBase):
     def with_threading(self, num_threads = None ):
         raise RenderPipelineLogicError("Threading cannot be set for a multipass image render. Try setting the threading status for the individual stages before generating the multipass renderer.")
 
+    @instrumentation.instrumented('render')
     def render(self):
         return [r.render() for r in self._subrenderers]
 
@@ -446,6 +470,11 @@ class MultipassImageRenderer(ImageRendererBase):
         for r in self._subrenderers:
             r.set_smooth_range(smooth_min, smooth_max)
 
+    def set_level_of_detail(self, tolerance: float | NoneType = None):
+        self._level_of_detail = tolerance
+        for r in self._subrenderers:
+            r.set_level_of_detail(tolerance)
+
     def set_particle_array_slice(self, slice):
         for r in self._subrenderers:
             r.set_particle_array_slice(slice)
@@ -460,6 +489,7 @@ class DenoisedImageRenderer(MultipassImageRenderer):
         self._subrenderers[1].set_quantity(np.ones(len(self._snapshot), dtype=base._array.dtype))
         self._subrenderers[1].set_output_units(None)
 
+    @instrumentation.instrumented('render')
     def render(self):
         result_source_field, result_noise_field = super().render()
         return result_source_field / result_noise_field
@@ -500,6 +530,7 @@ class ProjectionAverageImageRenderer(MultipassImageRenderer):
         self._subrenderers[0].set_output_units(units_)
         self._subrenderers[1].set_output_units(None)
 
+    @instrumentation.instrumented('render')
     def render(self):
         result_source_field, result_weight_field = super().render()
 
@@ -524,6 +555,7 @@ class ThreadedImageRenderer(MultipassImageRenderer):
             # render every num_threads particle, starting at i
             r.set_particle_array_slice(slice(i, None, num_threads))
 
+    @instrumentation.instrumented('render')
     def render(self):
         with concurrent.futures.ThreadPoolExecutor(max_workers=len(self._subrenderers)) as executor:
             # logger.info("Rendering image on %d threads..." % self._num_threads)
@@ -564,6 +596,7 @@ class ApproximateImageRenderer(MultipassImageRenderer):
             zoomed_images.append(zoomed_result)
         return zoomed_images
 
+    @instrumentation.instrumented('render')
     def render(self):
         results = self._apply_zoom(super().render())
         summed = sum(results)
@@ -588,6 +621,7 @@ class ImageRenderer(ImageRendererBase):
         return repeat_array
 
 
+    @instrumentation.instrumented('render')
     def render(self):
         kernel = kernels.create_kernel(self._kernel)
 
@@ -597,14 +631,9 @@ class ImageRenderer(ImageRendererBase):
         g = self._geometry
 
         with self._snapshot.immediate_mode:
-            if self._particle_array_slice is not None:
-                mass, rho, x, y, z, smooth = (self._snapshot[name][self._particle_array_slice]
-                                              for name in ('mass', 'rho', 'x', 'y', 'z', self._smooth))
-                array = self._array[self._particle_array_slice]
-            else:
-                mass, rho, x, y, z, smooth = (self._snapshot[name]
-                                              for name in ('mass', 'rho', 'x', 'y', 'z', self._smooth))
-                array = self._array
+            mass, rho, x, y, z, smooth = (self._snapshot[name]
+                                          for name in ('mass', 'rho', 'x', 'y', 'z', self._smooth))
+            array = self._array
 
         if hasattr(array, 'units'):
             array_units = array.units
@@ -620,9 +649,33 @@ class ImageRenderer(ImageRendererBase):
             conversion = 1.0
             out_units = native_units
 
-        smooth, array, mass, rho = (q.view(np.ndarray) for q in (smooth, array, mass, rho))
+        pixel_deposits = None
+        if self._level_of_detail is None:
+            batches = [((x, y, z, smooth, array, mass, rho), (self._smooth_min, self._smooth_max))]
+        else:
+            particles, super_particles, pixel_deposits = self._get_level_of_detail_particles(x, y, z, smooth, array,
+                                                                                            mass, rho)
+            # the smoothing range has already been applied when selecting the nodes for super-particles
+            batches = [(particles, (self._smooth_min, self._smooth_max)), (super_particles, (0.0, np.inf))]
+
+        image = None
+        for (x, y, z, smooth, array, mass, rho), smooth_range in batches:
+            if self._particle_array_slice is not None:
+                x, y, z, smooth, array, mass, rho = (q[self._particle_array_slice]
+                                                     for q in (x, y, z, smooth, array, mass, rho))
+
+            smooth, array, mass, rho = (np.asarray(q) for q in (smooth, array, mass, rho))
+
+            batch_image = self._call_c_renderer(array, g, kernel, mass, rho, smooth, x, y, z, smooth_range)
+            if image is None:
+                image = batch_image
+            else:
+                image += batch_image
 
-        image = self._call_c_renderer(array, g, kernel, mass, rho, smooth, x, y, z)
+        if pixel_deposits is not None:
+            if self._particle_array_slice is not None:
+                pixel_deposits = (q[self._particle_array_slice] for q in pixel_deposits)
+            image += level_of_detail.deposit_to_pixels(*pixel_deposits, g)
 
         if conversion != 1.0:
             image *= conversion
@@ -633,10 +686,65 @@ class ImageRenderer(ImageRendererBase):
 
         return image
 
-    def _call_c_renderer(self, array, geometry, kernel, mass_array, rho_array, smooth_array, x_array, y_array, z_array):
+    def _get_level_of_detail_particles(self, x, y, z, smooth, array, mass, rho):
+        """Return the particles to be rendered after merging KDTree nodes according to the level-of-detail tolerance.
+
+        The result is a tuple of (individual particles, super-particles, pixel deposits). The first two give
+        positions, smoothing lengths, quantities, masses and densities. The last is None, or gives the positions and
+        quantity-volume products of super-particles to be deposited directly into pixels.
+
+        The result is cached, so that threaded renderers sharing this renderer's geometry need only walk the tree
+        once."""
+        g = self._geometry
+        key = (id(array), self._kernel.__class__, self._is_projected, self._level_of_detail, self._smooth_min,
+               self._smooth_max, self._smooth_floor, g.x1, g.x2, g.y1, g.y2, g.z1, g.z2, g.nx, g.ny, g.z_plane,
+               g.z_camera)
+
+        with self._level_of_detail_lock:
+            cached = self._level_of_detail_cache.get(key)
+            if cached is not None and cached[0]() is array:
+                return cached[1]
+
+            kdtree = getattr(self._snapshot, 'kdtree', None)
+            if kdtree is None:
+                self._snapshot.build_tree()
+                kdtree = self._snapshot.kdtree
+            moments = level_of_detail.get_node_moments(kdtree, x, y, z, mass, rho, smooth)
+
+            wrapping = (len(self._calculate_wrapping_repeat_array(g.x1, g.x2)) > 1
+                        or len(self._calculate_wrapping_repeat_array(g.y1, g.y2)) > 1)
+            nodes, particles = level_of_detail.select_nodes(
+                moments, g, self._level_of_detail, self._kernel.max_d, (self._smooth_min, self._smooth_max),
+                self._smooth_floor, self._is_projected, self._level_of_detail_slice_plane(), culling=not wrapping)
+
+            super_particles = level_of_detail.super_particles(
+                moments, nodes, moments.quantity_volume_sum(array, mass, rho), self._kernel.__class__,
+                self._smooth_floor, self._is_projected)
+
+            if self._is_projected and not g.z_camera and not wrapping:
+                # super-particles smaller than a pixel are deposited directly into pixels
+                sub_pixel = self._kernel.max_d * super_particles[3] < min(g.x2 - g.x1, g.y2 - g.y1) / max(g.nx, g.ny)
+                pixel_deposits = (super_particles[0][sub_pixel], super_particles[1][sub_pixel],
+                                  (super_particles[4] * super_particles[5] / super_particles[6])[sub_pixel])
+                super_particles = tuple(q[~sub_pixel] for q in super_particles)
+            else:
+                pixel_deposits = None
+
+            result = (tuple(np.asarray(q)[particles] for q in (x, y, z, smooth, array, mass, rho)), super_particles,
+                      pixel_deposits)
+
+            self._level_of_detail_cache[key] = (weakref.ref(array), result)
+            return result
+
+    def _level_of_detail_slice_plane(self):
+        """Return the z coordinate of the slice being rendered, or None if the image integrates along z"""
+        return None if self._is_projected else self._geometry.z_plane
+
+    def _call_c_renderer(self, array, geometry, kernel, mass_array, rho_array, smooth_array, x_array, y_array,
+                         z_array, smooth_range):
         image = _render.render_image(geometry.nx, geometry.ny, x_array, y_array, z_array, smooth_array, geometry.x1, geometry.x2, geometry.y1, geometry.y2,
                                      geometry.z_camera or 0.0, geometry.z_plane, array, mass_array, rho_array,
-                                     self._smooth_min, self._smooth_max, geometry.z1, geometry.z2,
+                                     smooth_range[0], smooth_range[1], geometry.z1, geometry.z2,
                                      self._smooth_floor, kernel,
                                      self._calculate_wrapping_repeat_array(geometry.x1, geometry.x2),
                                      self._calculate_wrapping_repeat_array(geometry.y1, geometry.y2))
@@ -654,10 +762,14 @@ class Grid3dRenderer(ImageRenderer):
         super().set_width(width)
         self.geometry.restrict_z_range() # sets z1, z2 - here this is for the grid edges, not the camera
 
-    def _call_c_renderer(self, array, geometry, kernel, mass_array, rho_array, smooth_array, x_array, y_array, z_array):
+    def _level_of_detail_slice_plane(self):
+        return None
+
+    def _call_c_renderer(self, array, geometry, kernel, mass_array, rho_array, smooth_array, x_array, y_array,
+                         z_array, smooth_range):
         image = _render.to_3d_grid(geometry.nx, geometry.ny, geometry.nz, x_array, y_array, z_array,
                                    smooth_array, geometry.x1, geometry.x2, geometry.y1, geometry.y2, geometry.z1, geometry.z2,
-                                   array, mass_array, rho_array, self._smooth_min, self._smooth_max, kernel,
+                                   array, mass_array, rho_array, smooth_range[0], smooth_range[1], kernel,
                                    self._calculate_wrapping_repeat_array(geometry.x1, geometry.x2),
                                    self._calculate_wrapping_repeat_array(geometry.y1, geometry.y2),
                                    self._calculate_wrapping_repeat_array(geometry.z1, geometry.z2))
@@ -677,7 +789,8 @@ def make_render_pipeline(sim : snapshot.SimSnap, /,
                          threaded: bool | NoneType = None,
                          approximate_fast: bool | NoneType = None,
                          denoise: bool | NoneType = None,
-                         grid_3d : bool = False
+                         grid_3d : bool = False,
+                         level_of_detail: float | NoneType = None
                          ) -> ImageRendererBase:
     """Generate a renderer object for rendering images of a simulation snapshot.
 
@@ -760,6 +873,12 @@ def make_render_pipeline(sim : snapshot.SimSnap, /,
     grid_3d : bool, optional
         If True, the renderer will render a 3D grid instead of a 2D image. The default is False.
 
+    level_of_detail : float, optional
+        If specified, groups of particles that are small compared with the pixel size or their smoothing lengths are
+        merged into KDTree node aggregates before rendering, with the given tolerance (e.g. 1.0). This makes
+        wide-field images of large simulations much faster. For more information, see
+        :meth:`ImageRendererBase.set_level_of_detail`. The default is None, i.e. every particle is rendered.
+
     """
     if resolution is None:
         resolution = config['image-default-resolution']
@@ -789,6 +908,7 @@ def make_render_pipeline(sim : snapshot.SimSnap, /,
 
     renderer.set_width(width)
     renderer.set_smooth_floor(smooth_floor)
+    renderer.set_level_of_detail(level_of_detail)
     if restrict_depth:
         renderer.restrict_z_range()
 
@@ -10,7 +10,7 @@ np.import_array()
 cimport openmp
 from cython.parallel cimport prange
 from libc.math cimport atan, pow
-from libc.stdlib cimport free, malloc
+from libc.stdlib cimport free, malloc, strtod, strtoll
 
 from pynbody import config
 
@@ -340,5 +340,187 @@ cpdef int is_sorted(int_or_float[:] A):
                 return 0
         return -1
 
+cdef inline bint _is_ascii_space(unsigned char c) nogil:
+    return c == b' ' or c == b'\n' or c == b'\t' or c == b'\r' or c == b'\v' or c == b'\f'
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int _parse_ascii_tokens(const unsigned char[:] buf, np.int64_t[:] bounds, np.int64_t[:] offsets,
+                             int_or_float[:] out, int num_threads):
+    """Parse the tokens in each of the regions delimited by bounds into out, starting at the specified offsets.
+
+    Returns the number of tokens that could not be parsed."""
+    cdef int t, n_regions = len(bounds) - 1
+    cdef np.int64_t i, j, end
+    cdef int errors = 0
+    cdef char *endptr
+    cdef const char *start
+
+    for t in prange(n_regions, nogil=True, schedule='static', chunksize=1, num_threads=num_threads):
+        i = bounds[t]
+        end = bounds[t+1]
+        j = offsets[t]
+        while i < end:
+            if _is_ascii_space(buf[i]):
+                i = i + 1
+                continue
+            start = <const char *> &buf[i]
+            endptr = NULL # assignment ensures cython makes endptr thread-private
+            if int_or_float is np.float32_t or int_or_float is np.float64_t:
+                out[j] = <int_or_float> strtod(start, &endptr)
+            else:
+                out[j] = <int_or_float> strtoll(start, &endptr, 10)
+            if endptr == start or not _is_ascii_space(<unsigned char> endptr[0]):
+                errors += 1
+                while i < end and not _is_ascii_space(buf[i]):
+                    i = i + 1
+            else:
+                i = i + (endptr - start)
+            j = j + 1
+    return errors
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def parse_ascii_numbers(const unsigned char[:] buf, dtype, int num_threads=-1):
+    """Parse whitespace-separated numbers from a bytes-like buffer in parallel.
+
+    Only complete tokens, i.e. those followed by whitespace, are parsed; the caller is responsible for
+    passing any trailing partial token back in with the next block of data (or appending whitespace
+    at the end of the file).
+
+    Parameters
+    ----------
+    buf : bytes-like
+        The text to parse
+    dtype : numpy dtype
+        The output dtype; must be one of float32, float64, int32 or int64
+    num_threads : int, optional
+        If greater than zero, use that many parallel threads. Otherwise, use config['number_of_threads']
+
+    Returns
+    -------
+    values : array
+        The parsed values
+    consumed : int
+        The number of bytes of *buf* that were consumed
+    """
+
+    cdef np.int64_t N = len(buf), end, i, total
+    cdef int t, n_regions
+
+    if num_threads <= 0:
+        num_threads = config['number_of_threads']
+
+    end = N
+    while end > 0 and not _is_ascii_space(buf[end-1]):
+        end -= 1
+
+    # split into one region per thread, with each boundary falling on whitespace so that no
+    # token straddles two regions
+    n_regions = max(1, min(num_threads, end // 65536))
+    cdef np.int64_t[:] bounds = np.empty(n_regions + 1, dtype=np.int64)
+    cdef np.int64_t[:] counts = np.zeros(n_regions, dtype=np.int64)
+    bounds[0] = 0
+    bounds[n_regions] = end
+    for t in range(1, n_regions):
+        i = max((end * t) // n_regions, bounds[t-1])
+        while i < end and not _is_ascii_space(buf[i]):
+            i += 1
+        bounds[t] = i
+
+    for t in prange(n_regions, nogil=True, schedule='static', chunksize=1, num_threads=num_threads):
+        for i in range(bounds[t], bounds[t+1]):
+            if not _is_ascii_space(buf[i]) and (i == 0 or _is_ascii_space(buf[i-1])):
+                counts[t] += 1
+
+    cdef np.int64_t[:] offsets = np.zeros(n_regions, dtype=np.int64)
+    for t in range(1, n_regions):
+        offsets[t] = offsets[t-1] + counts[t-1]
+    total = offsets[n_regions-1] + counts[n_regions-1]
+
+    cdef np.float32_t[:] values_f32
+    cdef np.float64_t[:] values_f64
+    cdef np.int32_t[:] values_i32
+    cdef np.int64_t[:] values_i64
+    cdef int errors
+
+    values = np.empty(total, dtype=dtype)
+    if values.dtype == np.float32:
+        values_f32 = values
+        errors = _parse_ascii_tokens(buf, bounds, offsets, values_f32, num_threads)
+    elif values.dtype == np.float64:
+        values_f64 = values
+        errors = _parse_ascii_tokens(buf, bounds, offsets, values_f64, num_threads)
+    elif values.dtype == np.int32:
+        values_i32 = values
+        errors = _parse_ascii_tokens(buf, bounds, offsets, values_i32, num_threads)
+    elif values.dtype == np.int64:
+        values_i64 = values
+        errors = _parse_ascii_tokens(buf, bounds, offsets, values_i64, num_threads)
+    else:
+        raise TypeError("Unsupported dtype %s for ASCII parsing" % values.dtype)
+
+    if errors > 0:
+        raise ValueError("Unable to parse %d entries as %s" % (errors, values.dtype))
+
+    return values, end
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def segmented_moments(np.ndarray[fused_float, ndim=2] values,
+                      np.ndarray[fused_float_2, ndim=1] weights,
+                      np.ndarray[fused_int, ndim=1] indices,
+                      np.ndarray[fused_int_2, ndim=2] boundaries,
+                      bint weighted=True, bint second_moment=False, int num_threads=-1):
+    """Calculate weighted sums, means and (optionally) variances of values over many segments in one parallel pass.
+
+    Segment s consists of the rows values[indices[boundaries[s,0]:boundaries[s,1]]]. The weight of each row is
+    given by weights[indices[...]] if *weighted* is True; otherwise all weights are one (and *weights* is ignored).
+
+    Returns a tuple (sum_w, sum_wv, var) where sum_w has length Nsegments, sum_wv has shape (Nsegments, ndim) and
+    var is the weighted variance about the weighted mean with shape (Nsegments, ndim) if *second_moment* is True,
+    otherwise None. The variance is calculated with a second pass over the data, for numerical accuracy."""
+    cdef Py_ssize_t nseg = boundaries.shape[0]
+    cdef Py_ssize_t ndim = values.shape[1]
+    cdef Py_ssize_t s, j, k, start, stop, p
+    cdef double w, mean_k, d
+
+    cdef np.ndarray[np.float64_t, ndim=1] sum_w = np.zeros(nseg)
+    cdef np.ndarray[np.float64_t, ndim=2] sum_wv = np.zeros((nseg, ndim))
+    cdef Py_ssize_t nvar = nseg if second_moment else 0
+    cdef np.ndarray[np.float64_t, ndim=2] var = np.zeros((nvar, ndim))
+
+    if num_threads <= 0:
+        num_threads = config['number_of_threads']
+
+    for s in prange(nseg, nogil=True, schedule='dynamic', chunksize=64, num_threads=num_threads):
+        start = boundaries[s, 0]
+        stop = boundaries[s, 1]
+        for j in range(start, stop):
+            p = indices[j]
+            if weighted:
+                w = weights[p]
+            else:
+                w = 1.0
+            sum_w[s] += w
+            for k in range(ndim):
+                sum_wv[s, k] += w * values[p, k]
+
+        if second_moment and sum_w[s] > 0:
+            for k in range(ndim):
+                mean_k = sum_wv[s, k] / sum_w[s]
+                for j in range(start, stop):
+                    p = indices[j]
+                    if weighted:
+                        w = weights[p]
+                    else:
+                        w = 1.0
+                    d = values[p, k] - mean_k
+                    var[s, k] += w * d * d
+                var[s, k] /= sum_w[s]
+
+    return sum_w, sum_wv, (var if second_moment else None)
+
 __all__ = ['grid_gen','find_boundaries', 'sum', 'sum_if_gt', 'sum_if_lt',
-           'binary_search', 'is_sorted']
+           'binary_search', 'is_sorted', 'parse_ascii_numbers', 'segmented_moments']
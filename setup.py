@@ -141,8 +141,15 @@ interpolate3d_pyx = Extension('pynbody.analysis._interpolate3d',
                               extra_link_args=openmp_args)
 
 
+mass_assignment_pyx = Extension('pynbody.analysis._mass_assignment',
+                                sources = ['pynbody/analysis/_mass_assignment.pyx'],
+                                include_dirs=incdir,
+                                extra_compile_args=openmp_args,
+                                extra_link_args=openmp_args)
+
+
 ext_modules += [gravity, chunkscan, sph_render, halo_pyx, bridge_pyx, util_pyx, filt_geom_pyx,
-                cython_fortran_file, interpolate3d_pyx, omp_commands]
+                cython_fortran_file, interpolate3d_pyx, mass_assignment_pyx, omp_commands]
 
 install_requires = [
     'cython>=0.20',
@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import pynbody
+from pynbody.snapshot import cached
+
+
+@pytest.fixture
+def gadgethdf_snapshot(tmp_path):
+    f = pynbody.new(dm=2000, gas=1000)
+    f['pos'] = np.random.uniform(size=(len(f), 3))
+    f['pos'].units = 'kpc a h^-1'
+    f['vel'] = np.random.normal(size=(len(f), 3))
+    f['vel'].units = 'km s^-1'
+    f['mass'] = np.random.uniform(1e-6, 1e-5, size=len(f))
+    f['mass'].units = '1e10 Msol h^-1'
+    f.properties.update(a=0.5, h=0.7, omegaM0=0.3, omegaL0=0.7, boxsize=pynbody.units.Unit('1 kpc a h^-1'),
+                        time=pynbody.units.Unit('3.3 Gyr'))
+    filename = tmp_path / "snap.hdf5"
+    f.write(pynbody.snapshot.gadgethdf.GadgetHDFSnap, str(filename))
+    return filename
+
+
+@pytest.fixture
+def enable_cache():
+    pynbody.config['cache']['enabled'] = True
+    yield
+    pynbody.config['cache']['enabled'] = False
+
+
+def test_cache_roundtrip(gadgethdf_snapshot):
+    f = pynbody.load(gadgethdf_snapshot)
+    f.write(cached.CachedSnap, arrays=['smooth'])
+    assert cached.cache_path(gadgethdf_snapshot).is_dir()
+
+    f_cached = pynbody.load(cached.cache_path(gadgethdf_snapshot))
+    assert isinstance(f_cached, cached.CachedSnap)
+    assert set(f_cached.loadable_keys()) == {'pos', 'mass', 'smooth'}
+    assert f_cached.families() == f.families()
+    assert f_cached.properties['boxsize'] == f.properties['boxsize']
+    assert f_cached.properties['time'] == f.properties['time']
+
+    for name in 'pos', 'mass', 'smooth':
+        assert f_cached[name].units == f[name].units
+        npt.assert_array_equal(f_cached[name], f[name])
+    npt.assert_array_equal(f_cached.gas['pos'], f.gas['pos'])
+
+    # arrays not in the cache come from the original snapshot
+    npt.assert_array_equal(f_cached['vel'], f['vel'])
+
+
+def test_cache_transparent_use(gadgethdf_snapshot, enable_cache):
+    assert isinstance(pynbody.load(gadgethdf_snapshot), pynbody.snapshot.gadgethdf.GadgetHDFSnap)
+    pynbody.load(gadgethdf_snapshot).write(cached.CachedSnap)
+
+    f = pynbody.load(gadgethdf_snapshot)
+    assert isinstance(f, cached.CachedSnap)
+    assert 'smooth' not in f.loadable_keys()
+    f['smooth']
+    # derived arrays listed in the configuration are added to the cache automatically
+    assert 'smooth' in pynbody.load(gadgethdf_snapshot).loadable_keys()
+
+    # modifying the original snapshot invalidates the cache
+    mtime = os.stat(gadgethdf_snapshot).st_mtime_ns
+    os.utime(gadgethdf_snapshot, ns=(mtime + 10**9, mtime + 10**9))
+    assert isinstance(pynbody.load(gadgethdf_snapshot), pynbody.snapshot.gadgethdf.GadgetHDFSnap)
+    with pytest.raises(OSError, match="out of date"):
+        cached.CachedSnap(gadgethdf_snapshot)
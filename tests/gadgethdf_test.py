@@ -138,3 +138,31 @@ def test_arepo_style_units():
     with pytest.warns(UserWarning, match="Unable to infer units from HDF attributes"):
         assert f.st['EMP_BirthTemperature'].units == units.NoUnit()
     # here is a case where no unit information is recorded in the file (who knows why)
+
+@pytest.mark.parametrize("kwargs", [{}, {'compression': 'gzip', 'shuffle': True}, {'compression': 'lzf'},
+                                    {'num_files': 3, 'compression': 'gzip', 'chunk_size': 100}])
+def test_write_snapshot(kwargs, tmp_path):
+    f = pynbody.new(dm=2000, gas=1000, star=50)
+    f['pos'] = np.random.uniform(size=(len(f), 3))
+    f['pos'].units = 'kpc a h^-1'
+    f['vel'] = np.random.normal(size=(len(f), 3))
+    f['vel'].units = 'km s^-1 a^1/2'
+    f['mass'] = np.random.uniform(size=len(f))
+    f['mass'].units = '1e10 Msol h^-1'
+    f.gas['rho'] = np.random.uniform(size=len(f.gas))
+    f.gas['rho'].units = 'Msol kpc^-3'
+    f.properties.update(a=0.5, h=0.7, omegaM0=0.3, omegaL0=0.7, boxsize=units.Unit('10 Mpc a h^-1'))
+
+    f.write(pynbody.snapshot.gadgethdf.GadgetHDFSnap, str(tmp_path / "written"), **kwargs)
+
+    if kwargs.get('num_files', 1) > 1:
+        assert (tmp_path / "written.2.hdf5").exists()
+    f2 = pynbody.load(str(tmp_path / "written"))
+
+    assert f2.families() == [pynbody.family.gas, pynbody.family.dm, pynbody.family.star]
+    npt.assert_allclose(f2.properties['boxsize'].in_units('Mpc a h^-1'), 10.0)
+    for fam in f.families():
+        assert (f2[fam]['iord'] == f[fam].get_index_list(f)).all()
+        for name in 'pos', 'vel', 'mass':
+            npt.assert_allclose(f2[fam][name].in_units(f[name].units), f[fam][name], rtol=1e-6)
+    npt.assert_allclose(f2.gas['rho'].in_units('Msol kpc^-3'), f.gas['rho'], rtol=1e-6)
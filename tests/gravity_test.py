@@ -69,3 +69,27 @@ def test_eps_retrieval_number():
                             -0.06739005, -0.06748439, -0.0695245,
                             -0.06803885, -0.0679833,  -0.07277965, -0.07189107])
     npt.assert_allclose(f['phi'][:10], true_phi_10)
+
+
+def test_tree_matches_direct():
+    f = pynbody.new(5000)
+    np.random.seed(1)
+    f['pos'] = np.random.normal(size=(5000, 3)) * np.random.uniform(0.1, 1.0, size=(5000, 1))
+    f['pos'].units = 'kpc'
+    f['mass'] = np.random.uniform(0.5, 1.5, size=5000)
+    f['mass'].units = '1e10 Msol'
+    f['eps'] = np.ones(5000) * 0.01
+    f['eps'].units = 'kpc'
+
+    pynbody.gravity.calc.all_direct(f)
+    phi_direct, accel_direct = f['phi'].copy(), f['acc'].copy()
+    pynbody.gravity.calc.all_tree(f, opening_angle=0.5)
+
+    assert f['phi'].units == phi_direct.units
+    npt.assert_allclose(f['phi'], phi_direct, rtol=5e-3)
+    accel_error = np.linalg.norm(f['acc'] - accel_direct, axis=1) / np.linalg.norm(accel_direct, axis=1)
+    assert np.median(accel_error) < 5e-3
+
+    rbins = np.linspace(0.1, 2.0, 10)
+    npt.assert_allclose(pynbody.gravity.calc.midplane_rot_curve(f, rbins, solver='tree'),
+                        pynbody.gravity.calc.midplane_rot_curve(f, rbins), rtol=5e-3)
@@ -3,6 +3,7 @@
 import warnings
 
 import numpy as np
+import numpy.testing as npt
 import pytest
 
 import pynbody
@@ -275,6 +276,35 @@ def test_get_group_array():
     assert (f.dm['comparison_grp'] == dm_grp).all()
     assert (f.gas['comparison_grp'] == gas_grp).all()
 
+@pytest.mark.parametrize("family", [None, pynbody.family.gas])
+def test_reduce(family):
+    f = pynbody.new(dm=100, gas=100)
+    f['mass'] = np.random.uniform(1.0, 2.0, len(f))
+    f['mass'].units = 'Msol'
+    f['pos'] = np.random.normal(size=(len(f), 3))
+    f['pos'].units = 'kpc'
+    h = SimpleHaloCatalogueWithMultiMembership(f)
+
+    mass = h.reduce('mass', family=family)
+    com = h.reduce('pos', 'mean', family=family)
+    dispersion = h.reduce('pos', 'std', family=family, weight=None)
+    count = h.reduce(op='count', family=family)
+
+    assert mass.units == 'Msol'
+    assert com.shape == (len(h), 3)
+
+    for i, halo_number in enumerate(h.keys()):
+        halo = h[halo_number] if family is None else h[halo_number][family]
+        assert count[i] == len(halo)
+        npt.assert_allclose(mass[i], halo['mass'].sum())
+        if len(halo) > 0:
+            npt.assert_allclose(com[i], halo.mean_by_mass('pos'))
+            npt.assert_allclose(dispersion[i], halo['pos'].std(axis=0))
+        else:
+            assert np.isnan(com[i]).all()
+
+    npt.assert_allclose(h[2:5].reduce('mass', family=family), mass[h.number_mapper.number_to_index(np.arange(2, 5))])
+
 
 
 @pytest.fixture
@@ -49,6 +49,43 @@ def test_center_wrapped_halo():
 
 
 
+def _triaxial_halos(npart, axis_ratios):
+    f = pynbody.new(dm=npart * len(axis_ratios))
+    np.random.seed(1337)
+    for i, (ba, ca) in enumerate(axis_ratios):
+        pos = np.random.normal(size=(npart, 3)) * [1.0, ba, ca]
+        rotation, _ = np.linalg.qr(np.random.normal(size=(3, 3)))
+        f['pos'][i * npart:(i + 1) * npart] = pos @ rotation.T
+    f['mass'] = np.random.uniform(0.5, 1.5, len(f))
+    f['grp'] = np.repeat(np.arange(1, len(axis_ratios) + 1), npart)
+    return f
+
+
+def test_halo_shapes():
+    npart = 20000
+    f = _triaxial_halos(npart, [(0.8, 0.6), (0.5, 0.3)])
+    halos = [f[i * npart:(i + 1) * npart] for i in range(2)]
+
+    for bins in ('equal', 'log'):
+        shapes = pynbody.analysis.halo.halo_shapes(halos, N=8, rin=0.1, bins=bins)
+        assert shapes.shape == (2, 8)
+        for halo, shape in zip(halos, shapes):
+            rbin, ba, ca, angle, Es = pynbody.analysis.halo.halo_shape(halo, N=8, rin=0.1, bins=bins)
+            npt.assert_allclose(shape['r'], rbin)
+            npt.assert_allclose(shape['b'] / shape['a'], ba, rtol=1e-6)
+            npt.assert_allclose(shape['c'] / shape['a'], ca, rtol=1e-6)
+            npt.assert_allclose(shape['angle'], angle, rtol=1e-6)
+
+    # the same result is obtained from a halo catalogue, given the centres
+    catalogue = f.halos(priority=['HaloNumberCatalogue'])
+    shapes_from_catalogue = pynbody.analysis.halo.halo_shapes(catalogue, N=8, centers=np.zeros((2, 3)))
+    npt.assert_allclose(shapes_from_catalogue['b'], pynbody.analysis.halo.halo_shapes(halos, N=8)['b'])
+
+    # the outer shells recover the input axis ratios
+    shapes = pynbody.analysis.halo.halo_shapes(halos, N=4, bins='lin', rin=0.5, rout=2.0)
+    npt.assert_allclose(np.median(shapes['b'] / shapes['a'], axis=1), [0.8, 0.5], atol=0.05)
+    npt.assert_allclose(np.median(shapes['c'] / shapes['a'], axis=1), [0.6, 0.3], atol=0.05)
+
 def test_align():
     global f, h
     with pynbody.analysis.angmom.faceon(h[0]) as t:
@@ -70,6 +107,23 @@ def test_virialradius():
         np.testing.assert_allclose(vrad, 0.005946911872, atol=1.e-5)
 
 
+def test_catalogue_centers_and_radii():
+    global f, h
+    result = pynbody.analysis.halo.catalogue_centers_and_radii(h, overdensities=(178, 500),
+                                                                particles_for_velocity=500)
+    for halo_number in (0, 1):
+        halo_index = h.number_mapper.number_to_index(halo_number)
+        cen, vel = pynbody.analysis.halo.shrink_sphere_center(h[halo_number], particles_for_velocity=500)
+        npt.assert_allclose(result['center'][halo_index], cen, rtol=1e-5)
+        npt.assert_allclose(result['vel'][halo_index], vel, rtol=1e-5)
+        with h[halo_number].translate(-cen):
+            vrad = pynbody.analysis.halo.virial_radius(h[halo_number], r_max=result['r_178'][halo_index] * 2)
+        npt.assert_allclose(result['r_178'][halo_index], vrad, rtol=1e-2)
+    found = ~np.isnan(result['r_500'])
+    assert (result['r_500'][found] <= result['r_178'][found]).all()
+    assert (result['m_500'][found] <= result['m_178'][found]).all()
+
+
 def test_ssc_bighalo():
     s = pynbody.load('testdata/gadget3/data/subhalos_103/subhalo_103')
     s.physical_units()
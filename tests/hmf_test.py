@@ -58,3 +58,29 @@ def test_get_empirical_hmf(recwarn):
           3.99810849e-05])
     npt.assert_allclose(err, [1.48092011e-04, 8.53762344e-05, 5.53994163e-05, 4.45210519e-05,
           1.78800847e-05])
+
+def test_fftlog():
+    ln_k = np.linspace(np.log(1e-4), np.log(1e4), 4096)
+    ln_r, r3_xi = hmf._fftlog(ln_k, np.exp(-np.exp(ln_k) ** 2 / 2), hmf._j0_mellin, -1.5)
+    r = np.exp(ln_r)
+    use = (r > 0.1) & (r < 3.0)
+    # Fourier transform of a gaussian power spectrum
+    npt.assert_allclose(r3_xi[use] / r[use] ** 3, (2 * np.pi) ** -1.5 * np.exp(-r[use] ** 2 / 2), rtol=1e-6)
+
+
+def test_correlation(recwarn):
+    f = pynbody.new()
+    ps = hmf.PowerSpectrum(f)
+    npt.assert_allclose(hmf.correlation([0.05, 1.0, 80.0], ps), [35.4712, 5.39458, 9.3537e-4], rtol=1e-4)
+    npt.assert_allclose(hmf.correlation(1.0, ps), 5.39458, rtol=1e-4)
+
+
+@pytest.mark.parametrize("filter_class", [hmf.TophatFilter, hmf.GaussianFilter, hmf.HarmonicStepFilter])
+def test_variance_vectorised(recwarn, filter_class):
+    f = pynbody.new()
+    ps = hmf.PowerSpectrum(f)
+    filt = filter_class(f)
+    masses = 10 ** np.arange(8.0, 16.0, 1.0)
+    variances = hmf.variance(masses, filt, ps)
+    npt.assert_allclose([hmf.variance(m, filt, ps) for m in masses], variances)
+    assert (np.diff(variances) < 0).all()
@@ -0,0 +1,54 @@
+import json
+
+import numpy as np
+
+import pynbody
+from pynbody import instrumentation
+
+
+def _make_snapshot():
+    f = pynbody.new(gas=5000)
+    f['pos'] = np.random.uniform(size=(len(f), 3))
+    f['pos'].units = 'kpc'
+    f['mass'] = np.ones(len(f))
+    f['mass'].units = 'Msol'
+    return f
+
+
+def test_profile_records_events(tmp_path):
+    f = _make_snapshot()
+    with instrumentation.Profile() as prof:
+        f['rho']
+        pynbody.sph.render_image(f, width=1, resolution=50)
+
+    kinds = {(e.kind, e.name) for e in prof.events}
+    assert ('lazy_get', 'rho') in kinds
+    assert ('derive', 'rho') in kinds
+    assert ('kdtree_populate', 'rho') in kinds
+    assert ('render', 'ImageRenderer.render') in kinds
+
+    derive_rho = [e for e in prof.events if e.kind == 'derive' and e.name == 'rho'][0]
+    assert derive_rho.dependency_chain == ['rho']
+
+    lazy_get_rho = [e for e in prof.events if e.kind == 'lazy_get' and e.name == 'rho'][0]
+    assert lazy_get_rho.duration >= lazy_get_rho.self_duration >= 0
+    assert lazy_get_rho.bytes_allocated >= f['rho'].nbytes
+
+    summary = prof.summary()
+    assert summary[0]['self_time'] >= summary[-1]['self_time']
+    assert "kdtree_populate" in prof.report()
+
+    prof.write_chrome_trace(tmp_path / "trace.json")
+    with open(tmp_path / "trace.json") as trace_file:
+        trace = json.load(trace_file)
+    assert len(trace['traceEvents']) == len(prof.events)
+    assert all(e['ph'] == 'X' for e in trace['traceEvents'])
+
+
+def test_no_events_outside_profile():
+    f = _make_snapshot()
+    with instrumentation.Profile(trace_memory=False) as prof:
+        pass
+    f['smooth']
+    assert prof.events == []
+    assert instrumentation.region('load', 'pos') is instrumentation.region('load', 'vel')
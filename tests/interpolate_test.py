@@ -0,0 +1,58 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+import scipy.interpolate
+
+import pynbody
+from pynbody.analysis.interpolate import GridInterpolator, interpolate3d, load_table
+
+
+@pytest.mark.parametrize("ndim", [2, 3])
+def test_grid_interpolator(ndim):
+    np.random.seed(1)
+    axes = [np.sort(np.random.uniform(size=n)) for n in (6, 41, 7)[:ndim]]
+    tables = {'a': np.random.uniform(size=[len(a) for a in axes]),
+              'b': np.random.uniform(size=[len(a) for a in axes])}
+    interp = GridInterpolator(axes, tables)
+
+    points = np.random.uniform(size=(1000, ndim))
+    result = interp(*points.T)
+    assert set(result.keys()) == {'a', 'b'}
+
+    # points outside the grid are clamped to its edge
+    clamped = np.clip(points, [a[0] for a in axes], [a[-1] for a in axes])
+    for name, table in tables.items():
+        npt.assert_allclose(result[name], scipy.interpolate.interpn(axes, table, clamped))
+
+    # weights can be reused, and a subset of tables selected
+    weights = interp.weights(*points.T)
+    npt.assert_array_equal(interp(weights=weights, names=['b'])['b'], result['b'])
+
+
+def test_grid_interpolator_matches_interpolate3d():
+    np.random.seed(2)
+    axes = [np.linspace(0, 1, n) for n in (5, 10, 8)]
+    table = np.random.uniform(size=(5, 10, 8))
+    points = np.random.uniform(size=(100, 3))
+    npt.assert_allclose(GridInterpolator(axes, {'t': table})(*points.T)['t'],
+                        interpolate3d(*points.T, *axes, table))
+
+
+def test_ionfrac_multiple_ions():
+    f = pynbody.new(gas=1000)
+    f['temp'] = 10 ** np.random.uniform(3, 8, len(f))
+    f['temp'].units = 'K'
+    f['rho'] = 10 ** np.random.uniform(-7, 1, len(f))
+    f['rho'].units = 'm_p cm^-3'
+    f.properties['z'] = 0.5
+
+    ions = pynbody.analysis.ionfrac.available_ions()
+    assert 'ovi' in ions
+    result = pynbody.analysis.ionfrac.calculate(f, ions)
+    for ion in ions:
+        npt.assert_array_equal(result[ion], pynbody.analysis.ionfrac.calculate(f, ion))
+        assert np.all(result[ion] > 0) and np.all(result[ion] <= 1.0001)
+
+    # tables are loaded only once
+    ifs = load_table(pynbody.analysis.ionfrac._ionfrac_file)
+    assert ifs is load_table(pynbody.analysis.ionfrac._ionfrac_file)
@@ -131,3 +131,11 @@ def test_halo_half_light(testfile):
     pynbody.analysis.faceon(h[0])
     for (band, cylindrical), expected in expected_results.items():
         npt.assert_allclose(pynbody.analysis.luminosity.half_light_r(h[0], band, cylindrical=cylindrical), expected)
+
+def test_multiple_bands(testfile):
+    for ssp_name, tests in results.items():
+        with pynbody.analysis.luminosity.use_custom_ssp_table(ssp_name):
+            mags = pynbody.analysis.luminosity.calc_mags(testfile.st, band=list(tests.keys()))
+            assert list(mags.keys()) == list(tests.keys())
+            for band, result in tests.items():
+                npt.assert_allclose(mags[band][::5000], result, rtol=1e-5)
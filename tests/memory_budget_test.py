@@ -0,0 +1,84 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import pynbody
+
+
+@pytest.fixture
+def gadgethdf_snapshot(tmp_path):
+    f = pynbody.new(dm=2000, gas=1000)
+    f['pos'] = np.random.uniform(size=(len(f), 3))
+    f['pos'].units = 'kpc a h^-1'
+    f['vel'] = np.random.normal(size=(len(f), 3))
+    f['vel'].units = 'km s^-1'
+    f['mass'] = np.random.uniform(1e-6, 1e-5, size=len(f))
+    f['mass'].units = '1e10 Msol h^-1'
+    f.properties.update(a=0.5, h=0.7, omegaM0=0.3, omegaL0=0.7, boxsize=pynbody.units.Unit('1 kpc a h^-1'))
+    filename = tmp_path / "snap.hdf5"
+    f.write(pynbody.snapshot.gadgethdf.GadgetHDFSnap, str(filename))
+    return filename
+
+
+def test_parse_memory_size():
+    from pynbody.snapshot.memory_budget import parse_memory_size
+    assert parse_memory_size("4 GB") == 4 * 1024**3
+    assert parse_memory_size("512MB") == 512 * 1024**2
+    assert parse_memory_size(1e6) == 1000000
+    assert parse_memory_size("none") is None
+    assert parse_memory_size(0) is None
+
+
+def test_lru_eviction(gadgethdf_snapshot):
+    f = pynbody.load(gadgethdf_snapshot)
+    f.set_memory_budget("1 GB")
+    pos = np.array(f['pos'])
+    f.set_memory_budget(f['pos'].nbytes * 3 // 2)
+    f['vel']
+
+    # loading vel took us over budget, so the least recently used array (pos) must have been evicted
+    assert 'pos' not in f.keys()
+    assert 'x' not in f.keys()
+    assert 'vel' in f.keys()
+
+    # ...but is transparently reloaded on demand
+    npt.assert_array_equal(f['x'], pos[:, 0])
+    assert 'vel' not in f.keys()
+
+
+def test_derived_arrays_evicted_and_rederived(gadgethdf_snapshot):
+    f = pynbody.load(gadgethdf_snapshot)
+    f.set_memory_budget(f['pos'].nbytes * 21 // 10)
+
+    r = np.array(f['r'])
+    assert 'r' in f.keys()
+    f['vel']
+    assert 'r' not in f.keys()
+    npt.assert_array_equal(f['r'], r)
+
+
+def test_modified_and_referenced_arrays_not_evicted(gadgethdf_snapshot):
+    f = pynbody.load(gadgethdf_snapshot)
+    f.set_memory_budget(1)
+
+    f['mass'] *= 2
+    vel = f['vel']
+    f['pos']
+    f['r']
+
+    assert 'mass' in f.keys()
+    assert 'vel' in f.keys()
+    assert 'pos' not in f.keys()
+
+    del vel
+    f['pos']
+    assert 'vel' not in f.keys()
+
+
+def test_kdtree_arrays_not_evicted(gadgethdf_snapshot):
+    f = pynbody.load(gadgethdf_snapshot)
+    f.set_memory_budget(1)
+    f.build_tree()
+    f['vel']
+    assert 'pos' in f.keys()
+    assert 'mass' in f.keys()
@@ -0,0 +1,60 @@
+import contextlib
+import sys
+import time
+
+import numpy as np
+
+import pynbody
+
+
+@contextlib.contextmanager
+def timer(name):
+    start = time.time()
+    yield
+    end = time.time()
+    print(f"{name} took {end-start:.2f}s")
+
+print("""performance_halo_shape.py
+
+This script compares the performance of halo_shapes, which fits all shells of many halos in parallel, against
+calling halo_shape on each halo in turn. It also reports the largest difference in axis ratios between the two,
+but the normal unit tests should be used to check correctness.
+
+You can test with different numbers of threads by passing the number of threads as an argument to this script.
+
+""")
+
+try:
+    num_threads = int(sys.argv[1])
+    print("Using", num_threads, "threads for shape fitting")
+except Exception:
+    num_threads = None
+
+np.random.seed(1337)
+
+Nhalos = 50
+Npart_per_halo = 20000
+Nshells = 20
+
+f = pynbody.new(dm=Nhalos * Npart_per_halo)
+for i in range(Nhalos):
+    ba, ca = np.sort(np.random.uniform(0.3, 1.0, size=2))[::-1]
+    pos = np.random.normal(size=(Npart_per_halo, 3)) * [1.0, ba, ca]
+    rotation, _ = np.linalg.qr(np.random.normal(size=(3, 3)))
+    f['pos'][i * Npart_per_halo:(i + 1) * Npart_per_halo] = pos @ rotation.T
+f['mass'] = np.ones(len(f))
+
+halos = [f[i * Npart_per_halo:(i + 1) * Npart_per_halo] for i in range(Nhalos)]
+
+with timer("halo_shape, one halo at a time"):
+    old_ba = []
+    for h in halos:
+        print(".", end="")
+        sys.stdout.flush()
+        old_ba.append(pynbody.analysis.halo.halo_shape(h, N=Nshells)[1])
+    print()
+
+with timer("halo_shapes, all halos at once"):
+    shapes = pynbody.analysis.halo.halo_shapes(halos, N=Nshells, num_threads=num_threads)
+
+print("Largest difference in b/a:", np.nanmax(np.abs(shapes['b'] / shapes['a'] - np.array(old_ba))))
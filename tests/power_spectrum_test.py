@@ -0,0 +1,65 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import pynbody
+from pynbody.analysis import _mass_assignment, power_spectrum
+
+
+@pytest.fixture
+def random_snapshot():
+    np.random.seed(1)
+    f = pynbody.new(dm=100000)
+    f['pos'] = np.random.uniform(0, 100, size=(len(f), 3))
+    f['pos'].units = 'Mpc'
+    f['mass'] = np.ones(len(f))
+    f.properties['boxsize'] = pynbody.units.Unit('100 Mpc')
+    return f
+
+
+@pytest.mark.parametrize("scheme", [1, 2, 3])
+def test_deposit_threaded(scheme):
+    np.random.seed(1)
+    pos = np.random.uniform(0, 1, size=(10000, 3))
+    mass = np.random.uniform(1, 2, size=10000)
+    serial = np.zeros((32, 32, 32))
+    threaded = np.zeros((32, 32, 32))
+    _mass_assignment.deposit(pos, mass, serial, 0.0, 1/32, scheme, 0.0, True, 1)
+    _mass_assignment.deposit(pos, mass, threaded, 0.0, 1/32, scheme, 0.0, True, 4)
+    npt.assert_allclose(serial, threaded)
+    npt.assert_allclose(serial.sum(), mass.sum())
+
+
+@pytest.mark.parametrize("scheme", ['cic', 'tsc'])
+def test_shot_noise(random_snapshot, scheme):
+    k, Pk, num_modes = power_spectrum.power_spectrum(random_snapshot, ngrid=32, scheme=scheme,
+                                                     subtract_shot_noise=False)
+    assert k.units == pynbody.units.Unit("Mpc^-1")
+    assert Pk.units == pynbody.units.Unit("Mpc^3")
+    shot_noise = 100.0**3 / len(random_snapshot)
+    # a random distribution has only shot noise, which should be flat once the window is deconvolved
+    well_sampled = num_modes > 2000
+    npt.assert_allclose(Pk[well_sampled], shot_noise, rtol=0.15)
+
+    k, Pk, num_modes = power_spectrum.power_spectrum(random_snapshot, ngrid=32, scheme=scheme)
+    assert abs(Pk[well_sampled]).max() < 0.15 * shot_noise
+
+
+def test_plane_wave():
+    ngrid = 32
+    q = (np.indices((ngrid,) * 3).reshape(3, -1).T + 0.5) * 100.0 / ngrid
+    k_wave = 2 * np.pi * 3 / 100.0
+    q[:, 0] += 0.3 * np.sin(k_wave * q[:, 0])
+
+    f = pynbody.new(dm=len(q))
+    f['pos'] = q % 100.0
+    f['mass'] = np.ones(len(f))
+    f.properties['boxsize'] = 100.0
+
+    k, Pk, num_modes = power_spectrum.power_spectrum(f, ngrid=ngrid)
+    assert abs(k[np.argmax(Pk)] - k_wave) < 2 * np.pi / 100.0
+
+    r, xi = power_spectrum.correlation_function(f, ngrid=ngrid)
+    # the spherically averaged correlation function of a plane wave is proportional to sin(kr)/kr
+    assert xi[0] > 0
+    assert xi[np.argmin(abs(r - 4.49 / k_wave))] < 0
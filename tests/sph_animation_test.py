@@ -0,0 +1,93 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import pynbody
+from pynbody.sph import animation, renderers
+
+
+@pytest.fixture(scope='module')
+def gas():
+    np.random.seed(1)
+    n = 20000
+    f = pynbody.new(gas=n)
+    f['pos'] = np.random.normal(scale=3.0, size=(n, 3))
+    f['pos'].units = 'kpc'
+    f['mass'] = np.full(n, 1e4)
+    f['mass'].units = 'Msol'
+    f['temp'] = np.random.uniform(1e4, 2e4, n)
+    f['temp'].units = 'K'
+    f['smooth'], f['rho']
+    return f
+
+
+def _reference_image(f, frame, **kwargs):
+    centre, rotation, width, z_camera = frame
+    with f.translate(-centre), f.rotate(rotation):
+        return renderers.make_render_pipeline(f, width=width, z_camera=z_camera, resolution=50, threaded=False,
+                                              approximate_fast=False, **kwargs).render()
+
+
+@pytest.mark.parametrize("kwargs", [dict(out_units="Msol kpc^-2"),
+                                    dict(quantity='temp'),
+                                    dict(quantity='temp', weight='rho'),
+                                    dict(out_units="Msol kpc^-2", restrict_depth=True)])
+def test_frames_match_transformed_snapshot(gas, kwargs):
+    path = animation.CameraPath.from_keyframes([0, 1, 2], [[0, 0, 0], [1, 0, 0], [1, 1, 0]],
+                                               [np.eye(3), np.eye(3), [[0, 1, 0], [-1, 0, 0], [0, 0, 1]]],
+                                               [8.0, 6.0, 4.0], 7)
+    renderer = animation.FrameSequenceRenderer(gas, path, resolution=50, threaded=False, **kwargs)
+    for i, image in enumerate(renderer.frames()):
+        npt.assert_allclose(image, _reference_image(gas, path[i], **kwargs), rtol=1e-5)
+
+
+def test_selection_reused_between_frames(gas):
+    rotation = [[np.cos(0.3), np.sin(0.3), 0], [-np.sin(0.3), np.cos(0.3), 0], [0, 0, 1]]
+    path = animation.CameraPath([[0, 0, 0], [0.2, 0, 0], [4.0, 0, 0]], [np.eye(3), rotation, rotation], 4.0)
+    renderer = animation.FrameSequenceRenderer(gas, path, resolution=50, threaded=False)
+    renderer.render_frame(0)
+    working = renderer._working_snapshot
+    assert len(working) < len(gas)
+
+    # a small movement and rotation about the line of sight keeps the view within the margin...
+    image = renderer.render_frame(1)
+    assert renderer._working_snapshot is working
+    npt.assert_allclose(image, _reference_image(gas, path[1]), rtol=1e-5)
+
+    # ...but a large movement does not
+    image = renderer.render_frame(2)
+    assert renderer._working_snapshot is not working
+    npt.assert_allclose(image, _reference_image(gas, path[2]), rtol=1e-5)
+
+
+def test_perspective_orbit(gas):
+    path = animation.CameraPath.orbit([0, 0, 0], 4.0, 4, axis='x', z_camera=20.0)
+    renderer = animation.FrameSequenceRenderer(gas, path, resolution=50, threaded=False, restrict_depth=True)
+    for i in range(len(path)):
+        npt.assert_allclose(renderer.render_frame(i), _reference_image(gas, path[i], restrict_depth=True),
+                            rtol=1e-5)
+
+
+def test_keyframe_interpolation():
+    rotation = [[0, 1, 0], [-1, 0, 0], [0, 0, 1]]
+    path = animation.CameraPath.from_keyframes([0, 1], [[0, 0, 0], [2, 0, 0]], [np.eye(3), rotation],
+                                               [1.0, 100.0], 3)
+    assert len(path) == 3
+    npt.assert_allclose(path.centres[1], [1, 0, 0])
+    npt.assert_allclose(path.widths, [1.0, 10.0, 100.0])
+    npt.assert_allclose(path.rotations[2], rotation, atol=1e-12)
+    assert path[0][3] is None
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_render_to_files(gas, tmp_path, processes):
+    path = animation.CameraPath.orbit([0, 0, 0], 8.0, 4, axis='y')
+    renderer = animation.FrameSequenceRenderer(gas, path, resolution=50, out_units="Msol kpc^-2")
+    filenames = renderer.render_to_files(str(tmp_path / "frames" / "frame_{:02d}.npy"), processes=processes)
+    assert len(filenames) == 4
+    for i, filename in enumerate(filenames):
+        npt.assert_allclose(np.load(filename), renderer.render_frame(i))
+
+    filenames = renderer.render_to_files(str(tmp_path / "frame_{:02d}.png"), processes=processes,
+                                         vmin=1e5, vmax=1e9)
+    assert all((tmp_path / f"frame_{i:02d}.png").exists() for i in range(4))
@@ -122,6 +122,21 @@ def test_approximate_images(compare2d, compare3d, compare_grid):
     assert abs(np.log10(im3d/compare3d)).mean()<0.03
     assert abs(np.log10(im_grid / compare_grid)).mean() < 0.03
 
+def test_level_of_detail_images(compare2d, compare3d):
+    global f
+    im2d = pynbody.plot.sph.image(
+        f.gas, width=20.0, units="m_p cm^-2", noplot=True, approximate_fast=False, resolution=500,
+        level_of_detail=1.0)
+    im3d = pynbody.plot.sph.image(
+        f.gas, width=20.0, units="m_p cm^-3", noplot=True, approximate_fast=False, resolution=500,
+        level_of_detail=1.0)
+
+    np.save("result_lod_im_2d.npy", im2d)
+    np.save("result_lod_im_3d.npy", im3d)
+
+    assert abs(np.log10(im2d/compare2d)).mean()<0.02
+    assert abs(np.log10(im3d/compare3d)).mean()<0.03
+
 
 def test_denoise_projected_image_throws():
     global f
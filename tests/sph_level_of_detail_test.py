@@ -0,0 +1,81 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+
+import pynbody
+from pynbody.sph import level_of_detail, renderers
+
+
+@pytest.fixture(scope='module')
+def clumpy_gas():
+    np.random.seed(1)
+    n = 200000
+    centres = np.random.uniform(-10, 10, size=(200, 3))
+    which = np.random.randint(0, 200, size=n)
+    f = pynbody.new(gas=n)
+    f['pos'] = centres[which] + np.random.normal(size=(n, 3)) * np.random.uniform(0.05, 0.5, size=200)[which, None]
+    f['pos'].units = 'kpc'
+    f['mass'] = np.ones(n)
+    f['mass'].units = 'Msol'
+    f['temp'] = np.random.uniform(1e4, 2e4, size=n)
+    f['temp'].units = 'K'
+    f.gas['smooth']
+    f.gas['rho']
+    return f
+
+
+def _render(f, resolution, level_of_detail=None, **kwargs):
+    return renderers.make_render_pipeline(f.gas, width=20.0, resolution=resolution, approximate_fast=False,
+                                          level_of_detail=level_of_detail, **kwargs).render()
+
+
+def test_node_moments(clumpy_gas):
+    f = clumpy_gas.gas
+    kdtree = f.kdtree
+    moments = level_of_detail.get_node_moments(kdtree, f['x'], f['y'], f['z'], f['mass'], f['rho'], f['smooth'])
+    assert level_of_detail.get_node_moments(kdtree, f['x'], f['y'], f['z'], f['mass'], f['rho'],
+                                            f['smooth']) is moments
+
+    npt.assert_allclose(moments.mass[1], f['mass'].sum())
+    npt.assert_allclose(moments.volume[1], (f['mass'] / f['rho']).sum())
+    npt.assert_allclose(moments.centroid[1], np.average(f['pos'], weights=f['mass'] / f['rho'], axis=0), atol=1e-10)
+    assert moments.smooth_min[1] == f['smooth'].min()
+    assert moments.smooth_max[1] == f['smooth'].max()
+    npt.assert_allclose(moments.mass[2] + moments.mass[3], moments.mass[1])
+
+
+def test_zero_tolerance_matches_exact(clumpy_gas):
+    npt.assert_allclose(_render(clumpy_gas, 100, 0.0, out_units="Msol kpc^-2"),
+                        _render(clumpy_gas, 100, out_units="Msol kpc^-2"), rtol=1e-5)
+
+
+def _errors_against_truth(f, units):
+    # Compare low-resolution images with a block average of a high resolution one
+    truth = np.asarray(_render(f, 400, out_units=units)).reshape(50, 8, 50, 8).mean(axis=(1, 3))
+    exact = np.asarray(_render(f, 50, out_units=units))
+    approx = np.asarray(_render(f, 50, 1.0, out_units=units))
+    return abs(exact - truth).sum() / truth.sum(), abs(approx - truth).sum() / truth.sum()
+
+
+def test_level_of_detail_projected_accuracy(clumpy_gas):
+    # Particles are much smaller than the low-resolution pixels, so the exact renderer is noisy whereas the
+    # level-of-detail renderer, which deposits aggregates into pixels, should be closer to the truth
+    exact_error, approx_error = _errors_against_truth(clumpy_gas, "Msol kpc^-2")
+    assert approx_error < exact_error
+    assert approx_error < 0.2
+
+
+def test_level_of_detail_slice_accuracy(clumpy_gas):
+    exact_error, approx_error = _errors_against_truth(clumpy_gas, "Msol kpc^-3")
+    assert approx_error < 1.1 * exact_error
+
+
+@pytest.mark.filterwarnings("ignore:invalid value encountered in divide:RuntimeWarning")
+def test_level_of_detail_pipeline(clumpy_gas):
+    reference = _render(clumpy_gas, 50, 1.0, quantity='temp', out_units='K kpc', threaded=False)
+    npt.assert_allclose(_render(clumpy_gas, 50, 1.0, quantity='temp', out_units='K kpc', threaded=True),
+                        reference, rtol=1e-4)
+    assert reference.units == pynbody.units.Unit("K kpc")
+
+    averaged = _render(clumpy_gas, 50, 1.0, quantity='temp', weight='rho', threaded=True)
+    assert 1e4 <= np.nanmin(averaged) and np.nanmax(averaged) <= 2e4
@@ -338,6 +338,46 @@ def test_snapshot_update(test_output):
     f3 = pynbody.load(test_output)
     assert (f3.dm['metals'] == 789.1).all()
 
+def test_aux_array_format_cache(test_output):
+    f1 = pynbody.load(test_output)
+    f1['ascii_array'] = np.arange(len(f1), dtype=float)
+    f1['ascii_array'].write()
+    f1['binary_array'] = np.arange(len(f1), dtype=np.float32) * 2
+    f1.write_array('binary_array', binary=True)
+
+    # an array written by another code, with no .pynbody-meta file
+    with open(test_output + ".external_array", "w") as f:
+        f.write("%d\n" % len(f1))
+        np.savetxt(f, np.arange(len(f1)) * 3, fmt="%d")
+
+    del f1
+
+    f2 = pynbody.load(test_output)
+    assert f2._get_aux_array_format('ascii_array', test_output + ".ascii_array") == (False, np.float64)
+    assert f2._get_aux_array_format('binary_array', test_output + ".binary_array") == (True, np.float32)
+
+    assert (f2.dm['external_array'] == np.arange(20, 29) * 3).all()
+    assert f2['external_array'].dtype == int
+    with open(test_output + ".external_array.pynbody-meta") as f:
+        assert "format: ascii int64" in f.read()
+
+    assert (f2.star['binary_array'] == np.arange(29, 40) * 2).all()
+    assert (f2['ascii_array'] == np.arange(40)).all()
+
+def test_aux_array_partial_load(test_output):
+    f1 = pynbody.load(test_output)
+    f1['ascii_array'] = np.arange(len(f1), dtype=float)
+    f1['ascii_array'].write()
+    f1['binary_array'] = np.arange(len(f1), dtype=np.float32)
+    f1.write_array('binary_array', binary=True)
+    del f1
+
+    take = np.array([1, 2, 25, 38])
+    f2 = pynbody.load(test_output, take=take)
+    assert (f2['ascii_array'] == take).all()
+    assert (f2['binary_array'] == take).all()
+    assert (f2.dm['binary_array'] == [25]).all()
+
 def test_unit_persistence():
     f1 = pynbody.load("testdata/gasoline_ahf/g15784.lr.01024")
     f1['pos']
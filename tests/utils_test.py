@@ -215,3 +215,23 @@ def test_is_sorted():
     assert pynbody.util.is_sorted(np.array([1, 2, 3])) == 1
     assert pynbody.util.is_sorted(np.array([1, 2, 1])) == 0
     assert pynbody.util.is_sorted(np.array([3, 2, 1])) == -1
+
+def test_parse_ascii_numbers():
+    values = np.random.normal(size=100000)
+    text = "\n".join("%.10e" % v for v in values) + "\n"
+
+    for nthreads in [1, 2, 7]:
+        parsed, consumed = pynbody.util.parse_ascii_numbers(text.encode(), np.float64, num_threads=nthreads)
+        assert consumed == len(text)
+        npt.assert_allclose(parsed, values, rtol=1e-9)
+
+    # incomplete trailing token is left unparsed
+    parsed, consumed = pynbody.util.parse_ascii_numbers(b"1 -2\t3\n 45", np.int32)
+    npt.assert_equal(parsed, [1, -2, 3])
+    assert consumed == 8
+
+    parsed, _ = pynbody.util.parse_ascii_numbers(b"inf 1.5e3\n", np.float32)
+    npt.assert_equal(parsed, [np.inf, 1500.0])
+
+    with pytest.raises(ValueError):
+        pynbody.util.parse_ascii_numbers(b"1 2.5\n", np.int64)